@@ -1,5 +1,3 @@
-from flask import Flask
-from flask_login import LoginManager
 import os
 import sys
 
@@ -9,37 +7,27 @@ parent_dir_path = os.path.abspath(os.path.join(dir_path, os.pardir))
 sys.path.insert(0, parent_dir_path)
 
 from matilda.config import *
+from matilda.lazy_imports import lazy_star_imports
 
-from matilda.fundamental_analysis import *
-from matilda.portfolio_management import *
-from matilda.quantitative_analysis import *
-from matilda.broker_deployment import *
-
-from matilda.data_pipeline.object_model import User
-from matilda.data_pipeline.db_crud import get_atlas_db_url, connect_to_mongo_engine
-from matilda.api_routes.auth import auth as auth_blueprint
-from matilda.api_routes.main import main as main_blueprint
+from matilda.data_pipeline.db_crud import get_atlas_db_url, connect_to_mongo_engine, register_mongo_engine
 
+# the client is created, and the cluster reached, by the first read or write
 atlas_url = get_atlas_db_url(username='AlainDaccache', password='qwerty98', dbname='matilda-db')
-db = connect_to_mongo_engine(atlas_url)
-
-app = Flask(__name__)
-app.config["DEBUG"] = True
-app.config['SECRET_KEY'] = 'secret-key-goes-here'
+register_mongo_engine(atlas_url)
 
-app.register_blueprint(auth_blueprint)  # blueprint for auth routes in our app
-app.register_blueprint(main_blueprint)  # blueprint for non-auth parts of app
+# each analysis subpackage is imported by the first use of one of its names, e.g. `from matilda import beneish_m_score`
+_lazy_star_getattr = lazy_star_imports(__name__, ['matilda.fundamental_analysis', 'matilda.portfolio_management',
+                                                  'matilda.quantitative_analysis', 'matilda.broker_deployment'])
 
-login_manager = LoginManager()
-login_manager.login_view = 'auth.login'
-login_manager.init_app(app)
 
-
-@login_manager.user_loader
-def load_user(user_id):
-    # since the email is just the primary key of our user table, use it in the query for the user
-    return User.objects(_id=user_id).first()
+def __getattr__(name: str):
+    if name == 'create_app':  # the web app, and flask, are only imported by `flask run` with FLASK_APP=matilda
+        from matilda.api_routes import create_app
+        return create_app
+    return _lazy_star_getattr(name)
 
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0')
+    from matilda.api_routes import create_app
+
+    create_app().run(debug=True, host='0.0.0.0')
@@ -0,0 +1,30 @@
+from flask import Flask
+from flask_login import LoginManager
+
+from matilda.data_pipeline.object_model import User
+from matilda.api_routes.auth import auth as auth_blueprint
+from matilda.api_routes.main import main as main_blueprint
+
+login_manager = LoginManager()
+login_manager.login_view = 'auth.login'
+
+
+@login_manager.user_loader
+def load_user(user_id):
+    # since the email is just the primary key of our user table, use it in the query for the user
+    return User.objects(_id=user_id).first()
+
+
+def create_app(debug: bool = True, secret_key: str = 'secret-key-goes-here') -> Flask:
+    """
+    Build the web app. Also found by `flask run` with FLASK_APP=matilda.
+    """
+    app = Flask('matilda')  # templates are in matilda/templates
+    app.config["DEBUG"] = debug
+    app.config['SECRET_KEY'] = secret_key
+
+    app.register_blueprint(auth_blueprint)  # blueprint for auth routes in our app
+    app.register_blueprint(main_blueprint)  # blueprint for non-auth parts of app
+
+    login_manager.init_app(app)
+    return app
@@ -57,6 +57,28 @@ FINANCIAL_STATEMENTS_DIR_PATH_PICKLE_YEARLY = os.path.join(FINANCIAL_STATEMENTS_
 STOCK_PRICES_DIR_NAME = 'stock_prices'
 STOCK_PRICES_DIR_PATH = os.path.join(DATA_DIR_PATH, STOCK_PRICES_DIR_NAME)
 
+PRICE_STORE_DIR_NAME = 'price_store'
+PRICE_STORE_DIR_PATH = os.path.join(DATA_DIR_PATH, PRICE_STORE_DIR_NAME)
+
+UNIVERSE_MATRIX_DIR_NAME = 'universe_matrix'
+UNIVERSE_MATRIX_DIR_PATH = os.path.join(DATA_DIR_PATH, UNIVERSE_MATRIX_DIR_NAME)
+
+FUNDAMENTALS_CUBE_DIR_NAME = 'fundamentals_cube'
+FUNDAMENTALS_CUBE_DIR_PATH = os.path.join(DATA_DIR_PATH, FUNDAMENTALS_CUBE_DIR_NAME)
+
+READ_CACHE_FILE_NAME = 'read_cache.sqlite'
+READ_CACHE_FILE_PATH = os.path.join(DATA_DIR_PATH, READ_CACHE_FILE_NAME)
+
+LOCAL_DATABASE_FILE_NAME = 'local_database.sqlite'
+LOCAL_DATABASE_FILE_PATH = os.path.join(DATA_DIR_PATH, LOCAL_DATABASE_FILE_NAME)
+STORAGE_BACKEND = 'mongo'  # where `db_crud` reads and writes: 'mongo' for the cluster, 'sqlite' for the file above
+
+IMPORT_TIMES_FILE_NAME = 'import_times.csv'
+IMPORT_TIMES_FILE_PATH = os.path.join(DATA_DIR_PATH, IMPORT_TIMES_FILE_NAME)
+
+WALK_FORWARD_CACHE_DIR_NAME = 'walk_forward_cache'
+WALK_FORWARD_CACHE_DIR_PATH = os.path.join(DATA_DIR_PATH, WALK_FORWARD_CACHE_DIR_NAME)
+
 MACRO_DATA_FILE_NAME = 'Macro-Data.xlsx'
 MACRO_DATA_FILE_PATH = os.path.join(DATA_DIR_PATH, MACRO_DATA_FILE_NAME)
 
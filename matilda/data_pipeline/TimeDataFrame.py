@@ -5,22 +5,37 @@ import numpy as np
 from datetime import timedelta
 from datetime import datetime
 from matilda import config
-from matilda.data_pipeline.data_preparation_helpers import get_date_index
+from matilda.data_pipeline.data_preparation_helpers import date_slice
 from matilda.data_pipeline.db_crud import read_prices_series
+from matilda.data_pipeline.universe_matrix import get_universe_matrix
 
 
 class TimeDataFrame:
-    def __init__(self, returns):
+    def __init__(self, returns, from_date: datetime = None, to_date: datetime = None):
+        """
+        :param returns: tickers, series or dataframes of returns
+        :param from_date: first date of the returns read for tickers, by default their whole history
+        :param to_date: last date of the returns read for tickers, by default their whole history
+        """
         returns_copy = []
         cur_max_freq = 'D'
         frequencies = {'D': 0, 'B': 0, 'W': 1, 'M': 2, 'Q': 3, 'Y': 4}
         # frequencies = ['D', 'W', 'M', 'Q', 'Y']
         if not isinstance(returns, list):
             returns = [returns]
+        # only tickers need the universe matrix, returns given in memory are wrapped as they are
+        universe_matrix = get_universe_matrix() if len(returns) > 0 \
+            and all(isinstance(retrn, str) for retrn in returns) else None
+        if universe_matrix is not None and all(retrn in universe_matrix for retrn in returns):
+            # one block sliced from the mapped universe matrix, instead of one prices query per ticker
+            returns = [universe_matrix.frame('returns', tickers=returns, trading_days_only=True,
+                                             from_date=from_date, to_date=to_date)]
         for retrn in returns:
             if isinstance(retrn, str):
                 # path = os.path.join(config.STOCK_PRICES_DIR_PATH, '{}.pkl'.format(retrn))
-                series = read_prices_series(stock=retrn).pct_change().rename(retrn)
+                series = read_prices_series(stock=retrn, from_date=datetime.min if from_date is None else from_date,
+                                            to_date=datetime.max if to_date is None else to_date)
+                series = series.pct_change().rename(retrn)
                 # series = pd.read_pickle(path)['Adj Close'].pct_change().rename(retrn)
                 returns_copy.append(series)
                 l_ = 1
@@ -101,28 +116,28 @@ class TimeDataFrame:
             self.frequency = frequency[0]
 
     def slice_dataframe(self, to_date: datetime = None, from_date=None, inplace: bool = False):
-        if to_date is not None:
-            to_date_idx = get_date_index(date=to_date, dates_values=self.df_returns.index)
-        else:
-            to_date = self.df_returns.index[-1]
-            to_date_idx = len(self.df_returns)
+        """
+        Keep the returns after `from_date` and up to `to_date` included.
 
-        if isinstance(from_date, datetime):
-            from_date_idx = get_date_index(date=from_date, dates_values=self.df_returns.index)
-        elif isinstance(from_date, int):
+        :param to_date: by default, up to the last return
+        :param from_date: a date, or a lookback from `to_date` as a timedelta or a number of periods of the frequency.
+            By default, from the first return.
+        """
+        last_date = self.df_returns.index[-1] if to_date is None else to_date
+        if isinstance(from_date, int):
             period_to_int = {'D': 1, 'W': 7, 'M': 30.5, 'Y': 365.25}
-            lookback = timedelta(days=int(period_to_int[self.frequency[0]] * from_date))
-            from_date_idx = get_date_index(date=to_date - lookback, dates_values=self.df_returns.index)
+            from_date = last_date - timedelta(days=int(period_to_int[self.frequency[0]] * from_date))
         elif isinstance(from_date, timedelta):
-            from_date_idx = get_date_index(date=to_date - from_date, dates_values=self.df_returns.index)
-        else:
-            from_date_idx = 0
+            from_date = last_date - from_date
+        elif not isinstance(from_date, datetime):
+            from_date = None
+        rows = date_slice(self.df_returns.index, from_date=from_date, to_date=to_date)
 
         if inplace:
-            self.df_returns = self.df_returns.iloc[from_date_idx:to_date_idx]
+            self.df_returns = self.df_returns.iloc[rows]
         else:
             class_ = self.__class__.__name__
-            return self.__class__(self.df_returns.iloc[from_date_idx:to_date_idx])
+            return self.__class__(self.df_returns.iloc[rows])
 
     def merge(self, time_dfs: typing.List, inplace: bool = False):
         merged_returns = self.df_returns
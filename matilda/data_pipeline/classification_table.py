@@ -0,0 +1,83 @@
+"""
+In-memory classification of the companies: sector, industry, location and exchange of every ticker.
+
+The companies are read once per process into category-coded columns, one per classification field, along with an
+inverted index from each category to its tickers, so that both
+
+>>> get_classification_table().value('AAPL', 'gics_sector')
+>>> get_classification_table().tickers_where('gics_sector', config.GICS_Sectors.INFORMATION_TECHNOLOGY.value)
+
+are dictionary and array lookups, rather than a query each (e.g. for every stock `compare_against_macro` scores).
+"""
+
+import typing
+
+import numpy as np
+import pandas as pd
+
+from matilda.data_pipeline import object_model
+from matilda.data_pipeline.storage_backend import get_storage_backend
+
+CLASSIFICATION_FIELDS = ['sic_sector', 'sic_industry', 'gics_sector', 'gics_industry', 'location', 'exchange']
+
+
+class ClassificationTable:
+    def __init__(self, companies: typing.Iterable[typing.Dict]):
+        """
+        :param companies: fields of each company as stored, its ticker being '_id' (see `StorageBackend.read_company`)
+        """
+        self.companies = {company['_id']: company for company in companies}
+        self.tickers = pd.Index(sorted(self.companies))
+        self.rows = {ticker: row for row, ticker in enumerate(self.tickers)}
+        self.codes, self.categories, self.inverted = {}, {}, {}
+        for field in CLASSIFICATION_FIELDS:
+            column = pd.Categorical([self.companies[ticker].get(field) for ticker in self.tickers])
+            self.codes[field], self.categories[field] = column.codes, column.categories
+            # tickers of each category, in one sort of the codes
+            order = np.argsort(column.codes, kind='stable')
+            bounds = np.searchsorted(column.codes[order], np.arange(len(column.categories) + 1))
+            self.inverted[field] = {category: self.tickers[order[bounds[code]:bounds[code + 1]]].to_numpy()
+                                    for code, category in enumerate(column.categories)}
+
+    def __contains__(self, ticker: str):
+        return ticker in self.rows
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def classification(self, ticker: str) -> typing.Dict:
+        """
+        :return: copy of the fields of the company, as `get_company_classification` returns them
+        """
+        return dict(self.companies[ticker])
+
+    def value(self, ticker: str, field: str):
+        """
+        :return: category of the company for `field`, e.g. its 'gics_sector', None if it has none
+        """
+        code = self.codes[field][self.rows[ticker]]
+        return None if code < 0 else self.categories[field][code]
+
+    def tickers_where(self, field: str, value: str) -> typing.List[str]:
+        """
+        :return: tickers of the companies whose `field` is `value`
+        """
+        if field not in self.inverted:
+            raise Exception('Please enter a classification field, one of {}'.format(CLASSIFICATION_FIELDS))
+        return self.inverted[field].get(value, np.array([], dtype=object)).tolist()
+
+
+_classification_table = None
+
+
+def get_classification_table(refresh: bool = False) -> ClassificationTable:
+    """
+    The classification of every company stored, read once per process.
+
+    :param refresh: read the companies again, e.g. after `populate_db_company_info`
+    """
+    global _classification_table
+    if refresh or _classification_table is None:
+        _classification_table = ClassificationTable(company.to_mongo().to_dict() for company
+                                                    in get_storage_backend().documents(object_model.Company))
+    return _classification_table
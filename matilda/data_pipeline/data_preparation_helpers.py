@@ -3,10 +3,7 @@ import os
 import traceback
 from datetime import datetime, timedelta
 import pandas as pd
-from openpyxl.styles import PatternFill
-from openpyxl import load_workbook
 import numpy as np
-import xlrd
 
 from matilda import config
 
@@ -42,34 +39,80 @@ def sort_df(df, column_idx, key):
     return df.iloc[order]
 
 
+def datetime64_values(dates_values) -> np.ndarray:
+    """
+    Dates as a datetime64 array, whether strings ('%Y-%m-%d'), datetimes, timestamps or datetime64.
+    """
+    if len(dates_values) > 0 and isinstance(dates_values[0], str):
+        return pd.to_datetime(list(dates_values), format='%Y-%m-%d').to_numpy(dtype='datetime64[ns]')
+    return np.asarray(dates_values, dtype='datetime64[ns]')
+
+
+def is_descending(dates_values) -> bool:
+    """
+    Whether the dates decrease rightwards or downwards, judging by the first two.
+    """
+    if len(dates_values) <= 1:
+        return False
+    first, second = datetime64_values(dates_values[:2])
+    return first > second
+
+
+def date_positions(dates, dates_values, side: str = 'right'):
+    """
+    Positions of `dates` on a date axis sorted either way, by binary search: the boundary between the dates of the
+    axis up to each date (included if `side` is 'right', excluded if 'left') and the dates after it. On an ascending
+    axis, the dates up to a date are `dates_values[:position]`; on a descending axis, `dates_values[position:]`.
+
+    :param dates: a date, or a list or array of dates to look up at once
+    :param dates_values: sorted dates of the axis, e.g. a `DatetimeIndex`
+    :param side: 'right' or 'left'
+    :return: int, or array of ints aligned on `dates`
+    """
+    values = datetime64_values(dates_values)
+    targets = datetime64_values(np.atleast_1d(dates))
+    if len(values) > 1 and values[0] > values[1]:
+        positions = len(values) - np.searchsorted(values[::-1], targets, side=side)
+    else:
+        positions = np.searchsorted(values, targets, side=side)
+    return positions if np.ndim(dates) > 0 else int(positions[0])
+
+
+def date_slice(dates_values, from_date=None, to_date=None) -> slice:
+    """
+    Positional slice of the dates of an axis sorted either way that are after `from_date` and up to `to_date`
+    included, e.g. `series.iloc[date_slice(series.index, from_date, to_date)]`.
+
+    :param from_date: by default, from the first date
+    :param to_date: by default, to the last date
+    """
+    start, stop = (to_date, from_date) if is_descending(dates_values) else (from_date, to_date)
+    return slice(0 if start is None else date_positions(start, dates_values),
+                 len(dates_values) if stop is None else date_positions(stop, dates_values))
+
+
 def get_date_index(date, dates_values, lookback_index=0):
-    if isinstance(dates_values[0], str):
-        dates_values = [datetime.strptime(x, '%Y-%m-%d') for x in dates_values]
-    elif isinstance(dates_values[0], np.datetime64):
-        dates_values = [x.astype('M8[ms]').astype('O') for x in dates_values]
-
-    if len(dates_values) > 1:
-        if dates_values[0] > dates_values[1]:  # if dates decreasing rightwards or downwards
-            date_index = next((index for (index, item) in enumerate(dates_values) if item < date), 0)
-            # adjusted_lookback = date_item - lookback_period
-            # lookback_index = next((
-            #     index for (index, item) in enumerate(dates_values[date_index:]) if item <= adjusted_lookback), 0)
-            return date_index + lookback_index
-        else:  # if dates increasing rightwards or downwards
-            date_index = next((index for (index, item) in enumerate(dates_values) if item > date), -1)
-            # adjusted_lookback = date_item - lookback_period
-            # lookback_index = next((
-            #     index for (index, item) in enumerate(dates_values[date_index:]) if item > adjusted_lookback), -1)
-            return date_index - lookback_index  # TODO Fix lookback index is a date here, convert before calling method
+    """
+    Position of the first date after `date` on an ascending axis (-1 if there is none), or of the first date before
+    `date` on a descending axis (0 if there is none), shifted `lookback_index` dates back. See `date_slice` to slice
+    an axis between two dates.
 
+    :param date: a date, or a list or array of dates to look up at once
+    :return: int, or array of ints aligned on `date`
+    """
+    if len(dates_values) <= 1:
+        return np.zeros(len(date), dtype=int) if np.ndim(date) > 0 else 0
+    if is_descending(dates_values):
+        positions = date_positions(date, dates_values, side='left')
+        positions = np.where(positions == len(dates_values), 0, positions) + lookback_index
     else:
-        return 0
+        positions = date_positions(date, dates_values, side='right')
+        positions = np.where(positions == len(dates_values), -1, positions) - lookback_index
+    return positions if np.ndim(date) > 0 else int(positions)
 
 
 def slice_series_dates(series, from_date, to_date):
-    date_idx_from = get_date_index(from_date, series.index)
-    date_idx_to = get_date_index(to_date, series.index)
-    return series[date_idx_from:date_idx_to]
+    return series.iloc[date_slice(series.index, from_date=from_date, to_date=to_date)]
 
 
 def save_into_csv(filename, df, sheet_name='Sheet1', startrow=None, overwrite_sheet=False, concat=False,
@@ -78,6 +121,8 @@ def save_into_csv(filename, df, sheet_name='Sheet1', startrow=None, overwrite_sh
     if 'engine' in to_excel_kwargs:
         to_excel_kwargs.pop('engine')
 
+    from openpyxl import load_workbook
+
     writer = pd.ExcelWriter(filename, engine='openpyxl')
 
     try:
@@ -130,6 +175,8 @@ def save_into_csv(filename, df, sheet_name='Sheet1', startrow=None, overwrite_sh
 
 
 def read_df_from_csv(path, sheet_name='Sheet1'):
+    import xlrd
+
     if os.path.exists(path):
         workbook = xlrd.open_workbook(path, on_demand=True)
         sheets = workbook.sheet_names()
@@ -163,8 +210,8 @@ def read_entry_from_pickle(path, x, y, lookback_index=0):
 
         elif isinstance(y, list) and isinstance(y[0], datetime):
             to_return = pd.Series()
-            for date in y:
-                date_index = get_date_index(date=date, dates_values=df.index, lookback_index=lookback_index)
+            date_indices = get_date_index(date=y, dates_values=df.index, lookback_index=lookback_index)
+            for date, date_index in zip(y, date_indices):
 
                 reduced_df = df.iloc[date_index, :]
                 for el in ([x] if not isinstance(x, list) else x):
@@ -177,8 +224,8 @@ def read_entry_from_pickle(path, x, y, lookback_index=0):
 
         elif isinstance(x, list) and isinstance(x[0], datetime):
             to_return = pd.Series()
-            for date in x:
-                date_index = get_date_index(date=date, dates_values=df.columns, lookback_index=lookback_index)
+            date_indices = get_date_index(date=x, dates_values=df.columns, lookback_index=lookback_index)
+            for date, date_index in zip(x, date_indices):
                 reduced_df = df.iloc[:, date_index]
                 if reduced_df.index.isin([tuple(y)]).any():
                     reduced_df = reduced_df.loc[tuple(y)]
@@ -233,6 +280,8 @@ def read_entry_from_csv(path, x, y, sheet_name='Sheet1', lookback_index=0, skip_
 
 
 def read_dates_from_csv(path, sheet_name):
+    import xlrd
+
     if os.path.exists(path):
         sheets = xlrd.open_workbook(path, on_demand=True).sheet_names()
         if sheet_name not in sheets:
@@ -311,21 +360,16 @@ def slice_resample_merge_returns(returns: list, from_date=None, to_date=None, lo
 
     # Go over returns list because merged would have nans
     to_date = min([series.index[-1] for series in returns_copy]) if to_date is None else to_date
-    to_date_idx = get_date_index(date=to_date, dates_values=merged_returns.index)
 
-    if from_date is not None:  # from_date has precedence over lookback if both are not none
-        from_date_idx = get_date_index(date=from_date, dates_values=merged_returns.index)
-    elif lookback is not None:
+    if from_date is None and lookback is not None:  # from_date has precedence over lookback if both are not none
         if isinstance(lookback, int) and frequency is not None:
             period_to_int = {'D': 1, 'W': 7, 'M': 30.5, 'Y': 365.25}
             lookback = timedelta(days=int(period_to_int[frequency] * lookback))
         elif not isinstance(lookback, timedelta):
             raise Exception
-        from_date_idx = get_date_index(date=to_date - lookback, dates_values=merged_returns.index)
-    else:
-        from_date_idx = 0
+        from_date = to_date - lookback
 
-    merged_returns = merged_returns.iloc[from_date_idx:to_date_idx]
+    merged_returns = merged_returns.iloc[date_slice(merged_returns.index, from_date=from_date, to_date=to_date)]
 
     for col in merged_returns.columns:
         merged_returns[col] = merged_returns[col].apply(lambda y: 0 if isinstance(y, np.ndarray) else y)
@@ -374,6 +418,9 @@ def flatten_dict(d, parent_key='', sep='_'):
 
 
 def save_pretty_excel(path, financials_dictio, with_pickle=True):
+    from openpyxl import load_workbook
+    from openpyxl.styles import PatternFill
+
     for sheet_name in [config.income_statement_name, config.cash_flow_statement_name]:
         for sheet_period, sheet_dict in financials_dictio.items():
 
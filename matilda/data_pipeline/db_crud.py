@@ -1,3 +1,4 @@
+import itertools
 import os
 import pickle
 
@@ -7,17 +8,22 @@ from matilda import config
 import pandas as pd
 
 from collections import defaultdict
-from numpy import mean
-from pymongo import MongoClient
+import numpy as np
+from pymongo import MongoClient, ReplaceOne
 from mongoengine import *
+from pymongo.errors import BulkWriteError  # not mongoengine's
 from datetime import datetime, timedelta
 
-from matilda.data_pipeline.data_scapers.company_classification import scrape_company_classification
-from matilda.data_pipeline.data_scapers.financial_statements_scraper.macrotrend_scraper import scrape_macrotrend
-from matilda.data_pipeline.data_scapers.index_exchanges_tickers import save_historical_dow_jones_tickers, \
-    save_historical_sp500_tickers
 from matilda.data_pipeline import object_model, data_preparation_helpers
-from matilda.data_pipeline.data_scapers.stock_prices_scraper import YahooFinance
+from matilda.data_pipeline.classification_table import get_classification_table
+from matilda.data_pipeline.fundamentals_cube import FundamentalsCube, get_fundamentals_cube
+from matilda.data_pipeline.fundamentals_panel import FundamentalsPanel
+from matilda.data_pipeline.index_membership import get_index_membership
+from matilda.data_pipeline.price_store import get_price_store
+from matilda.data_pipeline.read_cache import cached_read, invalidate_cached_reads
+from matilda.data_pipeline.read_graph import active_read_graph
+from matilda.data_pipeline.read_memo import memoized_read
+from matilda.data_pipeline.storage_backend import get_storage_backend
 
 '''
 0. Connect to MongoDB Atlas and Mongo Engine using our URL
@@ -35,36 +41,145 @@ def connect_to_mongo_atlas(atlas_url: str):
 
 
 def connect_to_mongo_engine(atlas_url: str):
+    object_model.cancel_deferred_connection()
     return connect(host=atlas_url)
 
 
+def register_mongo_engine(atlas_url: str):
+    """
+    Same as `connect_to_mongo_engine`, except that the cluster is only reached by the first read or write.
+    """
+    object_model.defer_connection(host=atlas_url)
+
+
+def ensure_indexes():
+    """
+    Create the indexes declared in the `meta` of the documents, upfront rather than on the first use of each
+    collection. Indexes that already exist are left as they are.
+    """
+    for document in [object_model.User, object_model.Company, object_model.Filing, object_model.AssetPrices,
+                     object_model.PriceBucket, object_model.PriceWatermark, object_model.RiskFactorModel,
+                     object_model.Index]:
+        document.ensure_indexes()
+
+
 '''
 I. `Create` Routines for Company Info, Financial Statements, Asset Prices, Risk Factors, Macroeconomic Indicators
 '''
 
 
-def populate_db_company_info(tickers=None):
+def bulk_write(collection, operations: typing.Iterable, batch_size: int = 1000, ordered: bool = False,
+               on_batch: typing.Callable = None, duplicates_ok: bool = False) -> pd.DataFrame:
+    """
+    Send write operations (pymongo's `ReplaceOne`, `UpdateOne`...) in batches, one round trip per batch rather than
+    one per operation.
+
+    :param collection: pymongo collection
+    :param operations: possibly a generator
+    :param batch_size: operations per round trip
+    :param ordered: stop at the first failed write of a batch. By default, the server applies the writes of a batch
+        in any order, and a failed write does not prevent the others.
+    :param on_batch: called after each batch with the positions (in `operations`) of its writes that succeeded, and
+        of those that failed
+    :param duplicates_ok: count the duplicate key errors as successes, for upserts conditional on what they write not
+        being there yet
+    :return: summary of each batch, with columns 'Writes', 'Inserted', 'Matched', 'Failed' and 'Errors'
+    """
+    batch, summaries = [], []
+    written = 0  # operations sent before the current batch
+
+    def write():
+        nonlocal written
+        try:
+            result = collection.bulk_write(batch, ordered=ordered).bulk_api_result
+        except BulkWriteError as error:
+            result = error.details
+        write_errors = [write_error for write_error in result['writeErrors']
+                        if not (duplicates_ok and write_error.get('code') == 11000)]
+        failed = {write_error['index'] for write_error in write_errors}
+        if ordered and len(result['writeErrors']) > 0:  # the writes after the first error were not applied either
+            failed |= set(range(min(write_error['index'] for write_error in result['writeErrors']) + 1, len(batch)))
+        summaries.append({'Writes': len(batch), 'Inserted': result['nUpserted'], 'Matched': result['nMatched'],
+                          'Failed': len(failed), 'Errors': [write_error['errmsg'] for write_error in write_errors]})
+        if on_batch is not None:
+            on_batch([written + i for i in range(len(batch)) if i not in failed],
+                     sorted(written + i for i in failed))
+        written += len(batch)
+        batch.clear()
+
+    for operation in operations:
+        batch.append(operation)
+        if len(batch) == batch_size:
+            write()
+    if len(batch) > 0:
+        write()
+
+    summaries_df = pd.DataFrame(summaries, columns=['Writes', 'Inserted', 'Matched', 'Failed', 'Errors'])
+    summaries_df.index.name = 'Batch'
+    return summaries_df
+
+
+def bulk_upsert(documents: typing.Iterable[Document], keys: typing.List[str], batch_size: int = 1000,
+                ordered: bool = False) -> pd.DataFrame:
+    """
+    Write documents of one collection in batches (see `bulk_write`). A document replaces the one with the same `keys`
+    if any, so that populating again updates the database rather than duplicating it.
+
+    :param documents: mongoengine documents of the same class, possibly a generator
+    :param keys: fields identifying a document, e.g. ['company', 'date', 'period'] for filings
+    :param batch_size: documents per round trip
+    :param ordered:
+    :return: summary of each batch, with columns 'Documents', 'Inserted', 'Replaced', 'Failed' and 'Errors'
+    """
+    documents = iter(documents)
+    first = next(documents, None)
+    if first is None:
+        return bulk_write(collection=None, operations=[]).rename(columns={'Writes': 'Documents',
+                                                                          'Matched': 'Replaced'})
+
+    def replacements():
+        for document in itertools.chain([first], documents):
+            document.validate()
+            son = document.to_mongo()
+            key_fields = [document._fields[key].db_field for key in keys]
+            if '_id' not in key_fields:
+                son.pop('_id', None)
+            yield ReplaceOne({field: son[field] for field in key_fields}, son, upsert=True)
+
+    summaries_df = bulk_write(collection=first._get_collection(), operations=replacements(), batch_size=batch_size,
+                              ordered=ordered)
+    return summaries_df.rename(columns={'Writes': 'Documents', 'Matched': 'Replaced'})
+
+
+def populate_db_company_info(tickers=None, batch_size: int = 1000):
     """
 
     :param tickers: if None, then populate all
-    :return:
+    :param batch_size: companies written per round trip
+    :return: summary of each batch written, see `storage_backend.upsert_summary`
     """
     if not os.path.exists(config.TOTAL_MARKET_PATH):
+        from matilda.data_pipeline.data_scapers.company_classification import scrape_company_classification
+
         scrape_company_classification(tickers=tickers)
 
     with open(config.TOTAL_MARKET_PATH, 'rb') as handle:
         company_classifications = pickle.load(handle)
+    if tickers is not None:
+        company_classifications = company_classifications[company_classifications.index.isin(tickers)]
 
-    for ticker, company in company_classifications.iterrows():
-        if tickers is not None and ticker not in tickers:
-            continue
-        object_model.Company(name=company['Company Name'], ticker=ticker, cik=company['CIK'],
-                             sic_sector=company['SIC Sector'], sic_industry=company['SIC Industry'],
-                             gics_sector=company['GICS Sector'],
-                             location=company['Location'], exchange=company['Exchange']).save()
+    companies = (object_model.Company(name=company['Company Name'], ticker=ticker, cik=company['CIK'],
+                                      sic_sector=company['SIC Sector'], sic_industry=company['SIC Industry'],
+                                      gics_sector=company['GICS Sector'],
+                                      location=company['Location'], exchange=company['Exchange'])
+                 for ticker, company in company_classifications.iterrows())
+    summaries_df = get_storage_backend().write_companies(companies, batch_size=batch_size)
+    get_classification_table(refresh=True)
+    return summaries_df
 
 
-def populate_db_financial_statements(tickers, from_date=None, to_date=None, statements=None, refresh=False):
+def populate_db_financial_statements(tickers, from_date=None, to_date=None, statements=None, refresh=False,
+                                     batch_size: int = 1000):
     """
 
     :param tickers:
@@ -72,13 +187,33 @@ def populate_db_financial_statements(tickers, from_date=None, to_date=None, stat
     :param to_date: by default, all
     :param statements: by default, all
     :param refresh: re-scrape the data
-    :return:
+    :param batch_size: filings written per round trip
+    :return: summary of each batch written, see `storage_backend.upsert_summary`
+    """
+    summaries_df = get_storage_backend().write_filings(filing_documents(tickers), batch_size=batch_size)
+    invalidate_cached_reads(tickers=tickers, collection='Filing')
+
+    cube = get_fundamentals_cube()
+    if cube is not None:
+        if summaries_df['Replaced'].sum() > 0:  # replaced filings keep their ids, so refreshing would miss them
+            FundamentalsCube.build(path=cube.path, version=cube.version)
+        else:  # append the new filings to the cube
+            get_fundamentals_cube(refresh=True)
+    return summaries_df
+
+
+def filing_documents(tickers):
+    """
+    `Filing` documents of the scraped financial statements of `tickers`, one ticker at a time.
     """
     for ticker in tickers:
 
         path = '{}/{}.pkl'.format(config.FINANCIAL_STATEMENTS_DIR_PATH_PICKLE_UNFLATTENED, ticker)
 
         if not os.path.exists(path):
+            from matilda.data_pipeline.data_scapers.financial_statements_scraper.macrotrend_scraper import \
+                scrape_macrotrend
+
             scrape_macrotrend(tickers=[ticker])
 
         with open(path, 'rb') as handle:
@@ -109,11 +244,10 @@ def populate_db_financial_statements(tickers, from_date=None, to_date=None, stat
                             for kkkk, vvvv in vvv.items()} for kkk, vvv in vv.items()}
                           for kk, vv in v.items()} for k, v in unflattened.items()}
 
-                filing = object_model.Filing(company=ticker, date=date_formatted, period=filing_period,
-                                             BalanceSheet=statement_dictio['Balance Sheet'],
-                                             IncomeStatement=statement_dictio['Income Statement'],
-                                             CashFlowStatement=statement_dictio['Cash Flow Statement'])
-                filing.save()
+                yield object_model.Filing(company=ticker, date=date_formatted, period=filing_period,
+                                          BalanceSheet=statement_dictio['Balance Sheet'],
+                                          IncomeStatement=statement_dictio['Income Statement'],
+                                          CashFlowStatement=statement_dictio['Cash Flow Statement'])
 
 
 def db_time_series_helper(df, from_date=None, to_date=None):
@@ -125,50 +259,176 @@ def db_time_series_helper(df, from_date=None, to_date=None):
     :return:
     """
 
-    from_ = 0 if from_date is None else data_preparation_helpers.get_date_index(date=from_date,
-                                                                                dates_values=df.index)
-
-    to_ = -1 if to_date is None else data_preparation_helpers.get_date_index(date=to_date, dates_values=df.index)
-    df = df.iloc[from_:to_, ]
+    df = df.iloc[data_preparation_helpers.date_slice(df.index, from_date=from_date, to_date=to_date)]
     df_conv = {key: [{'date': date, 'price': price} for date, price in zip(df.index, df[key])]
                for key in df.columns}
     return df_conv
 
 
-def populate_db_asset_prices(tickers: typing.List = None, from_date: datetime = None, to_date: datetime = None):
-    if tickers is None:  # takes all stocks currently in stock prices directory
-        tickers = next(os.walk(config.STOCK_PRICES_DIR_PATH))[2]
-        tickers = [ticker.strip('.pkl') for ticker in tickers]
+PRICE_BUCKET_FIELDS = {'Open': 'open', 'High': 'high', 'Low': 'low', 'Close': 'close', 'Adj Close': 'adj_close',
+                       'Volume': 'volume'}
+
+
+def price_buckets(data: pd.DataFrame):
+    """
+    Split bars into calendar months.
+
+    :param data: bars, one column per field as in the stock prices pickles
+    :return: iterator of (first day of the month, arrays of the `PriceBucket` of the month)
+    """
+    data = data.sort_index()
+    months = data.index.to_period('M').to_timestamp()
+    for month, bars in data.groupby(months):
+        arrays = {'dates': bars.index.to_pydatetime().tolist()}
+        for column, field in PRICE_BUCKET_FIELDS.items():
+            if column in bars.columns:
+                arrays[field] = bars[column].astype(float).tolist()
+        yield month.to_pydatetime(), arrays
+
+
+def populate_db_asset_prices(tickers: typing.List = None, from_date: datetime = None, to_date: datetime = None,
+                             batch_size: int = 500):
+    """
+    Write the price histories, as one `PriceBucket` per ticker and month.
+
+    :param tickers: by default, all the stocks of the price store, or else of the stock prices directory
+    :param from_date: widened to the first day of its month, as buckets replace whole months
+    :param to_date: widened to the last day of its month
+    :param batch_size: buckets written per round trip
+    :return: summary of each batch written, see `storage_backend.upsert_summary`
+    """
+    # a bucket written from the bars of part of a month would delete the other bars of that month
+    if from_date is not None:
+        from_date = pd.Timestamp(from_date).to_period('M').to_timestamp().to_pydatetime()
+    if to_date is not None:
+        next_month = (pd.Timestamp(to_date).to_period('M') + 1).to_timestamp()
+        to_date = (next_month - timedelta(microseconds=1)).to_pydatetime()
+    price_store = get_price_store()
+    if tickers is None:  # takes all stocks currently in the price store, or else in stock prices directory
+        if price_store is not None:
+            tickers = price_store.tickers.to_list()
+        else:
+            tickers = next(os.walk(config.STOCK_PRICES_DIR_PATH))[2]
+            tickers = [os.path.splitext(ticker)[0] for ticker in tickers]
 
     if not isinstance(tickers, list):
         tickers = [tickers]
 
-    for ticker in tickers:
-        path = f'{config.STOCK_PRICES_DIR_PATH}/{ticker}.pkl'
-        if not os.path.exists(path):
-            data = YahooFinance(ticker=ticker, from_date=from_date, to_date=to_date).convert_format('pandas')
+    def buckets():
+        for ticker in tickers:
+            data = source_asset_prices(ticker=ticker, price_store=price_store, from_date=from_date, to_date=to_date)
+            if from_date is not None:
+                data = data[data.index >= from_date]
+            if to_date is not None:
+                data = data[data.index <= to_date]
+            for month, arrays in price_buckets(data):
+                yield object_model.PriceBucket(ticker=ticker, month=month, last_date=arrays['dates'][-1], **arrays)
+
+    summaries_df = get_storage_backend().write_price_buckets(buckets(), batch_size=batch_size)
+    invalidate_cached_reads(tickers=tickers, collection='PriceBucket')
+    return summaries_df
+
+
+def source_asset_prices(ticker: str, price_store=None, from_date: datetime = None, to_date: datetime = None):
+    """
+    Bars of `ticker` from the price store, or else its stock prices pickle, or else Yahoo Finance.
+    """
+    path = f'{config.STOCK_PRICES_DIR_PATH}/{ticker}.pkl'
+    if price_store is not None and ticker in price_store:
+        return price_store.read_ticker(ticker)
+    if not os.path.exists(path):
+        from matilda.data_pipeline.data_scapers.stock_prices_scraper import YahooFinance
+
+        return YahooFinance(ticker=ticker, from_date=from_date, to_date=to_date).convert_format('pandas')
+    with open(path, 'rb') as handle:
+        return pickle.load(handle)
+
+
+def last_stored_bars(tickers: typing.List[str]) -> typing.Dict[str, datetime]:
+    """
+    Date of the last bar stored of each ticker. Tickers with no prices stored are left out.
+    """
+    return get_storage_backend().last_stored_bars(tickers)
+
+
+def update_db_asset_prices(tickers: typing.List = None, to_date: datetime = None, batch_size: int = 500):
+    """
+    Append to the database the bars newer than the last one stored, instead of rewriting whole price histories.
+    Tickers with no prices stored yet get their whole history. Appends are idempotent, so an interrupted update
+    resumes where it stopped when run again (see `StorageBackend.append_price_bars`).
+
+    :param tickers: by default, all the stocks of the price store, or else of the stock prices directory
+    :param to_date: by default, up to the last bar available
+    :param batch_size: buckets written per round trip
+    :return: summary of each batch written, see `StorageBackend.append_price_bars`
+    """
+    price_store = get_price_store()
+    if tickers is None:
+        if price_store is not None:
+            tickers = price_store.tickers.to_list()
         else:
-            with open(path, 'rb') as handle:
-                data = pickle.load(handle)
+            tickers = [os.path.splitext(ticker)[0] for ticker in next(os.walk(config.STOCK_PRICES_DIR_PATH))[2]]
+    if not isinstance(tickers, list):
+        tickers = [tickers]
+
+    last_dates = last_stored_bars(tickers)
+
+    def bars():
+        for ticker in tickers:
+            last_date = last_dates.get(ticker)
+            data = source_asset_prices(ticker=ticker, price_store=price_store, from_date=last_date, to_date=to_date)
+            if last_date is not None:
+                data = data[data.index > last_date]
+            if to_date is not None:
+                data = data[data.index <= to_date]
+            for month, arrays in price_buckets(data):
+                yield ticker, month, arrays
+
+    try:
+        return get_storage_backend().append_price_bars(bars(), batch_size=batch_size)
+    finally:  # also the bars written before an interruption
+        invalidate_cached_reads(tickers=tickers, collection='PriceBucket')
 
-        df_conv = db_time_series_helper(df=data, from_date=from_date, to_date=to_date)
 
-        object_model.AssetPrices(company=ticker, open=df_conv['Open'], high=df_conv['High'], low=df_conv['Low'],
-                                 close=df_conv['Close'], volume=df_conv['Volume']).save()
+def migrate_asset_prices(batch_size: int = 500):
+    """
+    Copy the price histories of the former `AssetPrices` layout (one document per ticker, with every bar embedded)
+    to price buckets.
+    """
+    tickers = []
+
+    def buckets():
+        for document in object_model.AssetPrices.objects.as_pymongo():
+            tickers.append(document['company'])
+            data = pd.concat({column: pd.Series([bar['price'] for bar in document.get(field, [])],
+                                                index=[bar['date'] for bar in document.get(field, [])], dtype=float)
+                              for column, field in PRICE_BUCKET_FIELDS.items() if len(document.get(field, [])) > 0},
+                             axis=1)
+            for month, arrays in price_buckets(data):
+                yield object_model.PriceBucket(ticker=document['company'], month=month,
+                                               last_date=arrays['dates'][-1], **arrays)
 
+    summaries_df = get_storage_backend().write_price_buckets(buckets(), batch_size=batch_size)
+    invalidate_cached_reads(tickers=tickers, collection='PriceBucket')
+    return summaries_df
 
-def populate_db_risk_factors(from_date=None, to_date=None):
+
+def populate_db_risk_factors(from_date=None, to_date=None, batch_size: int = 50):
     dir_path = f'{config.FACTORS_DIR_PATH}/pickle/'
     scrape_Fama_French_factors()
     scrape_AQR_factors()
-    for factor_model in os.listdir(path=dir_path):
-        path = f'{dir_path}/{factor_model}'
-        with open(path, 'rb') as handle:
-            df = pickle.load(handle)
-        df_conv = db_time_series_helper(df=df, from_date=from_date, to_date=to_date)
 
-        risk_factors = [object_model.RiskFactor(name=key, series=df_conv[key]) for key, value in df_conv.items()]
-        object_model.RiskFactorModel(name=factor_model.replace('.pkl', ''), risk_factors=risk_factors).save()
+    def risk_factor_models():
+        for factor_model in os.listdir(path=dir_path):
+            path = f'{dir_path}/{factor_model}'
+            with open(path, 'rb') as handle:
+                df = pickle.load(handle)
+            df_conv = db_time_series_helper(df=df, from_date=from_date, to_date=to_date)
+
+            risk_factors = [object_model.RiskFactor(name=key, series=df_conv[key]) for key, value in df_conv.items()]
+            yield object_model.RiskFactorModel(name=factor_model.replace('.pkl', ''), risk_factors=risk_factors)
+
+    return get_storage_backend().write_risk_factor_models(risk_factor_models(), batch_size=batch_size)
 
 
 def populate_db_routine(db_name,
@@ -181,6 +441,7 @@ def populate_db_routine(db_name,
     if reset_db:
         db.drop_database('matilda-db')
         connect_to_mongo_engine(atlas_url)
+    ensure_indexes()
     if populate_company_info:
         populate_db_company_info(tickers)
     if populate_financial_statements:
@@ -192,6 +453,9 @@ def populate_db_routine(db_name,
 
 
 def populate_indices(from_file=False):
+    from matilda.data_pipeline.data_scapers.index_exchanges_tickers import save_historical_dow_jones_tickers, \
+        save_historical_sp500_tickers
+
     for (name, path, fun) in [('Dow Jones', 'Dow-Jones-Historical-Constituents', save_historical_dow_jones_tickers),
                               ('S&P 500', 'S&P-500-Historical-Constituents', save_historical_sp500_tickers)]:
         if from_file:
@@ -202,7 +466,8 @@ def populate_indices(from_file=False):
             dictio = fun(save_pickle=False)
 
         output = [{'date': date, 'companies': companies} for date, companies in dictio.items()]
-        object_model.Index(name=name, evolution=output).save()
+        get_storage_backend().write_indices([object_model.Index(name=name, evolution=output)])
+        get_index_membership(name, refresh=True)
 
 
 '''
@@ -226,15 +491,15 @@ def format_output(output: dict):
     if len(output) == 1:
         if len(output.columns) > 1:  # one date, many stocks
             return output.iloc[0, :]
-        return float(output.values[0])  # one date, one stock
+        return float(output.values[0, 0])  # one date, one stock
     if len(output.columns) == 1:
         return output.iloc[:, 0]  # many dates, one stock
     return output  # many dates, many stocks
 
 
+@memoized_read
 def read_financial_statement_entry(stock, financial_statement: str, entry_name: list, period: str,
                                    date=None, lookback_period: timedelta = timedelta(days=0)):
-    # TODO also try multiple entries (allow entry_name to be list of list)
     """
     Read an entry from a financial statement. By default, we read the most recent position for the balance sheet,
     and the trailing twelve months for the income statement and cash flow statement.
@@ -245,96 +510,292 @@ def read_financial_statement_entry(stock, financial_statement: str, entry_name:
     :param date:
     :param lookback_period:
     :param period: 'FY' for fiscal year, 'Q' for quarter, 'YTD' for calendar year to date, 'TTM' for trailing twelve months
-    :return:
+    :return: float, pd.Series or pd.DataFrame depending on the number of stocks and dates, or a (dates, tickers) array
+        if `stock` is a `FundamentalsPanel` (its dates are then used)
 
     """
-
+    if isinstance(stock, FundamentalsPanel):
+        return stock.entry(financial_statement=financial_statement, entry_name=entry_name, period=period,
+                           lookback_period=lookback_period)
+    graph = active_read_graph()
+    if graph is not None and isinstance(stock, str) and (date is None or isinstance(date, datetime)):
+        return graph.read(stock=stock, financial_statement=financial_statement, entry_name=entry_name, period=period,
+                          date=date, lookback_period=lookback_period)
     stock, date = format_input(stock, date)
-    filings = object_model.Filing.objects(company__in=object_model.Company.objects(ticker__in=stock),
-                                          # date__gte=date[0] - lookback_period - timedelta(days=100) if period == 'Q'
-                                          # else date[0] - lookback_period - timedelta(days=400),
-                                          # date__lte=date[-1] - lookback_period,
-                                          period='Yearly' if period == 'FY' else 'Quarterly')
-
-    # TODO Try aggregation https://stackoverflow.com/questions/25151042/moving-averages-with-mongodbs-aggregation-framework
-
-    # .as_pymongo()  # .only(financial_statement).as_pymongo()[financial_statement]
-    #     pipeline = [{'$sort': {'date': 1}},
-    #                 {'$group': {
-    #                     '_id': '$company',
-    #                     'date': {'$last': '$date'},
-    #                 }}]
-    # agg = filings.aggregate(*pipeline)
-    # for a in agg:
-    #     print(a)
-
+    entries_df = read_financial_statement_entries(stocks=stock, entries=[(financial_statement, entry_name, period)],
+                                                  dates=date, lookback_period=lookback_period)
     output = defaultdict(dict)
-    for stock_ in stock:
-        filings_for_stock = filings.filter(company=stock_).order_by('date').as_pymongo()
-        for date_ in date:
+    for date_, stock_, value in zip(entries_df['Date'], entries_df['Ticker'], entries_df['Value']):
+        output[date_][stock_] = value
+    return format_output(dict(output))
+
+
+def entry_path(financial_statement: str, entry_name: list) -> str:
+    """
+    >>> entry_path('BalanceSheet', ['Assets', 'CurrentAssets', 'TotalCurrentAssets'])
+    'BalanceSheet.Assets.CurrentAssets.TotalCurrentAssets'
+    """
+    return '.'.join([financial_statement] + list(entry_name))
 
-            # get the closest filing from this date for this stock's filings
-            for idx, filing in enumerate(filings_for_stock):
 
-                # if date is instance of tuple, then it's a range and we need to consider all filings queried.
-                if isinstance(date, list) and \
-                        idx + 1 < len(filings_for_stock) and \
-                        filings_for_stock[idx + 1]['date'] < date_ - lookback_period:
-                    continue
+@memoized_read
+@cached_read(collection='Filing', tickers='stocks')
+def read_filings(stocks: typing.List[str], entry_paths: typing.List[str], period_type: str,
+                 after_id=None):
+    """
+    Read entries of all the filings of `stocks` in one aggregation, projected on the entries only.
+
+    :param stocks: tickers, None for all
+    :param entry_paths: dotted paths of the entries, e.g. 'BalanceSheet.Assets.CurrentAssets.TotalCurrentAssets'
+    :param period_type: 'Yearly' or 'Quarterly'
+    :param after_id: only read the filings inserted after the filing with this id
+    :return: tuple of
+        * {ticker: (sorted datetime64 array of filing dates, 2D array of filings by entries)}. Missing entries are NaN.
+        * the id of the last inserted filing read, None if there was none
+    """
+    return get_storage_backend().read_filings(stocks=stocks, entry_paths=entry_paths, period_type=period_type,
+                                              after_id=after_id)
 
-                def get_entry(filing_):  # now can get corresponding entry
-                    entry = filing_[financial_statement]
-                    for e in entry_name:
-                        entry = entry[e]
-                    return entry
 
-                if period in ['Q', 'FY']:
-                    output[date_][stock_] = get_entry(filing_=filing)
+def filings_pipeline(stocks: typing.List[str], entry_paths: typing.List[str], period_type: str,
+                     after_id=None) -> typing.List[typing.Dict]:
+    """
+    Aggregation of `read_filings`. The sort comes right after the match, so that both are served by the
+    (period, company, date) index of `Filing`.
+    """
+    match = {'period': period_type}
+    if stocks is not None:
+        match['company'] = {'$in': list(stocks)}
+    if after_id is not None:
+        match['_id'] = {'$gt': after_id}
+    projection = {'company': 1, 'date': 1}
+    projection.update({'entry_{}'.format(i): '${}'.format(path) for i, path in enumerate(entry_paths)})
+    return [{'$match': match}, {'$sort': {'company': 1, 'date': 1}}, {'$project': projection}]
+
+
+@memoized_read
+@cached_read(collection='Filing', tickers='stocks')
+def read_rolled_filings(stocks: typing.List[str], entry_paths: typing.List[str]):
+    """
+    `read_filings` of the quarterly filings, along with the trailing sums of their entries computed in the database
+    (see `rolled_filings_pipeline`), so that TTM and YTD values of a whole universe come back in one aggregation.
+
+    :param stocks: tickers, None for all
+    :param entry_paths: dotted paths of the entries
+    :return: {ticker: (sorted datetime64 array of filing dates, 2D array of filings by entries,
+        {'TTM': (sums, counts), 'YTD': (sums, counts)})}, as `rolled_filing_values` computes them
+    """
+    return get_storage_backend().read_rolled_filings(stocks=stocks, entry_paths=entry_paths)
 
-                elif period in ['TTM', 'YTD']:
-                    entries = []
-                    for i in range(min(4, len(filings_for_stock))):
-                        filing = filings_for_stock[idx - i]
-                        if period == 'YTD' and filing['date'] < datetime(date_.year, 1, 1):
-                            break
-                        entries.append(get_entry(filing_=filing))
 
-                    if financial_statement == 'BalanceSheet':  # do average since it's a statement of position
-                        output[date_][stock_] = sum(entries)
+def rolled_filings_pipeline(stocks: typing.List[str], entry_paths: typing.List[str]) -> typing.List[typing.Dict]:
+    """
+    Aggregation of `read_rolled_filings`: the quarterly filings of `filings_pipeline`, with trailing windows per
+    company over the (up to) 4 last filings for TTM, and over those of the same calendar year for YTD. For each
+    entry, the window sums it and counts the filings missing it; each window also counts its filings.
+    """
+    window = {'documents': [-3, 0]}
 
-                    elif financial_statement in ['IncomeStatement', 'CashFlowStatement']:
-                        output[date_][stock_] = mean(entries)
+    def rollups(prefix):
+        output = {'{}_count'.format(prefix): {'$sum': 1, 'window': window}}
+        for i in range(len(entry_paths)):
+            output['{}_{}'.format(prefix, i)] = {'$sum': '$entry_{}'.format(i), 'window': window}
+            output['{}_missing_{}'.format(prefix, i)] = {
+                '$sum': {'$cond': [{'$isNumber': '$entry_{}'.format(i)}, 0, 1]}, 'window': window}
+        return output
 
-                    else:
-                        raise Exception('Please enter a valid `financial_statement`')
+    return filings_pipeline(stocks=stocks, entry_paths=entry_paths, period_type='Quarterly') + [
+        {'$setWindowFields': {'partitionBy': '$company', 'sortBy': {'date': 1}, 'output': rollups('ttm')}},
+        {'$setWindowFields': {'partitionBy': {'company': '$company', 'year': {'$year': '$date'}},
+                              'sortBy': {'date': 1}, 'output': rollups('ytd')}}]
 
-                else:
-                    raise Exception('Please enter a valid `period`')
 
-                break
+def as_of_filing_values(filing_dates: np.ndarray, filing_values: np.ndarray, dates: np.ndarray, period: str,
+                        financial_statement: str, years: np.ndarray = None) -> np.ndarray:
+    """
+    Value of an entry as of each of `dates`, from the filings strictly before that date.
+
+    :param filing_dates: sorted datetime64 array
+    :param filing_values: entry of each filing
+    :param dates: datetime64 array of the dates to read at (lookback period already subtracted)
+    :param period: 'FY', 'Q', 'YTD' or 'TTM'
+    :param financial_statement: TTM and YTD add up the filings of the balance sheet, and average the others
+    :param years: calendar year of each date, for YTD. By default, the year of `dates`.
+    :return: array aligned on `dates`, NaN where no filing precedes the date
+    """
+    if period in ['Q', 'FY']:
+        if len(filing_dates) == 0:
+            return np.full(len(dates), np.nan)
+        last = np.searchsorted(filing_dates, dates, side='left') - 1  # last filing strictly before each date
+        return np.where(last >= 0, filing_values[np.maximum(last, 0)], np.nan)
+    if period not in ['TTM', 'YTD']:
+        raise Exception('Please enter a valid `period`')
+    rollups = rolled_filing_values(filing_dates=filing_dates, filing_values=filing_values[:, np.newaxis])
+    sums, counts = rollups[period]
+    return as_of_rolled_values(filing_dates=filing_dates, sums=sums[:, 0], counts=counts, dates=dates, period=period,
+                               financial_statement=financial_statement, years=years)
+
+
+def rolled_filing_values(filing_dates: np.ndarray, filing_values: np.ndarray) -> typing.Dict[str, typing.Tuple]:
+    """
+    Trailing sums of the entries at each filing, the same as `rolled_filings_pipeline` computes in the database: over
+    the (up to) 4 last filings for TTM, and those of them in the calendar year of the filing for YTD.
 
-    return format_output(dict(output))
+    :param filing_dates: sorted datetime64 array
+    :param filing_values: 2D array of filings by entries
+    :return: {'TTM': (sums, counts), 'YTD': (sums, counts)}, with a sum per filing and entry (NaN if an entry is
+        missing from a filing of the window), and the number of filings in the window of each filing
+    """
+    window = np.arange(len(filing_dates))[:, np.newaxis] - np.arange(4)[np.newaxis, :]
+    in_window = window >= 0
+    years = pd.DatetimeIndex(filing_dates).year.to_numpy()
+    rollups = {}
+    for period, in_period in [('TTM', in_window), ('YTD', in_window & (years[np.maximum(window, 0)]
+                                                                      == years[:, np.newaxis]))]:
+        sums = np.where(in_period[:, :, np.newaxis], filing_values[np.maximum(window, 0)], 0).sum(axis=1)
+        rollups[period] = (sums, in_period.sum(axis=1))
+    return rollups
+
+
+def as_of_rolled_values(filing_dates: np.ndarray, sums: np.ndarray, counts: np.ndarray, dates: np.ndarray,
+                        period: str, financial_statement: str, years: np.ndarray = None) -> np.ndarray:
+    """
+    TTM or YTD value of an entry as of each of `dates`, from the trailing sums at the last filing strictly before that
+    date (see `rolled_filing_values`).
+
+    :param sums: sum of the entry at each filing, for `period`
+    :param counts: number of filings summed at each filing, for `period`
+    :param financial_statement: TTM and YTD add up the filings of the balance sheet, and average the others
+    :param years: calendar year of each date, for YTD. By default, the year of `dates`.
+    :return: array aligned on `dates`, NaN where no filing precedes the date
+    """
+    if financial_statement not in ['BalanceSheet', 'IncomeStatement', 'CashFlowStatement']:
+        raise Exception('Please enter a valid `financial_statement`')
+    if len(filing_dates) == 0:
+        return np.full(len(dates), np.nan)
+    last = np.searchsorted(filing_dates, dates, side='left') - 1
+    totals, in_window = sums[np.maximum(last, 0)], counts[np.maximum(last, 0)]
+    if period == 'YTD':
+        # no filing yet in the year of the date
+        years = pd.DatetimeIndex(dates).year if years is None else years
+        same_year = pd.DatetimeIndex(filing_dates[np.maximum(last, 0)]).year.to_numpy() == np.asarray(years)
+        totals, in_window = np.where(same_year, totals, 0), np.where(same_year, in_window, 0)
+    if financial_statement != 'BalanceSheet':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            totals = totals / in_window
+    return np.where(last >= 0, totals, np.nan)
+
+
+@memoized_read
+def read_financial_statement_entries(stocks, entries: typing.List[typing.Tuple[str, typing.List[str], str]],
+                                     dates=None, lookback_period: timedelta = timedelta(days=0)) -> pd.DataFrame:
+    """
+    Batched `read_financial_statement_entry`: many stocks, many entries and many dates, in one query per period type
+    (yearly and quarterly filings) rather than one per stock, projected on the union of the entries. TTM and YTD sums
+    are computed by that query. Entries that are line items of the fundamentals cube are read from it, without
+    querying the database, for the tickers it holds, and their TTM and YTD sums are computed locally.
+
+    >>> read_financial_statement_entries(stocks=['AAPL', 'MSFT'], dates=[datetime(2019, 1, 1), datetime(2020, 1, 1)],
+    ...                                  entries=[('BalanceSheet', ['Assets', 'TotalAssets'], 'Q'),
+    ...                                           ('IncomeStatement', ['Revenues', 'NetSales'], 'TTM')])
+
+    :param stocks: ticker or list of tickers
+    :param entries: list of (financial_statement, entry_name, period), as in `read_financial_statement_entry`
+    :param dates: date or list of dates, by default now
+    :param lookback_period:
+    :return: tidy dataframe with columns 'Date', 'Ticker', 'Entry' (dotted path of the entry), 'Period' and 'Value'
+    """
+    stocks, dates = format_input(stocks, dates)
+    targets = pd.DatetimeIndex(dates)
+    as_of = (targets - lookback_period).to_numpy()
+
+    cube = get_fundamentals_cube()
+    rows = []
+    for period_type in ['Yearly', 'Quarterly']:
+        period_entries = [(financial_statement, entry_name, period)
+                          for financial_statement, entry_name, period in entries
+                          if (period == 'FY') == (period_type == 'Yearly')]
+        if len(period_entries) == 0:
+            continue
+        paths = [entry_path(financial_statement, entry_name) for financial_statement, entry_name, _ in period_entries]
+        # the union of the paths, projected once each (e.g. net sales read both quarterly and TTM), in an order that
+        # does not depend on the callers', so that the same union is memoized and cached under the same key
+        union = sorted(set(paths))
+        columns = [union.index(path) for path in paths]
+        rolling = any(period in ['TTM', 'YTD'] for _, _, period in period_entries)
+        if cube is not None and cube.covers(union):
+            filings = cube.filings(stocks=stocks, entry_paths=union, period_type=period_type)
+            uncached = [stock for stock in stocks if stock not in cube]
+        else:
+            filings, uncached = {}, stocks
+        rollups = {}  # TTM and YTD sums, from the database, or else computed below
+        if len(uncached) > 0 and rolling:
+            for stock, (filing_dates, filing_values, stock_rollups) in read_rolled_filings(
+                    stocks=uncached, entry_paths=union).items():
+                filings[stock], rollups[stock] = (filing_dates, filing_values), stock_rollups
+        elif len(uncached) > 0:
+            filings.update(read_filings(stocks=uncached, entry_paths=union, period_type=period_type)[0])
+        for stock in stocks:
+            filing_dates, filing_values = filings.get(stock, (np.array([], dtype='datetime64[ns]'),
+                                                              np.empty((0, len(union)))))
+            if rolling and stock not in rollups:
+                rollups[stock] = rolled_filing_values(filing_dates=filing_dates, filing_values=filing_values)
+            for i, (financial_statement, entry_name, period) in enumerate(period_entries):
+                if period in ['TTM', 'YTD']:
+                    sums, counts = rollups[stock][period]
+                    values = as_of_rolled_values(filing_dates=filing_dates, sums=sums[:, columns[i]], counts=counts,
+                                                 dates=as_of, period=period, financial_statement=financial_statement,
+                                                 years=targets.year)
+                else:
+                    values = as_of_filing_values(filing_dates=filing_dates, filing_values=filing_values[:, columns[i]],
+                                                 dates=as_of, period=period, financial_statement=financial_statement)
+                rows.extend(zip(dates, [stock] * len(dates), [paths[i]] * len(dates), [period] * len(dates), values))
 
+    return pd.DataFrame(rows, columns=['Date', 'Ticker', 'Entry', 'Period', 'Value'])
 
+
+@memoized_read
+@cached_read(collection='PriceBucket', tickers='stock')
 def read_prices_series(stock, from_date=None, to_date=datetime.now(),
                        lookback_period=timedelta(days=5 * 365), spec='close'):
+    """
+    Prices of a stock between two dates. Only the buckets of the months in range are read, and only their `spec`
+    field.
+
+    :param stock:
+    :param from_date: by default, `lookback_period` before `to_date`
+    :param to_date:
+    :param lookback_period:
+    :param spec: 'open', 'high', 'low', 'close', 'adj_close', 'volume'
+    :return: pd.Series indexed by date
+    """
     if from_date is None:
         from_date = to_date - lookback_period
 
     if not isinstance(stock, list):
         stock = [stock]
 
-    objects = object_model.AssetPrices.objects.get(company__in=object_model.Company.objects(ticker__in=stock),
-                                                   close__date__lte=to_date, close__date__gte=from_date)
-    dictios = objects.to_mongo().to_dict()[spec]
-    dates, prices = [dictio['date'] for dictio in dictios], [dictio['price'] for dictio in dictios]
-    series = pd.Series(data=prices, index=dates, name=stock[0])  # TODO quick fix
+    dates, prices = get_storage_backend().read_prices(stock=stock[0], from_date=from_date, to_date=to_date, spec=spec)
+    series = pd.Series(data=prices, index=pd.DatetimeIndex(dates), name=stock[0], dtype=float)  # TODO quick fix
 
-    return series
+    return series[(series.index >= from_date) & (series.index <= to_date)]
 
 
+def prices_series_query(stock: str, from_date: datetime, to_date: datetime, spec: str = 'close'):
+    """
+    Buckets of `read_prices_series`, served by the (ticker, month) index of `PriceBucket`.
+    """
+    first_month = datetime(from_date.year, from_date.month, 1)
+    return object_model.PriceBucket.objects(ticker=stock, month__gte=first_month, month__lte=to_date) \
+        .only('dates', spec).order_by('month').as_pymongo()
+
+
+@memoized_read
+@cached_read(collection='PriceBucket', tickers='stock')
 def read_market_price(stock, date=None, lookback_period=timedelta(days=0), spec='close'):
     """
+    Price of the last bar at or before `date - lookback_period`. For each date, the last bucket of each stock up to
+    that date is found through the (ticker, month) index, in one query for all the stocks.
 
     :param stock:
     :param date:
@@ -342,85 +803,85 @@ def read_market_price(stock, date=None, lookback_period=timedelta(days=0), spec=
     :param spec: 'open', 'high', 'low', 'close', 'adj_close'
     :return:
     """
+    if isinstance(stock, FundamentalsPanel):
+        return stock.market_price(lookback_period=lookback_period)
     stock, date = format_input(stock, date)
 
-    objects = object_model.AssetPrices.objects(company__in=object_model.Company.objects(ticker__in=stock),
-                                               close__date__lte=date[0])  # TODO read date list
     output = defaultdict(dict)
-    for obj in objects:
-        output[date[0]][obj.company.name] = obj.close[-1].price
+    for date_ in date:
+        output[date_].update(get_storage_backend().read_market_prices(stocks=stock, as_of=date_ - lookback_period,
+                                                                      spec=spec))
     return format_output(dict(output))
-    # output = objects.filter(date__lte=date)
 
-    # pipeline = [ {"$group": {'_id': {"date"}}}
-    #     {"date": {"$company": {"$toUpper": "$name"}}}
-    # ]
-    # data = objects.aggregate(pipeline)
 
-    # return output
+def market_price_pipeline(stocks: typing.List[str], as_of: datetime, spec: str = 'close') -> typing.List[typing.Dict]:
+    """
+    Aggregation of `read_market_price`: the last bucket of each stock starting at or before `as_of`, walking the
+    (ticker, month) index backwards.
+    """
+    return [{'$match': {'ticker': {'$in': list(stocks)}, 'month': {'$lte': as_of}, 'dates.0': {'$lte': as_of}}},
+            {'$sort': {'ticker': -1, 'month': -1}},
+            {'$group': {'_id': '$ticker', 'dates': {'$first': '$dates'}, 'prices': {'$first': '$' + spec}}}]
 
 
 def get_company_classification(stock):
-    return object_model.Company.objects.get(ticker=stock).to_mongo().to_dict()
+    table = get_classification_table()
+    if stock in table:
+        return table.classification(stock)
+    return get_storage_backend().read_company(stock)  # stored since the table was read
+
+
+def company_classification_value(stock, field: str):
+    """
+    :param field: one of `classification_table.CLASSIFICATION_FIELDS`, e.g. 'gics_sector'
+    """
+    table = get_classification_table()
+    if stock in table:
+        return table.value(stock, field)
+    return get_storage_backend().read_company(stock).get(field)
 
 
 def company_industry(stock, classification: str):
     if classification not in ['SIC', 'GICS']:
         raise Exception
 
-    return object_model.Company.objects(ticker=stock).values_list('sic_industry' if classification == 'SIC'
-                                                                  else 'gics_industry')[0]
+    return company_classification_value(stock, 'sic_industry' if classification == 'SIC' else 'gics_industry')
 
 
 def company_sector(stock, classification: str):
-    return object_model.Company.objects(ticker=stock).values_list('sic_sector' if classification == 'SIC'
-                                                                  else 'gics_sector')[0]
+    return company_classification_value(stock, 'sic_sector' if classification == 'SIC' else 'gics_sector')
 
 
 def company_location(stock):
-    return object_model.Company.objects(ticker=stock).values_list('location')[0]
+    return company_classification_value(stock, 'location')
 
 
+@memoized_read
 def company_indices(stock, date):
-    # TODO
-    for index in object_model.Index.objects:
-        if index.evolution:
-            pass
-    return ()
+    return tuple(index for index in config.MarketIndices if get_index_membership(index.value).is_member(stock, date))
 
 
+@memoized_read
 def companies_in_classification(class_, date=datetime.now()):
-    if isinstance(class_, config.SIC_Industries):
-        companies = object_model.Company.objects(sic_industry=class_.value)
-    elif isinstance(class_, config.GICS_Industries):
-        companies = object_model.Company.objects(gics_industry=class_.value)
-    elif isinstance(class_, config.SIC_Sectors):
-        companies = object_model.Company.objects(sic_sector=class_.value)
-    elif isinstance(class_, config.GICS_Sectors):
-        companies = object_model.Company.objects(gics_sector=class_.value)
-    elif isinstance(class_, config.Regions):
-        companies = object_model.Company.objects(location=class_.value)
-    elif isinstance(class_, config.Exchanges):
-        companies = object_model.Company.objects(exchange=class_.value)
-    elif isinstance(class_, config.MarketIndices):  # TODO do better query
-        query = object_model.Index.objects(name=class_.value).first().to_mongo()
-        for item in query['evolution']:
-            if item['date'] > date:
-                continue
-            return item['companies']
-        return []
-    else:
-        raise Exception('Ensure arg for classification is an instance of config.SIC_Industries, '
-                        'config.GICS_Industries, config.SIC_Sectors, config.GICS_Sectors,'
-                        'config.Regions, config.Exchanges, or config.MarketIndices')
-
-    return [company.ticker for company in companies]
-
-
+    fields = [(config.SIC_Industries, 'sic_industry'), (config.GICS_Industries, 'gics_industry'),
+              (config.SIC_Sectors, 'sic_sector'), (config.GICS_Sectors, 'gics_sector'), (config.Regions, 'location'),
+              (config.Exchanges, 'exchange')]
+    for classification, field in fields:
+        if isinstance(class_, classification):
+            return get_classification_table().tickers_where(field=field, value=class_.value)
+    if isinstance(class_, config.MarketIndices):
+        return get_index_membership(class_.value).constituents(date)
+    raise Exception('Ensure arg for classification is an instance of config.SIC_Industries, '
+                    'config.GICS_Industries, config.SIC_Sectors, config.GICS_Sectors,'
+                    'config.Regions, config.Exchanges, or config.MarketIndices')
+
+
+@memoized_read
 def read_factor_returns(factor_model, factor, from_date, to_date, frequency):
     pass
 
 
+@memoized_read
 def read_gross_national_product(from_date, to_date, frequency):
     pass
 
@@ -448,7 +909,7 @@ if __name__ == '__main__':
     db = connect_to_mongo_engine(atlas_url)
     # print(get_company_classification(stock='AAPL'))
     
-    object_model.AssetPrices.drop_collection()
+    object_model.PriceBucket.drop_collection()
     stocks = companies_in_classification(class_=config.MarketIndices.DOW_JONES)
     populate_db_asset_prices(stocks)
     # populate_db_financial_statements(stocks)
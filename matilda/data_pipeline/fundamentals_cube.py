@@ -0,0 +1,297 @@
+"""
+Dense, point-in-time cube of the filings of the whole universe, cached on disk.
+
+For each period type ('Yearly' and 'Quarterly'), the filings of every ticker are laid out as
+
+    * `values`: (tickers, periods, line items) array, a ticker's filings sorted by date and packed at the front,
+    * `dates`: (tickers, periods) filing dates, NaT past the last filing of the ticker,
+    * `counts`: number of filings of each ticker.
+
+The line items are every numeric field of the `object_model` statements, as dotted paths (e.g.
+'BalanceSheet.Assets.CurrentAssets.TotalCurrentAssets'), so that reading an entry for a universe is a slice of the
+mapped array rather than a database query per stock. The period axis keeps some free slots, which `refresh` fills
+with the filings inserted since the cube was built, without rewriting the history.
+"""
+
+import json
+import os
+import shutil
+import typing
+
+import numpy as np
+import pandas as pd
+from bson import ObjectId
+from mongoengine import EmbeddedDocumentField, FloatField, IntField
+
+from matilda import config
+from matilda.data_pipeline import object_model
+
+FORMAT_VERSION = 1
+PERIOD_TYPES = ['Yearly', 'Quarterly']
+STATEMENTS = ['BalanceSheet', 'IncomeStatement', 'CashFlowStatement']
+FREE_PERIODS = 8  # slots left after the last filing of the ticker with the most filings
+
+
+def line_items() -> typing.List[str]:
+    """
+    Dotted paths of the numeric fields of the financial statements of `object_model.Filing`, in declaration order.
+    """
+
+    def leaves(document, prefix):
+        for name in document._fields_ordered:
+            field = document._fields[name]
+            if isinstance(field, EmbeddedDocumentField):
+                yield from leaves(field.document_type, prefix + [name])
+            elif isinstance(field, (IntField, FloatField)):
+                yield '.'.join(prefix + [name])
+
+    return [item for statement in STATEMENTS
+            for item in leaves(object_model.Filing._fields[statement].document_type, [statement])]
+
+
+def period_file_name(period_type: str, name: str) -> str:
+    return '{}_{}.npy'.format(period_type.lower(), name)
+
+
+class FundamentalsCube:
+    def __init__(self, path: str = config.FUNDAMENTALS_CUBE_DIR_PATH):
+        """
+        Map an existing cube.
+
+        :param path: directory written by `FundamentalsCube.build`
+        """
+        self.path = path
+        with open(os.path.join(path, 'metadata.json'), 'r') as handle:
+            metadata = json.load(handle)
+        if metadata['format_version'] != FORMAT_VERSION:
+            raise Exception('Fundamentals cube at {} has format {}, expected {}. Please rebuild it.'.format(
+                path, metadata['format_version'], FORMAT_VERSION))
+
+        self.version = metadata['version']
+        self.tickers = pd.Index(metadata['tickers'])
+        self.line_items = pd.Index(metadata['line_items'])
+        self.last_ids = metadata['last_ids']  # id of the last filing read, per period type
+        self.values, self.dates, self.counts = {}, {}, {}
+        for period_type in PERIOD_TYPES:
+            self.values[period_type] = np.load(os.path.join(path, period_file_name(period_type, 'values')),
+                                               mmap_mode='r')
+            self.dates[period_type] = np.load(os.path.join(path, period_file_name(period_type, 'dates')))
+            self.counts[period_type] = np.load(os.path.join(path, period_file_name(period_type, 'counts')))
+
+    def __contains__(self, ticker):
+        return ticker in self.tickers
+
+    def covers(self, entry_paths: typing.List[str]) -> bool:
+        return all(entry_path in self.line_items for entry_path in entry_paths)
+
+    def item_locations(self, entry_paths: typing.List[str]) -> np.ndarray:
+        locations = self.line_items.get_indexer(entry_paths)
+        if (locations < 0).any():
+            missing = [entry for entry, location in zip(entry_paths, locations) if location < 0]
+            raise Exception('Entries {} are not line items of the fundamentals cube'.format(missing))
+        return locations
+
+    def filings(self, stocks: typing.List[str], entry_paths: typing.List[str], period_type: str):
+        """
+        Same as `db_crud.read_filings`, from the cube.
+
+        :return: {ticker: (sorted datetime64 array of filing dates, 2D array of filings by entries)}, for the tickers
+            of `stocks` that have filings
+        """
+        items = self.item_locations(entry_paths)
+        values, dates, counts = self.values[period_type], self.dates[period_type], self.counts[period_type]
+        output = {}
+        for stock in stocks:
+            if stock not in self.tickers:
+                continue
+            ticker_id = self.tickers.get_loc(stock)
+            count = counts[ticker_id]
+            if count > 0:
+                output[stock] = (dates[ticker_id, :count], np.asarray(values[ticker_id, :count])[:, items])
+        return output
+
+    @classmethod
+    def build(cls, path: str = config.FUNDAMENTALS_CUBE_DIR_PATH, version: int = 0):
+        """
+        Read every filing of the `Filing` collection (one aggregation per period type), then write the cube.
+
+        :param path:
+        :param version: version of the cube being replaced, if any. The new one gets the next version.
+        :return: the newly built `FundamentalsCube`
+        """
+        from matilda.data_pipeline.db_crud import read_filings
+
+        items = line_items()
+        filings, last_ids = {}, {}
+        for period_type in PERIOD_TYPES:
+            filings[period_type], last_ids[period_type] = read_filings(stocks=None, entry_paths=items,
+                                                                       period_type=period_type)
+        return cls.from_filings(filings=filings, line_items=items, last_ids=last_ids, path=path, version=version)
+
+    @classmethod
+    def from_filings(cls, filings: typing.Dict[str, typing.Dict[str, typing.Tuple[np.ndarray, np.ndarray]]],
+                     line_items: typing.List[str], last_ids: typing.Dict[str, ObjectId] = None,
+                     path: str = config.FUNDAMENTALS_CUBE_DIR_PATH, version: int = 0):
+        """
+        Write a cube from {period type: {ticker: (sorted filing dates, filings by line items array)}}, next to `path`,
+        then swap it in.
+
+        :param filings:
+        :param line_items: columns of the arrays of `filings`
+        :param last_ids: {period type: id of the last filing read}, from which `refresh` picks up
+        :param path:
+        :param version: version of the cube being replaced, if any
+        :return: the newly written `FundamentalsCube`
+        """
+        tickers = sorted(set(ticker for period_filings in filings.values() for ticker in period_filings))
+        last_ids = {} if last_ids is None else {period_type: last_id for period_type, last_id in last_ids.items()
+                                                 if last_id is not None}
+
+        temp_path = path + '.tmp'
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path)
+        os.makedirs(temp_path)
+        for period_type in PERIOD_TYPES:
+            period_filings = filings.get(period_type, {})
+            counts = np.array([len(period_filings[ticker][0]) if ticker in period_filings else 0
+                               for ticker in tickers], dtype=np.int64)
+            periods = int(counts.max() if len(counts) > 0 else 0) + FREE_PERIODS
+            values = np.lib.format.open_memmap(os.path.join(temp_path, period_file_name(period_type, 'values')),
+                                               mode='w+', dtype=np.float64,
+                                               shape=(len(tickers), periods, len(line_items)))
+            values[:] = np.nan
+            dates = np.full((len(tickers), periods), np.datetime64('NaT'), dtype='datetime64[ns]')
+            for ticker_id, ticker in enumerate(tickers):
+                if counts[ticker_id] > 0:
+                    ticker_dates, ticker_values = period_filings[ticker]
+                    dates[ticker_id, :counts[ticker_id]] = ticker_dates
+                    values[ticker_id, :counts[ticker_id]] = ticker_values
+            values.flush()
+            del values
+            np.save(os.path.join(temp_path, period_file_name(period_type, 'dates')), dates)
+            np.save(os.path.join(temp_path, period_file_name(period_type, 'counts')), counts)
+        cls._write_metadata(temp_path, version=version + 1, tickers=tickers, line_items=list(line_items),
+                            last_ids=last_ids)
+
+        old_path = path + '.old'
+        if os.path.exists(path):
+            os.replace(path, old_path)
+        os.replace(temp_path, path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+
+        _open_cubes.pop(path, None)
+        return cls(path)
+
+    def append(self, filings: typing.Dict[str, typing.Dict[str, typing.Tuple[np.ndarray, np.ndarray]]],
+               last_ids: typing.Dict[str, ObjectId]):
+        """
+        Write new filings in the free slots of the cube, in place.
+
+        :param filings: {period type: {ticker: (sorted filing dates, filings by line items array)}} of the new filings
+        :param last_ids: {period type: id of the last filing read}
+        :return: the up to date `FundamentalsCube`, or None if the new filings do not fit, i.e. they are for new
+            tickers, predate the last filing of their ticker, or outnumber the free slots. The cube then has to be
+            rebuilt.
+        """
+        for period_type, period_filings in filings.items():
+            counts, dates = self.counts[period_type], self.dates[period_type]
+            for ticker, (ticker_dates, _) in period_filings.items():
+                if ticker not in self.tickers:
+                    return None
+                ticker_id = self.tickers.get_loc(ticker)
+                count = counts[ticker_id]
+                if count + len(ticker_dates) > dates.shape[1] or \
+                        (count > 0 and ticker_dates[0] <= dates[ticker_id, count - 1]):
+                    return None
+
+        for period_type, period_filings in filings.items():
+            if len(period_filings) == 0:
+                continue
+            counts, dates = self.counts[period_type].copy(), self.dates[period_type].copy()
+            values = np.load(os.path.join(self.path, period_file_name(period_type, 'values')), mmap_mode='r+')
+            for ticker, (ticker_dates, ticker_values) in period_filings.items():
+                ticker_id = self.tickers.get_loc(ticker)
+                count = counts[ticker_id]
+                values[ticker_id, count:count + len(ticker_dates)] = ticker_values
+                dates[ticker_id, count:count + len(ticker_dates)] = ticker_dates
+                counts[ticker_id] += len(ticker_dates)
+            values.flush()
+            del values
+            # the slots written were past the counts of the readers of the previous version, so they never saw them
+            for name, array in [('dates', dates), ('counts', counts)]:
+                temp_file = os.path.join(self.path, period_file_name(period_type, name) + '.tmp.npy')
+                np.save(temp_file, array)
+                os.replace(temp_file, os.path.join(self.path, period_file_name(period_type, name)))
+        # metadata last, so that an interrupted append is read again by the next refresh
+        self._write_metadata(self.path, version=self.version + 1, tickers=self.tickers.to_list(),
+                             line_items=self.line_items.to_list(), last_ids=dict(self.last_ids, **last_ids))
+
+        _open_cubes.pop(self.path, None)
+        return FundamentalsCube(self.path)
+
+    @classmethod
+    def refresh(cls, path: str = config.FUNDAMENTALS_CUBE_DIR_PATH):
+        """
+        Bring the cube up to date with the `Filing` collection. Only the filings inserted since the cube was last
+        built or refreshed are read, and appended in place when they fit; otherwise the cube is rebuilt.
+
+        :param path:
+        :return: the up to date `FundamentalsCube`
+        """
+        from matilda.data_pipeline.db_crud import read_filings
+
+        if not os.path.exists(os.path.join(path, 'metadata.json')):
+            return cls.build(path=path)
+
+        cube = cls(path)
+        if not cube.line_items.equals(pd.Index(line_items())):  # the object model changed
+            return cls.build(path=path, version=cube.version)
+
+        filings, last_ids = {}, {}
+        for period_type in PERIOD_TYPES:
+            last_id = cube.last_ids.get(period_type)
+            filings[period_type], last_ids[period_type] = read_filings(
+                stocks=None, entry_paths=cube.line_items.to_list(), period_type=period_type,
+                after_id=None if last_id is None else ObjectId(last_id))
+            if last_ids[period_type] is None:  # nothing new
+                del last_ids[period_type]
+        if all(len(period_filings) == 0 for period_filings in filings.values()):
+            return cube
+
+        refreshed = cube.append(filings=filings, last_ids=last_ids)
+        return refreshed if refreshed is not None else cls.build(path=path, version=cube.version)
+
+    @staticmethod
+    def _write_metadata(path, version, tickers, line_items, last_ids):
+        temp_file = os.path.join(path, 'metadata.json.tmp')
+        with open(temp_file, 'w') as handle:
+            json.dump({'format_version': FORMAT_VERSION, 'version': version, 'tickers': tickers,
+                       'line_items': line_items,
+                       'last_ids': {period_type: str(last_id) for period_type, last_id in last_ids.items()}}, handle)
+        os.replace(temp_file, os.path.join(path, 'metadata.json'))
+
+
+_open_cubes = {}
+
+
+def get_fundamentals_cube(path: str = config.FUNDAMENTALS_CUBE_DIR_PATH, refresh: bool = False):
+    """
+    The fundamentals cube at `path`, mapped once per process.
+
+    :param path:
+    :param refresh: build the cube if there is none, or else append the filings inserted since it was last refreshed
+    :return: `FundamentalsCube`, or None if it was never built, in which case readers query the database
+    """
+    if refresh:
+        _open_cubes[path] = FundamentalsCube.refresh(path=path)
+    elif path not in _open_cubes:
+        if not os.path.exists(os.path.join(path, 'metadata.json')):
+            return None
+        _open_cubes[path] = FundamentalsCube(path)
+    return _open_cubes[path]
+
+
+if __name__ == '__main__':
+    cube = get_fundamentals_cube(refresh=True)
+    print(cube.version, len(cube.tickers), len(cube.line_items))
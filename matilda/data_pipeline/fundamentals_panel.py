@@ -0,0 +1,129 @@
+"""
+Panel mode of the fundamental analysis functions: a universe of stocks by a vector of dates.
+
+Pass a `FundamentalsPanel` as the `stock` of any statement entry, supporting metric or accounting ratio, and it
+returns a (dates, tickers) numpy array instead of a scalar:
+
+>>> panel = FundamentalsPanel(stocks=companies_in_classification(config.MarketIndices.SP_500),
+...                           dates=pd.date_range(datetime(2019, 1, 1), datetime(2020, 1, 1), freq='MS'))
+>>> panel.frame(current_ratio(stock=panel))
+
+Every line item is read once for the whole panel (one batched read per period type, or slices of the fundamentals
+cube), and the ratios are computed as elementwise operations over the aligned arrays, so the same functions serve
+one stock and the whole universe. `evaluate` goes one step further and reads the line items of many ratios at once.
+"""
+
+import typing
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from matilda import config
+from matilda.data_pipeline.price_store import get_price_store
+from matilda.data_pipeline.universe_matrix import forward_fill
+
+
+class FundamentalsPanel:
+    def __init__(self, stocks, dates):
+        """
+        :param stocks: ticker or list of tickers
+        :param dates: date or list of dates. Every entry is read as of each date, as in `read_financial_statement_entry`
+        """
+        self.stocks = [stocks] if isinstance(stocks, str) else list(stocks)
+        self.dates = pd.DatetimeIndex([dates] if isinstance(dates, datetime) else dates).unique().sort_values()
+        self.entries = {}  # (financial statement, entry path, period, lookback period) -> (dates, tickers) array
+        self.market_prices = {}  # lookback period -> (dates, tickers) array
+        self.recording = False
+
+    def __repr__(self):
+        return 'FundamentalsPanel({} stocks, {} dates)'.format(len(self.stocks), len(self.dates))
+
+    @property
+    def shape(self):
+        return len(self.dates), len(self.stocks)
+
+    def entry(self, financial_statement: str, entry_name: list, period: str,
+              lookback_period: timedelta = timedelta(days=0)) -> np.ndarray:
+        """
+        (dates, tickers) array of an entry, read the first time it is asked for.
+        """
+        key = (financial_statement, tuple(entry_name), period, lookback_period)
+        if self.entries.get(key) is None:
+            if self.recording:  # only collecting what the functions read, see `evaluate`
+                self.entries[key] = None
+                return np.full(self.shape, np.nan)
+            self.prefetch([key])
+        return self.entries[key].copy()  # callers may update it in place
+
+    def prefetch(self, keys: typing.List[typing.Tuple]):
+        """
+        Read entries in one batched read per lookback period.
+
+        :param keys: list of (financial statement, entry name, period, lookback period)
+        """
+        from matilda.data_pipeline.db_crud import read_financial_statement_entries, entry_path
+
+        lookback_periods = sorted(set(key[3] for key in keys))
+        for lookback_period in lookback_periods:
+            batch = [key for key in keys if key[3] == lookback_period]
+            entries_df = read_financial_statement_entries(
+                stocks=self.stocks, dates=self.dates.to_list(), lookback_period=lookback_period,
+                entries=[(financial_statement, list(entry_name), period)
+                         for financial_statement, entry_name, period, _ in batch])
+            for financial_statement, entry_name, period, _ in batch:
+                rows = entries_df[(entries_df['Entry'] == entry_path(financial_statement, entry_name))
+                                  & (entries_df['Period'] == period)]
+                values = rows.pivot(index='Date', columns='Ticker', values='Value')
+                self.entries[(financial_statement, tuple(entry_name), period, lookback_period)] = \
+                    values.reindex(index=self.dates, columns=self.stocks).to_numpy(dtype=np.float64)
+
+    def market_price(self, lookback_period: timedelta = timedelta(days=0)) -> np.ndarray:
+        """
+        (dates, tickers) array of the close of the last bar before each date, from the price store (or the database
+        if no store was built).
+        """
+        if self.recording:
+            return np.full(self.shape, np.nan)
+        if lookback_period not in self.market_prices:
+            as_of = self.dates - lookback_period
+            price_store = get_price_store()
+            if price_store is None:
+                from matilda.data_pipeline.db_crud import read_market_price
+
+                prices = np.array([[read_market_price(stock=stock, date=date) for stock in self.stocks]
+                                   for date in as_of], dtype=np.float64)
+            else:
+                locations = price_store.tickers.get_indexer(self.stocks)
+                closes = np.full((len(price_store.dates), len(self.stocks)), np.nan)
+                closes[:, locations >= 0] = price_store.field_array(config.PriceAction.CLOSE)[
+                    locations[locations >= 0]].T
+                rows = price_store.dates.searchsorted(as_of, side='right') - 1
+                prices = np.where(rows[:, np.newaxis] >= 0, forward_fill(closes)[np.maximum(rows, 0)], np.nan)
+            self.market_prices[lookback_period] = prices
+        return self.market_prices[lookback_period].copy()
+
+    def frame(self, values) -> pd.DataFrame:
+        """
+        (dates, tickers) dataframe of an array computed over the panel.
+        """
+        return pd.DataFrame(np.broadcast_to(values, self.shape), index=self.dates, columns=self.stocks)
+
+    def evaluate(self, metrics: typing.Dict[str, typing.Callable]) -> pd.DataFrame:
+        """
+        Compute many metrics over the panel, reading all of their line items upfront: the metrics first run once on
+        placeholder values to record what they read.
+
+        >>> panel.evaluate({'Current Ratio': current_ratio, 'ROE': partial(return_on_equity, period='TTM')})
+
+        :param metrics: {name: function of `stock`, such as the accounting ratios}
+        :return: dataframe indexed by date, with (metric name, ticker) columns
+        """
+        self.recording = True
+        try:
+            for metric in metrics.values():
+                metric(stock=self)
+        finally:
+            self.recording = False
+        self.prefetch([key for key, values in self.entries.items() if values is None])
+        return pd.concat({name: self.frame(metric(stock=self)) for name, metric in metrics.items()}, axis=1)
@@ -0,0 +1,80 @@
+"""
+Point-in-time constituents of the market indices, for universes free of survivorship bias.
+
+The evolution of an index (its constituents after each change) is loaded once per process into a sorted array of
+change dates and a (changes x tickers) membership matrix, so that both
+
+>>> get_index_membership('S&P 500').constituents(datetime(2016, 1, 1))
+>>> get_index_membership('S&P 500').is_member('AAPL', datetime(2016, 1, 1))
+
+are a binary search on the change dates, instead of a read and a scan of the whole evolution.
+"""
+
+import typing
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from matilda.data_pipeline.storage_backend import get_storage_backend
+
+
+class IndexMembership:
+    def __init__(self, evolution: typing.List[typing.Dict]):
+        """
+        :param evolution: constituents of the index from each date on, as a list of {'date', 'companies'} in any
+            order, as stored in `Index.evolution`
+        """
+        evolution = sorted(evolution, key=lambda item: item['date'])
+        self.dates = np.array([item['date'] for item in evolution], dtype='datetime64[ns]')
+        self.tickers = pd.Index(sorted({ticker for item in evolution for ticker in item['companies']}))
+        self.members = np.zeros((len(evolution), len(self.tickers)), dtype=bool)
+        for row, item in enumerate(evolution):
+            self.members[row, self.tickers.get_indexer(list(item['companies']))] = True
+
+    def __len__(self):
+        return len(self.dates)
+
+    def _rows(self, dates) -> np.ndarray:
+        """
+        Row of the last change at or before each of `dates`, -1 if the index had no constituents recorded yet.
+        """
+        return np.searchsorted(self.dates, np.asarray(dates, dtype='datetime64[ns]'), side='right') - 1
+
+    def constituents(self, date: datetime) -> typing.List[str]:
+        """
+        :return: tickers in the index at `date`, empty before its first recorded change
+        """
+        row = self._rows([date])[0]
+        return [] if row < 0 else self.tickers[self.members[row]].to_list()
+
+    def is_member(self, ticker: str, date: datetime) -> bool:
+        row = self._rows([date])[0]
+        column = self.tickers.get_indexer([ticker])[0]
+        return bool(row >= 0 and column >= 0 and self.members[row, column])
+
+    def membership(self, tickers: typing.List[str], dates) -> np.ndarray:
+        """
+        Vectorized `is_member`, e.g. on the dates and tickers of the universe matrix.
+
+        :return: (dates x tickers) boolean array
+        """
+        rows = self._rows(dates)
+        columns = self.tickers.get_indexer(list(tickers))
+        output = self.members[np.maximum(rows, 0)][:, np.maximum(columns, 0)] if len(self) > 0 \
+            else np.zeros((len(rows), len(columns)), dtype=bool)
+        return output & (rows >= 0)[:, np.newaxis] & (columns >= 0)[np.newaxis, :]
+
+
+_open_memberships = {}
+
+
+def get_index_membership(name: str, refresh: bool = False) -> IndexMembership:
+    """
+    Constituents of the index `name` (e.g. 'Dow Jones', see `config.MarketIndices`), read once per process.
+
+    :param refresh: read the index again, e.g. after `populate_indices`
+    """
+    if refresh or name not in _open_memberships:
+        _open_memberships[name] = IndexMembership(get_storage_backend().read_index(name))
+    return _open_memberships[name]
@@ -1,19 +1,65 @@
+import threading
+
 from mongoengine import *
-from flask_login import UserMixin
+from mongoengine.connection import DEFAULT_CONNECTION_NAME
+
+_deferred_hosts = {}  # connection alias -> host, connected by the first read or write
+_deferred_hosts_lock = threading.Lock()
+
+
+def defer_connection(host: str, alias: str = DEFAULT_CONNECTION_NAME):
+    """
+    Connect the documents to `host` by their first read or write, rather than now. Even registering a mongodb+srv
+    host resolves it.
+    """
+    with _deferred_hosts_lock:
+        _deferred_hosts[alias] = host
+
+
+def cancel_deferred_connection(alias: str = DEFAULT_CONNECTION_NAME):
+    with _deferred_hosts_lock:
+        _deferred_hosts.pop(alias, None)
 
 
-class Test(Document):
+class LazyDocument(Document):
+    """
+    Document connecting to the host of `defer_connection`, if any, when its collection is first needed.
+    """
+    meta = {'abstract': True}
+
+    @classmethod
+    def _get_db(cls):
+        alias = cls._meta.get('db_alias', DEFAULT_CONNECTION_NAME)
+        if alias in _deferred_hosts:
+            with _deferred_hosts_lock:
+                if alias in _deferred_hosts:
+                    connect(host=_deferred_hosts[alias], alias=alias)
+                    del _deferred_hosts[alias]
+        return super()._get_db()
+
+
+class Test(LazyDocument):
     number = IntField(required=True)
 
 
-class User(Document, UserMixin):
+class User(LazyDocument):
+    """
+    Also a Flask-Login user, without importing flask_login (and flask) with the documents.
+    """
     _id = ObjectIdField(required=True, primary_key=True)
     email = StringField(unique=True, required=True)
     password = StringField(required=True)
     name = StringField(required=True)
 
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
+
+    def get_id(self) -> str:
+        return str(self.pk)  # what `load_user` looks up
+
 
-class Company(Document):
+class Company(LazyDocument):
     name = StringField(required=True)
     ticker = StringField(primary_key=True, required=True)
     cik = StringField(required=False, max_length=10, min_length=10)
@@ -33,6 +79,9 @@ class Company(Document):
 
     filings = ListField(ReferenceField('Filing'))
 
+    # classification filters
+    meta = {'indexes': ['sic_sector', 'sic_industry', 'gics_sector', 'gics_industry', 'location', 'exchange']}
+
 
 class CashAndShortTermInvestments(EmbeddedDocument):
     CashAndCashEquivalents = IntField()
@@ -280,7 +329,7 @@ class CashFlowStatement(EmbeddedDocument):
     Supplemental = EmbeddedDocumentField(Supplemental)
 
 
-class Filing(Document):
+class Filing(LazyDocument):
     company = ReferenceField(Company)
     date = DateTimeField(required=True)
     period = StringField()  # Yearly, Quarterly
@@ -288,13 +337,16 @@ class Filing(Document):
     IncomeStatement = EmbeddedDocumentField(IncomeStatement)
     CashFlowStatement = EmbeddedDocumentField(CashFlowStatement)
 
+    # filings of a period type, for some or all companies, in (company, date) order; and the keys of their upserts
+    meta = {'indexes': [{'fields': ['period', 'company', 'date']}]}
+
 
 class DatePrice(EmbeddedDocument):
     date = DateTimeField()
     price = FloatField()
 
 
-class AssetPrices(Document):
+class AssetPrices(LazyDocument):
     company = ReferenceField(Company)
     open = ListField(EmbeddedDocumentField(DatePrice))
     high = ListField(EmbeddedDocumentField(DatePrice))
@@ -302,6 +354,29 @@ class AssetPrices(Document):
     close = ListField(EmbeddedDocumentField(DatePrice))
     volume = ListField(EmbeddedDocumentField(DatePrice))
 
+    meta = {'indexes': ['company']}
+
+
+class PriceBucket(LazyDocument):
+    # bars of a ticker over a calendar month, as parallel arrays
+    ticker = StringField(required=True)
+    month = DateTimeField(required=True)  # first day of the month
+    last_date = DateTimeField()  # of the last bar of the bucket
+    dates = ListField(DateTimeField())
+    open = ListField(FloatField())
+    high = ListField(FloatField())
+    low = ListField(FloatField())
+    close = ListField(FloatField())
+    adj_close = ListField(FloatField())
+    volume = ListField(FloatField())
+
+    meta = {'indexes': [{'fields': ['ticker', 'month'], 'unique': True}]}
+
+
+class PriceWatermark(LazyDocument):
+    ticker = StringField(primary_key=True)
+    last_date = DateTimeField()  # of the last bar stored in `PriceBucket`
+
 
 class RiskFactor(EmbeddedDocument):
     name = StringField()
@@ -309,16 +384,20 @@ class RiskFactor(EmbeddedDocument):
     series = ListField(EmbeddedDocumentField(DatePrice))
 
 
-class RiskFactorModel(Document):
+class RiskFactorModel(LazyDocument):
     name = StringField()
     risk_factors = ListField(EmbeddedDocumentField(RiskFactor))
 
+    meta = {'indexes': ['name']}
+
 
 class DateCompanies(EmbeddedDocument):
     date = DateTimeField()
     companies = ListField(ReferenceField(Company))
 
 
-class Index(Document):
+class Index(LazyDocument):
     name = StringField()
     evolution = ListField(EmbeddedDocumentField(DateCompanies))
+
+    meta = {'indexes': ['name']}
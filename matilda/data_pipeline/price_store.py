@@ -0,0 +1,210 @@
+"""
+Columnar, memory-mapped store of daily asset prices.
+
+The per-ticker pickles in `config.STOCK_PRICES_DIR_PATH` hold full OHLCV frames, so reading one field for a universe
+means unpickling every frame. The store instead keeps
+
+    * one aligned date axis shared by every ticker (`dates.npy`),
+    * one `.npy` array per price field (`config.PriceAction`), of shape (tickers, dates),
+    * a `metadata.json` file with the ticker axis and the fields.
+
+Arrays are opened with `mmap_mode='r'`, so a read only pages in the (ticker, date) slab it touches, and several
+processes reading the same store share the same pages through the OS page cache.
+"""
+
+import json
+import os
+import shutil
+import typing
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from matilda import config
+
+STORE_VERSION = 1
+
+
+def field_file_name(field) -> str:
+    """
+    'Adj Close' -> 'adj_close.npy'
+
+    :param field: `config.PriceAction` or its string value
+    :return:
+    """
+    if isinstance(field, config.PriceAction):
+        field = field.value
+    return '{}.npy'.format(field.lower().replace(' ', '_'))
+
+
+class PriceStore:
+    def __init__(self, path: str = config.PRICE_STORE_DIR_PATH):
+        """
+        Open an existing store. Nothing but the axes is read until a field is accessed.
+
+        :param path: directory of the store, as written by `PriceStore.build`
+        """
+        self.path = path
+        with open(os.path.join(path, 'metadata.json'), 'r') as handle:
+            metadata = json.load(handle)
+        if metadata['version'] != STORE_VERSION:
+            raise Exception('Price store at {} has version {}, expected {}. Please rebuild it.'.format(
+                path, metadata['version'], STORE_VERSION))
+
+        self.fields = metadata['fields']
+        self.tickers = pd.Index(metadata['tickers'])
+        self.dates = pd.DatetimeIndex(np.load(os.path.join(path, 'dates.npy')))
+        self._arrays = {}
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def __contains__(self, ticker):
+        return ticker in self.tickers
+
+    def field_array(self, field=config.PriceAction.ADJ_CLOSE) -> np.ndarray:
+        """
+        Memory-mapped (tickers, dates) array of a price field. Mapped lazily, then kept open.
+
+        :param field: `config.PriceAction` or its string value
+        :return:
+        """
+        if isinstance(field, config.PriceAction):
+            field = field.value
+        if field not in self.fields:
+            raise Exception('Field {} is not in the price store. Available fields are {}'.format(field, self.fields))
+        if field not in self._arrays:
+            self._arrays[field] = np.load(os.path.join(self.path, field_file_name(field)), mmap_mode='r')
+        return self._arrays[field]
+
+    def ticker_locations(self, tickers=None) -> np.ndarray:
+        if tickers is None:
+            return np.arange(len(self.tickers))
+        if isinstance(tickers, str):
+            tickers = [tickers]
+        locations = self.tickers.get_indexer(tickers)
+        if (locations < 0).any():
+            missing = [ticker for ticker, loc in zip(tickers, locations) if loc < 0]
+            raise Exception('Tickers {} are not in the price store'.format(missing))
+        return locations
+
+    def date_slice(self, from_date: datetime = None, to_date: datetime = None) -> slice:
+        """
+        Both ends are inclusive.
+        """
+        start = 0 if from_date is None else self.dates.searchsorted(pd.Timestamp(from_date), side='left')
+        stop = len(self.dates) if to_date is None else self.dates.searchsorted(pd.Timestamp(to_date), side='right')
+        return slice(start, stop)
+
+    def read(self, tickers=None, from_date: datetime = None, to_date: datetime = None,
+             field=config.PriceAction.ADJ_CLOSE) -> pd.DataFrame:
+        """
+        Read one price field for a subset of tickers and dates. Only that slab is copied out of the mapped file.
+
+        :param tickers: ticker or list of tickers. By default, all the tickers in the store.
+        :param from_date: inclusive. By default, the first date in the store.
+        :param to_date: inclusive. By default, the last date in the store.
+        :param field: `config.PriceAction` or its string value. By default, adjusted close.
+        :return: pd.DataFrame indexed by date, with one column per ticker
+        """
+        locations = self.ticker_locations(tickers)
+        dates = self.date_slice(from_date, to_date)
+        values = self.field_array(field)[:, dates][locations]
+        return pd.DataFrame(data=values.T, index=self.dates[dates], columns=self.tickers[locations])
+
+    def read_ticker(self, ticker: str, from_date: datetime = None, to_date: datetime = None) -> pd.DataFrame:
+        """
+        Every field of one ticker, in the layout of the per-ticker pickles (one column per field).
+        Dates on which the ticker has no bar are dropped.
+        """
+        location = self.ticker_locations([ticker])[0]
+        dates = self.date_slice(from_date, to_date)
+        data = {field: self.field_array(field)[location, dates] for field in self.fields}
+        return pd.DataFrame(data=data, index=self.dates[dates]).dropna(how='all')
+
+    @classmethod
+    def build(cls, tickers: typing.List = None, source_dir: str = config.STOCK_PRICES_DIR_PATH,
+              path: str = config.PRICE_STORE_DIR_PATH):
+        """
+        Convert the per-ticker pickles of `source_dir` into a store at `path`. The store is written next to `path`
+        and then swapped in, so readers never see a half-written store (processes that already mapped the previous
+        store keep reading it until they reopen).
+
+        :param tickers: by default, every pickle in `source_dir`
+        :param source_dir:
+        :param path:
+        :return: the newly built `PriceStore`
+        """
+        if tickers is None:
+            tickers = sorted(os.path.splitext(file)[0] for file in os.listdir(source_dir) if file.endswith('.pkl'))
+
+        frames = {}
+        for ticker in tickers:
+            frames[ticker] = pd.read_pickle(os.path.join(source_dir, '{}.pkl'.format(ticker)))
+
+        return cls.from_frames(frames=frames, path=path)
+
+    @classmethod
+    def from_frames(cls, frames: typing.Dict[str, pd.DataFrame], path: str = config.PRICE_STORE_DIR_PATH):
+        """
+        Write a store from a dict of {ticker: OHLCV dataframe}. Fields missing from a frame are stored as NaN.
+        """
+        fields = [price_action.value for price_action in config.PriceAction]
+        tickers = list(frames.keys())
+        dates = pd.DatetimeIndex([])
+        for frame in frames.values():
+            dates = dates.union(pd.DatetimeIndex(frame.index))
+
+        temp_path = path + '.tmp'
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path)
+        os.makedirs(temp_path)
+
+        np.save(os.path.join(temp_path, 'dates.npy'), dates.values.astype('datetime64[ns]'))
+        arrays = {field: np.lib.format.open_memmap(os.path.join(temp_path, field_file_name(field)), mode='w+',
+                                                   dtype=np.float64, shape=(len(tickers), len(dates)))
+                  for field in fields}
+        for i, ticker in enumerate(tickers):
+            frame = frames[ticker]
+            locations = dates.get_indexer(pd.DatetimeIndex(frame.index))
+            for field in fields:
+                arrays[field][i, :] = np.nan
+                if field in frame.columns:
+                    arrays[field][i, locations] = frame[field].to_numpy(dtype=np.float64)
+        for array in arrays.values():
+            array.flush()
+        del arrays
+
+        with open(os.path.join(temp_path, 'metadata.json'), 'w') as handle:
+            json.dump({'version': STORE_VERSION, 'fields': fields, 'tickers': tickers}, handle)
+
+        old_path = path + '.old'
+        if os.path.exists(path):
+            os.replace(path, old_path)
+        os.replace(temp_path, path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+
+        _open_stores.pop(path, None)
+        return cls(path)
+
+
+_open_stores = {}
+
+
+def get_price_store(path: str = config.PRICE_STORE_DIR_PATH):
+    """
+    The store at `path`, opened once per process. Returns None if no store was built there yet,
+    in which case callers fall back on the per-ticker pickles.
+    """
+    if path not in _open_stores:
+        if not os.path.exists(os.path.join(path, 'metadata.json')):
+            return None
+        _open_stores[path] = PriceStore(path)
+    return _open_stores[path]
+
+
+if __name__ == '__main__':
+    store = PriceStore.build()
+    print(store.read(tickers=store.tickers[:5].to_list(), from_date=datetime(2020, 1, 1)))
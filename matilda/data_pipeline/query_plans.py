@@ -0,0 +1,112 @@
+"""
+Query plans of the `db_crud` read routines.
+
+`explain_reads` runs `explain` on the query of each read routine, and flags the ones the database answers by scanning
+a whole collection (a missing or unused index), along with the keys and documents each query examined:
+
+>>> connect_to_mongo_engine(get_atlas_db_url(username, password, dbname))
+>>> explain_reads(stocks=['AAPL', 'MSFT'], date=datetime(2020, 1, 1))
+"""
+
+import typing
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from matilda import config
+from matilda.data_pipeline import object_model
+from matilda.data_pipeline.db_crud import ensure_indexes, filings_pipeline, market_price_pipeline, prices_series_query
+from matilda.data_pipeline.fundamentals_cube import line_items
+
+
+def plan_stages(explain: typing.Dict) -> typing.List[str]:
+    """
+    Stages of the winning plans of an `explain` output (e.g. 'IXSCAN', 'FETCH', 'COLLSCAN'), in the order they appear.
+    """
+    stages = []
+
+    def walk(node):
+        if isinstance(node, dict):
+            if isinstance(node.get('stage'), str):
+                stages.append(node['stage'])
+            for key, value in node.items():
+                # plans the planner rejected, and the winning plan again with its statistics
+                if key not in ('rejectedPlans', 'executionStats'):
+                    walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(explain)
+    return stages
+
+
+def execution_stats(explain: typing.Dict) -> typing.Dict:
+    """
+    First `executionStats` of an `explain` output, wherever the database nested it.
+    """
+    if 'executionStats' in explain:
+        return explain['executionStats']
+    for value in explain.values():
+        values = value if isinstance(value, list) else [value]
+        for element in values:
+            if isinstance(element, dict):
+                stats = execution_stats(element)
+                if len(stats) > 0:
+                    return stats
+    return {}
+
+
+def explain_aggregation(document, pipeline: typing.List[typing.Dict]) -> typing.Dict:
+    collection = document._get_collection()
+    return collection.database.command('explain', {'aggregate': collection.name, 'pipeline': pipeline, 'cursor': {}},
+                                       verbosity='executionStats')
+
+
+def explain_reads(stocks: typing.List[str] = None, date: datetime = None) -> pd.DataFrame:
+    """
+    :param stocks: tickers the queries are for, by default the Dow Jones'
+    :param date: by default now
+    :return: dataframe indexed by read routine, with the stages of its plan, whether it scans a whole collection,
+        and the keys examined, documents examined and documents returned
+    """
+    from matilda.data_pipeline.db_crud import companies_in_classification
+
+    stocks = companies_in_classification(class_=config.MarketIndices.DOW_JONES) if stocks is None else stocks
+    date = datetime.now() if date is None else date
+    entry_paths = line_items()[:1]
+
+    explains = {
+        'read_filings': explain_aggregation(object_model.Filing, filings_pipeline(
+            stocks=stocks, entry_paths=entry_paths, period_type='Quarterly')),
+        'read_filings (all stocks)': explain_aggregation(object_model.Filing, filings_pipeline(
+            stocks=None, entry_paths=entry_paths, period_type='Yearly')),
+        'read_market_price': explain_aggregation(object_model.PriceBucket, market_price_pipeline(
+            stocks=stocks, as_of=date)),
+        'read_prices_series': prices_series_query(stock=stocks[0], from_date=date - timedelta(days=365),
+                                                  to_date=date).explain(),
+        'last_stored_bars': object_model.PriceWatermark.objects(ticker__in=stocks).explain(),
+        'get_index_membership': object_model.Index.objects(
+            name=config.MarketIndices.DOW_JONES.value).explain(),
+    }
+
+    rows = {}
+    for routine, explain in explains.items():
+        stages = plan_stages(explain)
+        stats = execution_stats(explain)
+        rows[routine] = {'Stages': ' < '.join(dict.fromkeys(stages)), 'Collection Scan': 'COLLSCAN' in stages,
+                         'Keys Examined': stats.get('totalKeysExamined'),
+                         'Documents Examined': stats.get('totalDocsExamined'), 'Returned': stats.get('nReturned')}
+    return pd.DataFrame.from_dict(rows, orient='index')
+
+
+if __name__ == '__main__':
+    from matilda.data_pipeline.db_crud import connect_to_mongo_engine, get_atlas_db_url
+
+    connect_to_mongo_engine(get_atlas_db_url(username=config.ATLAS_DB_USERNAME, password=config.ATLAS_DB_PASSWORD,
+                                             dbname='matilda-db'))
+    ensure_indexes()
+    plans = explain_reads()
+    print(plans.to_string())
+    if plans['Collection Scan'].any():
+        raise Exception('Collection scans in {}'.format(', '.join(plans.index[plans['Collection Scan']])))
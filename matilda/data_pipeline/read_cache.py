@@ -0,0 +1,148 @@
+"""
+Persistent read-through cache of the `db_crud` reads, shared by every process of the machine (screener workers, API
+processes, backtests...).
+
+Reads are pickled in a SQLite database, keyed by the read routine, its normalized arguments and `CACHE_VERSION`, and
+indexed by the collection they come from and the tickers they read. When `populate_db_financial_statements` or
+`populate_db_asset_prices` writes a ticker, only the entries of that ticker in that collection are dropped.
+
+The cache is off until it is created:
+
+>>> ReadCache(path=config.READ_CACHE_FILE_PATH)
+>>> read_prices_series('AAPL')  # read from the database, then from the cache by every process
+>>> get_read_cache().hits, get_read_cache().misses
+"""
+
+import functools
+import inspect
+import os
+import pickle
+import sqlite3
+import typing
+
+from matilda import config
+from matilda.data_pipeline.read_memo import normalized
+
+CACHE_VERSION = 1  # bump when the format of what a cached read returns changes
+
+
+class ReadCache:
+    def __init__(self, path: str = config.READ_CACHE_FILE_PATH):
+        """
+        Open the cache at `path`, creating it if needed.
+        """
+        self.path = path
+        self.hits, self.misses = 0, 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # concurrent readers, and writers waiting on each other rather than failing
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS reads '
+                                '(key TEXT PRIMARY KEY, collection TEXT, version INTEGER, value BLOB)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS read_tickers '
+                                '(key TEXT, ticker TEXT, collection TEXT, PRIMARY KEY (ticker, collection, key))')
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM reads WHERE version = ?',
+                                       (CACHE_VERSION,)).fetchone()[0]
+
+    def get_or_read(self, key: str, collection: str, tickers: typing.List[str], read: typing.Callable):
+        """
+        :param key: what identifies the read
+        :param collection: the read comes from
+        :param tickers: the read depends on
+        :param read: computes the value on a miss
+        """
+        row = self.connection.execute('SELECT value FROM reads WHERE key = ? AND version = ?',
+                                      (key, CACHE_VERSION)).fetchone()
+        if row is not None:
+            self.hits += 1
+            return pickle.loads(row[0])
+        self.misses += 1
+        value = read()
+        with self.connection:  # both tables in one transaction
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('INSERT OR REPLACE INTO reads VALUES (?, ?, ?, ?)',
+                                    (key, collection, CACHE_VERSION, pickle.dumps(value)))
+            self.connection.executemany('INSERT OR IGNORE INTO read_tickers VALUES (?, ?, ?)',
+                                        [(key, ticker, collection) for ticker in set(tickers)])
+        return value
+
+    def invalidate(self, tickers: typing.List[str], collection: str = None):
+        """
+        Drop the reads of `tickers`, from `collection` only if given.
+        """
+        condition = 'ticker IN ({})'.format(', '.join('?' * len(tickers)))
+        parameters = list(tickers)
+        if collection is not None:
+            condition += ' AND collection = ?'
+            parameters.append(collection)
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('DELETE FROM reads WHERE key IN (SELECT key FROM read_tickers WHERE {})'.format(
+                condition), parameters)
+            self.connection.execute('DELETE FROM read_tickers WHERE key NOT IN (SELECT key FROM reads)')
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('DELETE FROM reads')
+            self.connection.execute('DELETE FROM read_tickers')
+
+
+_read_caches = {}
+
+
+def get_read_cache(path: str = config.READ_CACHE_FILE_PATH):
+    """
+    Cache at `path`, opened once per process.
+
+    :return: `ReadCache`, or None if it was never created
+    """
+    key = (path, os.getpid())  # SQLite connections cannot be shared with forked workers
+    if key not in _read_caches:
+        if not os.path.exists(path):
+            return None
+        _read_caches[key] = ReadCache(path=path)
+    return _read_caches[key]
+
+
+def invalidate_cached_reads(tickers: typing.List[str], collection: str = None):
+    read_cache = get_read_cache()
+    if read_cache is not None:
+        read_cache.invalidate(tickers=tickers, collection=collection)
+
+
+def cached_read(collection: str, tickers: str):
+    """
+    Serve a read routine from the `ReadCache`, if it was created.
+
+    :param collection: the routine reads from
+    :param tickers: name of the argument holding the ticker(s) read. Reads of all the tickers (None) are not cached.
+    """
+
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            read_cache = get_read_cache()
+            if read_cache is None:
+                return function(*args, **kwargs)
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            try:
+                key = repr((function.__qualname__,) + tuple((name, normalized(value))
+                                                            for name, value in arguments.arguments.items()))
+            except TypeError:  # e.g. a `FundamentalsPanel`
+                return function(*args, **kwargs)
+            stocks = arguments.arguments[tickers]
+            if stocks is None:  # a read of every ticker, which no invalidation of a ticker would drop
+                return function(*args, **kwargs)
+            return read_cache.get_or_read(key=key, collection=collection,
+                                          tickers=[stocks] if isinstance(stocks, str) else list(stocks),
+                                          read=lambda: function(*args, **kwargs))
+
+        return wrapper
+
+    return decorator
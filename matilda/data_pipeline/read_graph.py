@@ -0,0 +1,133 @@
+"""
+Deduplicated reads of composite scores (Beneish M-Score, Piotroski F-Score, Altman Z-Score...).
+
+A composite score is a DAG whose root is the score, whose inner nodes are the ratios and supporting metrics it is
+built from, and whose leaves are financial statement entries, each read for a (stock, entry, period, as-of date).
+The same leaf is typically reached through many paths (total assets is in most of the Piotroski F-Score's ratios,
+and the Beneish M-Score reads net sales six times), and evaluating the score naively reads it once per path.
+
+`ReadGraph.evaluate` first runs the scores on placeholder values to discover their leaves, then fetches every
+distinct leaf once, in bulk, and finally computes the scores from the fetched values:
+
+>>> graph = ReadGraph()
+>>> graph.evaluate({'Beneish M-Score': beneish_m_score, 'Piotroski F-Score': piotroski_f_score},
+...                stocks=['AAPL', 'MSFT'], date=datetime(2020, 1, 1))
+>>> graph.report()  # reads the scores made, distinct leaves fetched, and the difference saved
+"""
+
+import contextvars
+import typing
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+_active_graph = contextvars.ContextVar('read_graph', default=None)
+
+
+def active_read_graph():
+    """
+    :return: the `ReadGraph` the scores are being evaluated in, or None
+    """
+    return _active_graph.get()
+
+
+class ReadGraph:
+    def __init__(self):
+        self.leaves = {}  # (stock, financial statement, entry name, period, as-of date, year) -> value
+        self.read_at = {}  # leaf -> (date, lookback period) it was first asked for
+        self.dependencies = defaultdict(set)  # score name -> leaves it reads
+        self.recording = False
+        self.node = None  # score being evaluated
+        self.leaf_reads = 0  # reads the scores made, i.e. that a naive evaluation would send to the database
+        self.batched_reads = 0
+
+    def __enter__(self):
+        self.token = _active_graph.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active_graph.reset(self.token)
+
+    def read(self, stock: str, financial_statement: str, entry_name: list, period: str, date: datetime,
+             lookback_period: timedelta = timedelta(days=0)) -> float:
+        """
+        Value of a leaf, as `read_financial_statement_entry` would return it for one stock and one date.
+        """
+        date = datetime.now() if date is None else date
+        # the same filings are read as of the same date, whichever way the lookback period was applied
+        leaf = (stock, financial_statement, tuple(entry_name), period, date - lookback_period,
+                date.year if period == 'YTD' else None)
+        if self.node is not None:
+            self.dependencies[self.node].add(leaf)
+        if leaf not in self.read_at:
+            self.read_at[leaf] = (date, lookback_period)
+        if self.recording:
+            return np.nan
+        self.leaf_reads += 1
+        if leaf not in self.leaves:  # a branch the placeholders did not take
+            self.fetch()
+        return self.leaves[leaf]
+
+    def fetch(self):
+        """
+        Read the leaves not fetched yet, in one batched read per lookback period.
+        """
+        from matilda.data_pipeline.db_crud import read_financial_statement_entries, entry_path
+
+        pending = defaultdict(list)
+        for leaf, (date, lookback_period) in self.read_at.items():
+            if leaf not in self.leaves:
+                pending[lookback_period].append(leaf)
+        for lookback_period, leaves in pending.items():
+            stocks = sorted(set(leaf[0] for leaf in leaves))
+            dates = sorted(set(self.read_at[leaf][0] for leaf in leaves))
+            entries = sorted(set(leaf[1:4] for leaf in leaves))
+            entries_df = read_financial_statement_entries(
+                stocks=stocks, dates=dates, lookback_period=lookback_period,
+                entries=[(financial_statement, list(entry_name), period)
+                         for financial_statement, entry_name, period in entries])
+            self.batched_reads += 1
+            values = entries_df.set_index(['Ticker', 'Entry', 'Period', 'Date'])['Value']
+            for leaf in leaves:
+                stock, financial_statement, entry_name, period = leaf[:4]
+                self.leaves[leaf] = float(values.get((stock, entry_path(financial_statement, list(entry_name)),
+                                                      period, self.read_at[leaf][0]), np.nan))
+
+    def evaluate(self, scores: typing.Dict[str, typing.Callable], stocks, date: datetime = None) -> pd.DataFrame:
+        """
+        :param scores: {name: function of `stock` and `date`, such as the fundamental factor scores}
+        :param stocks: ticker or list of tickers
+        :param date: by default now
+        :return: dataframe indexed by ticker, with a column per score
+        """
+        stocks = [stocks] if isinstance(stocks, str) else list(stocks)
+        date = datetime.now() if date is None else date
+        with self:
+            self.recording = True
+            try:
+                for name, score in scores.items():
+                    self.node = name
+                    for stock in stocks:
+                        score(stock=stock, date=date)
+            finally:
+                self.recording = False
+                self.node = None
+            self.fetch()
+            results = {name: [score(stock=stock, date=date) for stock in stocks] for name, score in scores.items()}
+        return pd.DataFrame(results, index=stocks)
+
+    def shared_leaves(self) -> typing.Set[typing.Tuple]:
+        """
+        Leaves read by more than one of the scores evaluated.
+        """
+        counts = defaultdict(int)
+        for leaves in self.dependencies.values():
+            for leaf in leaves:
+                counts[leaf] += 1
+        return {leaf for leaf, count in counts.items() if count > 1}
+
+    def report(self) -> typing.Dict[str, int]:
+        return {'Leaf Reads': self.leaf_reads, 'Distinct Leaves': len(self.leaves),
+                'Reads Saved': self.leaf_reads - len(self.leaves), 'Batched Reads': self.batched_reads}
@@ -0,0 +1,130 @@
+"""
+Request-scoped memo of the `db_crud` reads.
+
+Within one screener run or one rebalancing day, the nested metrics read the same entries and prices over and over
+(`market_capitalization` inside `enterprise_value`, `enterprise_value` inside the EV multiples...). Inside a
+`ReadMemo` scope, every read routine decorated with `memoized_read` answers repeated calls from memory:
+
+>>> with ReadMemo() as memo:
+...     enterprise_value_to_ebitda(stock='AAPL', date=datetime(2020, 1, 1))
+...     enterprise_value_to_sales(stock='AAPL', date=datetime(2020, 1, 1))
+>>> memo.hits, memo.misses
+
+`ReadMemo()` also decorates a function, to scope the memo to each of its calls. A scope opened inside another one
+defers to it, so that e.g. the screener runs of a backtest share the memo of its rebalancing day. Outside of a scope,
+reads go to the database as usual.
+"""
+
+import contextlib
+import contextvars
+import enum
+import functools
+import inspect
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from matilda.data_pipeline.read_graph import active_read_graph
+
+_active_memo = contextvars.ContextVar('read_memo', default=None)
+
+
+class ReadMemo(contextlib.ContextDecorator):
+    def __init__(self, maxsize: int = 4096):
+        """
+        :param maxsize: number of reads kept, the least recently used being evicted first
+        """
+        self.maxsize = maxsize
+        self.reads = OrderedDict()
+        self.tokens = []
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        if len(self.tokens) == 0:  # not re-entered by a nested call of a decorated function
+            self.reads.clear()
+            self.hits, self.misses = 0, 0
+        active = _active_memo.get()
+        self.tokens.append(_active_memo.set(self if active is None else active))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active_memo.reset(self.tokens.pop())
+        if len(self.tokens) == 0:
+            self.reads.clear()
+
+    def __len__(self):
+        return len(self.reads)
+
+    def get_or_read(self, key, read):
+        if key in self.reads:
+            self.reads.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.reads[key] = read()
+            if len(self.reads) > self.maxsize:
+                self.reads.popitem(last=False)
+        return copied(self.reads[key])  # callers may update dataframes in place
+
+
+def copied(value):
+    """
+    Copy of the pandas and numpy objects of a read, and of the containers holding them, so that callers can update
+    them in place without altering the memo. Other values are immutable and shared.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return value.copy()
+    if isinstance(value, dict):
+        return {key: copied(element) for key, element in value.items()}
+    if isinstance(value, list):
+        return [copied(element) for element in value]
+    if isinstance(value, tuple):
+        return tuple(copied(element) for element in value)
+    return value
+
+
+def normalized(value):
+    """
+    Hashable form of a read argument, equal for equal arguments (a list and a tuple of the same tickers, a datetime
+    and the same pd.Timestamp...).
+
+    :raise TypeError: for arguments the memo does not know how to compare, such as a `FundamentalsPanel`
+    """
+    if value is None or isinstance(value, (str, bool, int, float, timedelta, enum.Enum)):
+        return value
+    if isinstance(value, np.number):
+        return value.item()
+    if isinstance(value, (datetime, np.datetime64)):
+        return pd.Timestamp(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(normalized(element) for element in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, normalized(element)) for key, element in value.items()))
+    raise TypeError('Cannot memoize an argument of type {}'.format(type(value).__name__))
+
+
+def memoized_read(function):
+    """
+    Answer the calls of a read routine from the active `ReadMemo`, if any.
+    """
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        memo = _active_memo.get()
+        # values read through a `ReadGraph` are placeholders while it records
+        if memo is None or active_read_graph() is not None:
+            return function(*args, **kwargs)
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        try:
+            key = (function.__qualname__,) + tuple((name, normalized(value))
+                                                   for name, value in arguments.arguments.items())
+        except TypeError:
+            return function(*args, **kwargs)
+        return memo.get_or_read(key, lambda: function(*args, **kwargs))
+
+    return wrapper
@@ -0,0 +1,659 @@
+"""
+Storage backends of the `db_crud` routines: where company info, filings, prices, index constituents and risk factors
+are written to and read from.
+
+`MongoBackend` is the MongoDB cluster the package connects to. `SQLiteBackend` is an embedded database in one local
+file, laid out for single-machine analytics: prices are stored as one row per bar, clustered by (ticker, date), and
+filings are clustered by (period, company, date), with entries projected and TTM/YTD windows computed by SQLite itself.
+Both return the same results, so the whole library can run offline, e.g. with a local copy of the cluster:
+
+>>> copy_storage(source=MongoBackend(), destination=SQLiteBackend(path=config.LOCAL_DATABASE_FILE_PATH))
+>>> config.STORAGE_BACKEND = 'sqlite'
+>>> read_prices_series('AAPL')  # from the local database, as are the writes of populates from now on
+
+The columnar price store and fundamentals cube are built on top of either backend.
+"""
+
+import abc
+import os
+import sqlite3
+import typing
+from collections import defaultdict
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from bson import ObjectId, json_util
+
+from matilda import config
+from matilda.data_pipeline import object_model
+
+
+def upsert_summary(summaries: typing.List[typing.Dict]) -> pd.DataFrame:
+    """
+    :param summaries: one dict per batch written
+    :return: summary of each batch, with columns 'Documents', 'Inserted', 'Replaced', 'Failed' and 'Errors'
+    """
+    summaries_df = pd.DataFrame(summaries, columns=['Documents', 'Inserted', 'Replaced', 'Failed', 'Errors'])
+    summaries_df.index.name = 'Batch'
+    return summaries_df
+
+
+def filings_output(filings: typing.Iterable[typing.Dict], entries: int) -> typing.Tuple[typing.Dict, typing.Any]:
+    """
+    Output of `read_filings` from filings in (company, date) order, each with its '_id', 'company', 'date' and entries
+    'entry_0', 'entry_1'...
+    """
+    by_stock = defaultdict(list)
+    last_id = None
+    for filing in filings:
+        by_stock[filing['company']].append(filing)
+        last_id = filing['_id'] if last_id is None else max(last_id, filing['_id'])
+    output = {}
+    for stock, stock_filings in by_stock.items():
+        dates = np.array([filing['date'] for filing in stock_filings], dtype='datetime64[ns]')
+        values = np.array([[filing.get('entry_{}'.format(i)) for i in range(entries)]
+                           for filing in stock_filings], dtype=np.float64)  # None (missing entry) becomes NaN
+        output[stock] = (dates, values)
+    return output, last_id
+
+
+def rolled_filings_output(filings: typing.Iterable[typing.Dict], entries: int) -> typing.Dict:
+    """
+    Output of `read_rolled_filings` from filings in (company, date) order, each with the fields of
+    `db_crud.rolled_filings_pipeline`.
+    """
+    by_stock = defaultdict(list)
+    for filing in filings:
+        by_stock[filing['company']].append(filing)
+    output = {}
+    for stock, stock_filings in by_stock.items():
+        def values(prefix):  # None (missing entry) becomes NaN
+            return np.array([[filing.get('{}{}'.format(prefix, i)) for i in range(entries)]
+                             for filing in stock_filings], dtype=np.float64).reshape(len(stock_filings), -1)
+
+        rollups = {}
+        for period in ['TTM', 'YTD']:
+            prefix = period.lower()
+            missing = values('{}_missing_'.format(prefix)) > 0
+            rollups[period] = (np.where(missing, np.nan, values('{}_'.format(prefix))),
+                               np.array([filing['{}_count'.format(prefix)] for filing in stock_filings]))
+        output[stock] = (np.array([filing['date'] for filing in stock_filings], dtype='datetime64[ns]'),
+                         values('entry_'), rollups)
+    return output
+
+
+class StorageBackend(metaclass=abc.ABCMeta):
+    """
+    Writes take mongoengine documents (validated the same way by every backend), and replace the document with the
+    same key if any: the ticker of a company, the (company, date, period) of a filing, the (ticker, month) of a price
+    bucket, the name of an index or of a risk factor model.
+    """
+
+    @abc.abstractmethod
+    def write_companies(self, companies: typing.Iterable[object_model.Company], batch_size: int = 1000):
+        """
+        :return: summary of each batch written, see `upsert_summary`
+        """
+        pass
+
+    @abc.abstractmethod
+    def write_filings(self, filings: typing.Iterable[object_model.Filing], batch_size: int = 1000):
+        pass
+
+    @abc.abstractmethod
+    def write_price_buckets(self, buckets: typing.Iterable[object_model.PriceBucket], batch_size: int = 500):
+        """
+        Replace the bars of the (ticker, month) of each bucket.
+        """
+        pass
+
+    @abc.abstractmethod
+    def append_price_bars(self, bars: typing.Iterable[typing.Tuple[str, datetime, typing.Dict]],
+                          batch_size: int = 500) -> pd.DataFrame:
+        """
+        Append bars to the ones stored, idempotently: bars already stored are not appended again.
+
+        :param bars: iterator of (ticker, first day of the month, arrays of the month), see `db_crud.price_buckets`
+        :return: summary of each batch written, with columns 'Writes', 'Inserted', 'Matched', 'Failed' and 'Errors'
+        """
+        pass
+
+    @abc.abstractmethod
+    def write_indices(self, indices: typing.Iterable[object_model.Index]):
+        pass
+
+    @abc.abstractmethod
+    def write_risk_factor_models(self, models: typing.Iterable[object_model.RiskFactorModel], batch_size: int = 50):
+        pass
+
+    @abc.abstractmethod
+    def documents(self, document_class) -> typing.Iterable:
+        """
+        Every document stored of `document_class`: `Company`, `Filing`, `PriceBucket`, `Index` or `RiskFactorModel`.
+        """
+        pass
+
+    @abc.abstractmethod
+    def read_company(self, ticker: str) -> typing.Dict:
+        """
+        :return: fields of the company as stored by MongoDB, its ticker being '_id'
+        """
+        pass
+
+    @abc.abstractmethod
+    def read_index(self, name: str) -> typing.List[typing.Dict]:
+        """
+        :return: evolution of the constituents of the index, as a list of {'date', 'companies'}
+        """
+        pass
+
+    @abc.abstractmethod
+    def read_risk_factor_model(self, name: str) -> typing.Dict:
+        """
+        :return: {risk factor name: series of {'date', 'price'}}
+        """
+        pass
+
+    @abc.abstractmethod
+    def read_filings(self, stocks: typing.List[str], entry_paths: typing.List[str], period_type: str, after_id=None):
+        """
+        See `db_crud.read_filings`.
+        """
+        pass
+
+    @abc.abstractmethod
+    def read_rolled_filings(self, stocks: typing.List[str], entry_paths: typing.List[str]) -> typing.Dict:
+        """
+        See `db_crud.read_rolled_filings`.
+        """
+        pass
+
+    @abc.abstractmethod
+    def read_prices(self, stock: str, from_date: datetime, to_date: datetime,
+                    spec: str = 'close') -> typing.Tuple[typing.List, typing.List]:
+        """
+        :return: (dates, prices) of the bars between the first day of the month of `from_date` and `to_date`, or
+            exactly between `from_date` and `to_date`, in chronological order
+        """
+        pass
+
+    @abc.abstractmethod
+    def read_market_prices(self, stocks: typing.List[str], as_of: datetime, spec: str = 'close') -> typing.Dict:
+        """
+        :return: {ticker: price of its last bar at or before `as_of`}, for the tickers with such a bar
+        """
+        pass
+
+    @abc.abstractmethod
+    def last_stored_bars(self, tickers: typing.List[str]) -> typing.Dict[str, datetime]:
+        """
+        Date of the last bar stored of each ticker. Tickers with no prices stored are left out.
+        """
+        pass
+
+
+class MongoBackend(StorageBackend):
+    def write_companies(self, companies, batch_size=1000):
+        from matilda.data_pipeline.db_crud import bulk_upsert
+
+        return bulk_upsert(companies, keys=['ticker'], batch_size=batch_size)
+
+    def write_filings(self, filings, batch_size=1000):
+        from matilda.data_pipeline.db_crud import bulk_upsert
+
+        return bulk_upsert(filings, keys=['company', 'date', 'period'], batch_size=batch_size)
+
+    def write_price_buckets(self, buckets, batch_size=500):
+        from matilda.data_pipeline.db_crud import bulk_upsert
+
+        tickers = set()
+
+        def tracked():
+            for bucket in buckets:
+                tickers.add(bucket.ticker)
+                yield bucket
+
+        summaries_df = bulk_upsert(tracked(), keys=['ticker', 'month'], batch_size=batch_size)
+        object_model.PriceWatermark.objects(ticker__in=sorted(tickers)).delete()  # the histories were replaced
+        return summaries_df
+
+    def append_price_bars(self, bars, batch_size=500):
+        """
+        The bars are pushed to the bucket of their month, which is created if needed. The pushes are conditional on
+        the first bar not being in the bucket yet, so bars written just before an interruption are not appended twice.
+        Each ticker's watermark (the date of its last bar stored) only moves forward once its bars are written, so that
+        an interrupted update resumes where it stopped when run again.
+        """
+        from pymongo import UpdateOne
+        from matilda.data_pipeline.db_crud import bulk_write
+
+        written = []  # (ticker, date of the last bar written), aligned on the operations
+        blocked = set()  # tickers with a failed write, whose watermark must not move past it
+
+        def operations():
+            for ticker, month, arrays in bars:
+                written.append((ticker, arrays['dates'][-1]))
+                # the bucket is created if new, but not if it already has these bars (duplicate key error instead)
+                not_written = {'$not': {'$gte': arrays['dates'][0]}}
+                yield UpdateOne({'ticker': ticker, 'month': month, 'last_date': not_written},
+                                {'$push': {field: {'$each': values} for field, values in arrays.items()},
+                                 '$max': {'last_date': arrays['dates'][-1]}}, upsert=True)
+
+        def advance_watermarks(succeeded, failed):
+            blocked.update(written[position][0] for position in failed)
+            watermarks = [UpdateOne({'_id': written[position][0]}, {'$max': {'last_date': written[position][1]}},
+                                    upsert=True) for position in succeeded if written[position][0] not in blocked]
+            if len(watermarks) > 0:
+                object_model.PriceWatermark._get_collection().bulk_write(watermarks, ordered=False)
+
+        return bulk_write(collection=object_model.PriceBucket._get_collection(), operations=operations(),
+                          batch_size=batch_size, on_batch=advance_watermarks, duplicates_ok=True)
+
+    def write_indices(self, indices):
+        from matilda.data_pipeline.db_crud import bulk_upsert
+
+        return bulk_upsert(indices, keys=['name'])
+
+    def write_risk_factor_models(self, models, batch_size=50):
+        from matilda.data_pipeline.db_crud import bulk_upsert
+
+        return bulk_upsert(models, keys=['name'], batch_size=batch_size)
+
+    def documents(self, document_class):
+        return document_class.objects.no_cache()
+
+    def read_company(self, ticker):
+        return object_model.Company.objects.get(ticker=ticker).to_mongo().to_dict()
+
+    def read_index(self, name):
+        index = object_model.Index.objects(name=name).first()
+        return [] if index is None else index.to_mongo()['evolution']
+
+    def read_risk_factor_model(self, name):
+        model = object_model.RiskFactorModel.objects(name=name).first()
+        if model is None:
+            return {}
+        return {factor['name']: factor.get('series', []) for factor in model.to_mongo().get('risk_factors', [])}
+
+    def read_filings(self, stocks, entry_paths, period_type, after_id=None):
+        from matilda.data_pipeline.db_crud import filings_pipeline
+
+        return filings_output(object_model.Filing.objects.aggregate(filings_pipeline(
+            stocks=stocks, entry_paths=entry_paths, period_type=period_type, after_id=after_id)),
+            entries=len(entry_paths))
+
+    def read_rolled_filings(self, stocks, entry_paths):
+        from matilda.data_pipeline.db_crud import rolled_filings_pipeline
+
+        return rolled_filings_output(object_model.Filing.objects.aggregate(
+            rolled_filings_pipeline(stocks=stocks, entry_paths=entry_paths), allowDiskUse=True),
+            entries=len(entry_paths))
+
+    def read_prices(self, stock, from_date, to_date, spec='close'):
+        from matilda.data_pipeline.db_crud import prices_series_query
+
+        dates, prices = [], []
+        for bucket in prices_series_query(stock=stock, from_date=from_date, to_date=to_date, spec=spec):
+            dates.extend(bucket['dates'])
+            prices.extend(bucket.get(spec, []))
+        return dates, prices
+
+    def read_market_prices(self, stocks, as_of, spec='close'):
+        import bisect
+        from matilda.data_pipeline.db_crud import market_price_pipeline
+
+        buckets = object_model.PriceBucket.objects.aggregate(market_price_pipeline(stocks=stocks, as_of=as_of,
+                                                                                   spec=spec))
+        return {bucket['_id']: bucket['prices'][bisect.bisect_right(bucket['dates'], as_of) - 1]
+                for bucket in buckets}
+
+    def last_stored_bars(self, tickers):
+        """
+        The watermark of each ticker, or else the last date of its price buckets.
+        """
+        last_dates = {watermark.ticker: watermark.last_date
+                      for watermark in object_model.PriceWatermark.objects(ticker__in=tickers)}
+        missing = [ticker for ticker in tickers if ticker not in last_dates]
+        if len(missing) > 0:
+            for document in object_model.PriceBucket.objects.aggregate([
+                {'$match': {'ticker': {'$in': missing}}},
+                {'$group': {'_id': '$ticker', 'last_date': {'$max': '$last_date'}}}]):
+                last_dates[document['_id']] = document['last_date']
+        return last_dates
+
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'  # sorts chronologically as text
+
+
+def _date_text(date) -> str:
+    return pd.Timestamp(date).strftime(DATE_FORMAT)
+
+
+def _parse_date(text: str) -> datetime:
+    return datetime.strptime(text, DATE_FORMAT)
+
+
+class SQLiteBackend(StorageBackend):
+    def __init__(self, path: str = config.LOCAL_DATABASE_FILE_PATH):
+        """
+        Open the database at `path`, creating it if needed.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        for pragma in ['journal_mode=WAL', 'synchronous=NORMAL', 'temp_store=MEMORY',
+                       'cache_size=-262144',  # 256 MB of pages
+                       'mmap_size=4294967296']:  # reads straight from the page cache of the file
+            self.connection.execute('PRAGMA {}'.format(pragma))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS companies (ticker TEXT PRIMARY KEY, document TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS filings (period TEXT, company TEXT, date TEXT, '
+                                'id TEXT UNIQUE, document TEXT, PRIMARY KEY (period, company, date)) WITHOUT ROWID')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS prices (ticker TEXT, date TEXT, {}, '
+                                'PRIMARY KEY (ticker, date)) WITHOUT ROWID'.format(
+                                    ', '.join('{} REAL'.format(field) for field in self.PRICE_FIELDS)))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS indices (name TEXT PRIMARY KEY, document TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS risk_factor_models (name TEXT PRIMARY KEY, document TEXT)')
+
+    PRICE_FIELDS = ['open', 'high', 'low', 'close', 'adj_close', 'volume']
+
+    def _upsert(self, table: str, keys: typing.List[str], rows: typing.Iterable[typing.Dict],
+                batch_size: int) -> pd.DataFrame:
+        """
+        Write rows in one transaction per batch. A row replaces the other columns of the row with the same `keys`;
+        the columns only given when inserting (such as filing ids) are kept.
+        """
+        summaries = []
+        batch = []
+
+        def write():
+            columns = list(batch[0].keys())
+            updated = [column for column in columns if column not in keys and column != 'id']
+            with self.connection:
+                self.connection.execute('BEGIN IMMEDIATE')
+                inserted = self.connection.executemany('INSERT OR IGNORE INTO {} ({}) VALUES ({})'.format(
+                    table, ', '.join(columns), ', '.join('?' * len(columns))),
+                    [[row[column] for column in columns] for row in batch]).rowcount
+                self.connection.executemany('UPDATE {} SET {} WHERE {}'.format(
+                    table, ', '.join('{} = ?'.format(column) for column in updated),
+                    ' AND '.join('{} = ?'.format(key) for key in keys)),
+                    [[row[column] for column in updated + keys] for row in batch])
+            summaries.append({'Documents': len(batch), 'Inserted': inserted, 'Replaced': len(batch) - inserted,
+                              'Failed': 0, 'Errors': []})
+            batch.clear()
+
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                write()
+        if len(batch) > 0:
+            write()
+        return upsert_summary(summaries)
+
+    @staticmethod
+    def _son(document) -> typing.Dict:
+        document.validate()
+        return document.to_mongo().to_dict()
+
+    def write_companies(self, companies, batch_size=1000):
+        def rows():
+            for company in companies:
+                son = self._son(company)
+                yield {'ticker': son['_id'], 'document': json_util.dumps(son)}
+
+        return self._upsert('companies', keys=['ticker'], rows=rows(), batch_size=batch_size)
+
+    def write_filings(self, filings, batch_size=1000):
+        def rows():
+            for filing in filings:
+                son = self._son(filing)
+                son.pop('_id', None)
+                yield {'period': son.get('period'), 'company': son['company'], 'date': _date_text(son['date']),
+                       'id': str(ObjectId()), 'document': json_util.dumps(son)}
+
+        return self._upsert('filings', keys=['period', 'company', 'date'], rows=rows(), batch_size=batch_size)
+
+    def write_price_buckets(self, buckets, batch_size=500):
+        summaries = []
+        batch = []
+
+        def write():
+            replaced = 0
+            with self.connection:
+                self.connection.execute('BEGIN IMMEDIATE')
+                for bucket in batch:
+                    first_day = _date_text(bucket['month'])
+                    next_month = _date_text(pd.Timestamp(bucket['month']) + pd.offsets.MonthBegin(1))
+                    replaced += self.connection.execute(
+                        'DELETE FROM prices WHERE ticker = ? AND date >= ? AND date < ?',
+                        (bucket['ticker'], first_day, next_month)).rowcount > 0
+                    self.connection.executemany('INSERT INTO prices (ticker, date, {}) VALUES (?, ?, {})'.format(
+                        ', '.join(self.PRICE_FIELDS), ', '.join('?' * len(self.PRICE_FIELDS))),
+                        self._price_rows(bucket['ticker'], bucket))
+            summaries.append({'Documents': len(batch), 'Inserted': len(batch) - replaced, 'Replaced': replaced,
+                              'Failed': 0, 'Errors': []})
+            batch.clear()
+
+        for bucket in buckets:
+            batch.append(self._son(bucket))
+            if len(batch) == batch_size:
+                write()
+        if len(batch) > 0:
+            write()
+        return upsert_summary(summaries)
+
+    def _price_rows(self, ticker: str, arrays: typing.Dict) -> typing.List[typing.List]:
+        columns = [arrays.get(field) or [None] * len(arrays['dates']) for field in self.PRICE_FIELDS]
+        return [[ticker, _date_text(date)] + list(values) for date, *values in zip(arrays['dates'], *columns)]
+
+    def append_price_bars(self, bars, batch_size=500):
+        summaries = []
+        batch = []
+
+        def write():
+            inserted = 0
+            with self.connection:
+                self.connection.execute('BEGIN IMMEDIATE')
+                for ticker, _, arrays in batch:
+                    inserted += self.connection.executemany(
+                        'INSERT OR IGNORE INTO prices (ticker, date, {}) VALUES (?, ?, {})'.format(
+                            ', '.join(self.PRICE_FIELDS), ', '.join('?' * len(self.PRICE_FIELDS))),
+                        self._price_rows(ticker, arrays)).rowcount > 0
+            summaries.append({'Writes': len(batch), 'Inserted': inserted, 'Matched': len(batch) - inserted,
+                              'Failed': 0, 'Errors': []})
+            batch.clear()
+
+        for ticker, month, arrays in bars:
+            batch.append((ticker, month, arrays))
+            if len(batch) == batch_size:
+                write()
+        if len(batch) > 0:
+            write()
+        summaries_df = pd.DataFrame(summaries, columns=['Writes', 'Inserted', 'Matched', 'Failed', 'Errors'])
+        summaries_df.index.name = 'Batch'
+        return summaries_df
+
+    def write_indices(self, indices):
+        rows = ({'name': son['name'], 'document': json_util.dumps(son)}
+                for son in (self._son(index) for index in indices))
+        return self._upsert('indices', keys=['name'], rows=rows, batch_size=1000)
+
+    def write_risk_factor_models(self, models, batch_size=50):
+        rows = ({'name': son['name'], 'document': json_util.dumps(son)}
+                for son in (self._son(model) for model in models))
+        return self._upsert('risk_factor_models', keys=['name'], rows=rows, batch_size=batch_size)
+
+    def documents(self, document_class):
+        if document_class is object_model.PriceBucket:
+            return self._price_buckets()
+        table = {object_model.Company: 'companies', object_model.Filing: 'filings', object_model.Index: 'indices',
+                 object_model.RiskFactorModel: 'risk_factor_models'}.get(document_class)
+        if table is None:
+            raise Exception('Please enter a document class stored by the storage backends')
+        return (document_class._from_son(json_util.loads(document))
+                for document, in self.connection.execute('SELECT document FROM {}'.format(table)))
+
+    def _price_buckets(self):
+        bucket = None
+        for ticker, date, *values in self.connection.execute('SELECT ticker, date, {} FROM prices '
+                                                             'ORDER BY ticker, date'.format(
+                                                                 ', '.join(self.PRICE_FIELDS))):
+            date = _parse_date(date)
+            month = datetime(date.year, date.month, 1)
+            if bucket is None or (bucket.ticker, bucket.month) != (ticker, month):
+                if bucket is not None:
+                    yield bucket
+                bucket = object_model.PriceBucket(ticker=ticker, month=month)
+            bucket.dates.append(date)
+            bucket.last_date = date
+            for field, value in zip(self.PRICE_FIELDS, values):
+                if value is not None:
+                    getattr(bucket, field).append(value)
+        if bucket is not None:
+            yield bucket
+
+    def read_company(self, ticker):
+        row = self.connection.execute('SELECT document FROM companies WHERE ticker = ?', (ticker,)).fetchone()
+        if row is None:
+            raise Exception('Please enter the ticker of a company stored, {} is not'.format(ticker))
+        return json_util.loads(row[0])
+
+    def read_index(self, name):
+        row = self.connection.execute('SELECT document FROM indices WHERE name = ?', (name,)).fetchone()
+        return [] if row is None else json_util.loads(row[0]).get('evolution', [])
+
+    def read_risk_factor_model(self, name):
+        row = self.connection.execute('SELECT document FROM risk_factor_models WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return {}
+        return {factor['name']: factor.get('series', []) for factor in json_util.loads(row[0]).get('risk_factors', [])}
+
+    @staticmethod
+    def _entries(entry_paths: typing.List[str]) -> typing.Tuple[str, typing.List[str]]:
+        """
+        Columns projecting the entries of the filings (NULL where missing or not a number, e.g. NaN), and their
+        parameters.
+        """
+        columns, parameters = [], []
+        for i, path in enumerate(entry_paths):
+            columns.append("CASE WHEN json_type(document, ?) IN ('integer', 'real') THEN json_extract(document, ?) "
+                           "END AS entry_{}".format(i))
+            parameters.extend(['$.' + path] * 2)
+        return ''.join(', ' + column for column in columns), parameters
+
+    @staticmethod
+    def _stocks_condition(stocks: typing.List[str]) -> typing.Tuple[str, typing.List[str]]:
+        if stocks is None:
+            return '', []
+        return ' AND company IN ({})'.format(', '.join('?' * len(stocks))), list(stocks)
+
+    def read_filings(self, stocks, entry_paths, period_type, after_id=None):
+        columns, parameters = self._entries(entry_paths)
+        condition, stock_parameters = self._stocks_condition(stocks)
+        if after_id is not None:
+            condition += ' AND id > ?'
+            stock_parameters.append(str(after_id))
+        cursor = self.connection.execute(
+            'SELECT id AS _id, company, date{} FROM filings WHERE period = ?{} ORDER BY company, date'.format(
+                columns, condition), parameters + [period_type] + stock_parameters)
+        names = [column[0] for column in cursor.description]
+        filings, last_id = filings_output((dict(zip(names, row), date=_parse_date(row[2])) for row in cursor),
+                                          entries=len(entry_paths))
+        return filings, None if last_id is None else ObjectId(last_id)
+
+    def read_rolled_filings(self, stocks, entry_paths):
+        columns, parameters = self._entries(entry_paths)
+        condition, stock_parameters = self._stocks_condition(stocks)
+        rollups = []
+        for prefix in ['ttm', 'ytd']:
+            rollups.append('COUNT(*) OVER {0} AS {0}_count'.format(prefix))
+            for i in range(len(entry_paths)):
+                rollups.append('SUM(entry_{1}) OVER {0} AS {0}_{1}, '
+                               'SUM(entry_{1} IS NULL) OVER {0} AS {0}_missing_{1}'.format(prefix, i))
+        cursor = self.connection.execute(
+            'WITH quarters AS (SELECT company, date, CAST(substr(date, 1, 4) AS INTEGER) AS year{} FROM filings '
+            "WHERE period = 'Quarterly'{}) "
+            'SELECT company, date, {}{} FROM quarters '
+            'WINDOW ttm AS (PARTITION BY company ORDER BY date ROWS 3 PRECEDING), '
+            'ytd AS (PARTITION BY company, year ORDER BY date ROWS 3 PRECEDING) '
+            'ORDER BY company, date'.format(columns, condition,
+                                            ', '.join('entry_{}'.format(i) for i in range(len(entry_paths))) + ', '
+                                            if len(entry_paths) > 0 else '', ', '.join(rollups)),
+            parameters + stock_parameters)
+        names = [column[0] for column in cursor.description]
+        return rolled_filings_output((dict(zip(names, row), date=_parse_date(row[1])) for row in cursor),
+                                     entries=len(entry_paths))
+
+    def read_prices(self, stock, from_date, to_date, spec='close'):
+        if spec not in self.PRICE_FIELDS:
+            raise Exception('Please enter a valid `spec`, one of {}'.format(self.PRICE_FIELDS))
+        rows = self.connection.execute('SELECT date, {} FROM prices WHERE ticker = ? AND date >= ? AND date <= ? '
+                                       'ORDER BY date'.format(spec),
+                                       (stock, _date_text(from_date), _date_text(to_date))).fetchall()
+        return [_parse_date(date) for date, _ in rows], [price for _, price in rows]
+
+    def read_market_prices(self, stocks, as_of, spec='close'):
+        if spec not in self.PRICE_FIELDS:
+            raise Exception('Please enter a valid `spec`, one of {}'.format(self.PRICE_FIELDS))
+        prices = {}
+        for stock in stocks:
+            row = self.connection.execute('SELECT {} FROM prices WHERE ticker = ? AND date <= ? '
+                                          'ORDER BY date DESC LIMIT 1'.format(spec),
+                                          (stock, _date_text(as_of))).fetchone()
+            if row is not None:
+                prices[stock] = row[0]
+        return prices
+
+    def last_stored_bars(self, tickers):
+        return {ticker: _parse_date(date) for ticker, date in self.connection.execute(
+            'SELECT ticker, MAX(date) FROM prices WHERE ticker IN ({}) GROUP BY ticker'.format(
+                ', '.join('?' * len(tickers))), list(tickers))}
+
+
+_storage_backend = None
+_local_backends = {}
+
+
+def set_storage_backend(backend: StorageBackend = None):
+    """
+    Backend of every read and write from now on, in this process. None goes back to the default, see
+    `get_storage_backend`.
+    """
+    global _storage_backend
+    _storage_backend = backend
+
+
+def get_storage_backend(name: str = None, path: str = config.LOCAL_DATABASE_FILE_PATH) -> StorageBackend:
+    """
+    :param name: 'mongo' or 'sqlite', by default `config.STORAGE_BACKEND`
+    :param path: of the local database, when `name` is 'sqlite'
+    :return: the backend set by `set_storage_backend`, or else the backend named (the local database is opened once
+        per process)
+    """
+    if _storage_backend is not None:
+        return _storage_backend
+    name = config.STORAGE_BACKEND if name is None else name
+    if name == 'mongo':
+        return MongoBackend()
+    if name != 'sqlite':
+        raise Exception("Please enter a valid storage backend, 'mongo' or 'sqlite'")
+    key = (path, os.getpid())  # SQLite connections cannot be shared with forked workers
+    if key not in _local_backends:
+        _local_backends[key] = SQLiteBackend(path=path)
+    return _local_backends[key]
+
+
+def copy_storage(source: StorageBackend, destination: StorageBackend,
+                 batch_size: int = 500) -> typing.Dict[str, pd.DataFrame]:
+    """
+    Copy every company, filing, price, index and risk factor model of `source` to `destination`.
+
+    :return: {document class name: summary of each batch written}
+    """
+    return {'Company': destination.write_companies(source.documents(object_model.Company), batch_size=batch_size),
+            'Filing': destination.write_filings(source.documents(object_model.Filing), batch_size=batch_size),
+            'PriceBucket': destination.write_price_buckets(source.documents(object_model.PriceBucket),
+                                                           batch_size=batch_size),
+            'Index': destination.write_indices(source.documents(object_model.Index)),
+            'RiskFactorModel': destination.write_risk_factor_models(source.documents(object_model.RiskFactorModel),
+                                                                    batch_size=batch_size)}
@@ -0,0 +1,103 @@
+"""
+Trading calendar of the securities universe: the days on which at least one ticker of the price store (or of the
+universe matrix) has a bar.
+
+The simulator walks the sessions of the universe matrix rather than every calendar day, and strategies with a declared
+rebalancing frequency only visit every n-th session.
+"""
+
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from matilda import config
+from matilda.data_pipeline.price_store import PriceStore, get_price_store
+from matilda.data_pipeline.universe_matrix import UniverseMatrix, get_universe_matrix
+
+
+class TradingCalendar:
+    def __init__(self, dates):
+        """
+        :param dates: timestamps of the bars, at any time of day. They are normalized to midnight.
+        """
+        self.sessions = pd.DatetimeIndex(dates).normalize().unique().sort_values()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, date):
+        return pd.Timestamp(date).normalize() in self.sessions
+
+    @classmethod
+    def from_price_store(cls, price_store: PriceStore = None):
+        if price_store is None:
+            price_store = get_price_store()
+        return cls(price_store.dates)
+
+    @classmethod
+    def from_universe_matrix(cls, universe_matrix: UniverseMatrix):
+        """
+        Sessions of the dates the matrix holds a bar for, which may lag the price store until it is refreshed.
+        """
+        traded = ~np.isnan(universe_matrix.prices).all(axis=1)
+        return cls(universe_matrix.dates[traded])
+
+    def sessions_between(self, from_date: datetime = None, to_date: datetime = None) -> pd.DatetimeIndex:
+        """
+        Both ends are inclusive.
+        """
+        start = 0 if from_date is None else self.sessions.searchsorted(pd.Timestamp(from_date).normalize(), side='left')
+        stop = len(self.sessions) if to_date is None else self.sessions.searchsorted(pd.Timestamp(to_date), side='right')
+        return self.sessions[start:stop]
+
+    def schedule(self, from_date: datetime = None, to_date: datetime = None, every: int = 1) -> pd.DatetimeIndex:
+        """
+        Every `every`-th session between `from_date` and `to_date`, starting with the first one.
+
+        :param from_date: inclusive
+        :param to_date: inclusive
+        :param every: number of sessions between two dates of the schedule, i.e. `RebalancingFrequency.value`
+        :return:
+        """
+        if every < 1:
+            raise Exception('Please enter a positive number of sessions between two scheduled dates')
+        return self.sessions_between(from_date, to_date)[::every]
+
+
+_calendars = {}
+
+
+def get_trading_calendar(path: str = config.PRICE_STORE_DIR_PATH):
+    """
+    Trading calendar of the price store at `path`, built once per opened store.
+
+    :return: `TradingCalendar`, or None if no store was built there yet
+    """
+    price_store = get_price_store(path)
+    if price_store is None:
+        return None
+    if path not in _calendars or _calendars[path][0] is not price_store:
+        _calendars[path] = (price_store, TradingCalendar.from_price_store(price_store))
+    return _calendars[path][1]
+
+
+_universe_calendars = {}
+
+
+def get_universe_calendar(universe_matrix: UniverseMatrix = None):
+    """
+    Trading calendar of the universe matrix, i.e. of the dates `Strategy.historical_simulation` walks, built once per
+    mapped matrix.
+
+    :param universe_matrix: by default, the one at `config.UNIVERSE_MATRIX_DIR_PATH`
+    :return: `TradingCalendar`, or None if there is no universe matrix
+    """
+    if universe_matrix is None:
+        universe_matrix = get_universe_matrix()
+        if universe_matrix is None:
+            return None
+    path = universe_matrix.path
+    if path not in _universe_calendars or _universe_calendars[path][0] is not universe_matrix:
+        _universe_calendars[path] = (universe_matrix, TradingCalendar.from_universe_matrix(universe_matrix))
+    return _universe_calendars[path][1]
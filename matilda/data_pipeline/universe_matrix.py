@@ -0,0 +1,327 @@
+"""
+Aligned (dates x tickers) price and return matrices of the whole securities universe, cached on disk.
+
+Built once from the `PriceStore`, on a calendar-daily date axis (the one `Strategy.historical_simulation` walks),
+and holding
+
+    * `prices`: adjusted close as traded, NaN on days without a bar,
+    * `ffilled_prices`: prices forward-filled over each ticker's lifetime (NaN before its first and after its last bar),
+    * `returns`: daily percentage change of the forward-filled prices (0 on days without a bar).
+
+The arrays are raw float64 files whose shapes live in `metadata.json`, so loading is a handful of `np.memmap`
+calls whatever the size of the universe, and new bars are appended at the end of the files by `refresh` without
+rewriting the history. Every build or refresh bumps `version`, which consumers can use to invalidate what they derived.
+"""
+
+import json
+import os
+import shutil
+import typing
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from matilda import config
+from matilda.data_pipeline.price_store import PriceStore, get_price_store
+
+FORMAT_VERSION = 1
+ARRAYS = ['prices', 'ffilled_prices', 'returns']
+
+
+def forward_fill(values: np.ndarray, seed: np.ndarray = None) -> np.ndarray:
+    """
+    Forward fill NaNs down the rows of a 2D array.
+
+    :param values: (rows, columns) array
+    :param seed: optional row of values preceding `values`, used to fill its leading NaNs
+    :return: filled copy of `values`
+    """
+    if seed is not None:
+        values = np.vstack([seed[np.newaxis, :], values])
+    rows = np.where(np.isnan(values), 0, np.arange(len(values))[:, np.newaxis])
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    filled = values[rows, np.arange(values.shape[1])]
+    return filled[1:] if seed is not None else filled
+
+
+def last_valid_rows(values: np.ndarray) -> np.ndarray:
+    """
+    Row index of the last non-NaN value of each column, -1 if the column is all NaN.
+    """
+    valid = ~np.isnan(values)
+    last = len(values) - 1 - np.argmax(valid[::-1], axis=0)
+    return np.where(valid.any(axis=0), last, -1)
+
+
+def derived_matrices(prices: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :param prices: (dates, tickers) prices as traded, NaN on days without a bar
+    :return: the forward-filled prices and the returns of `prices`, and the last valid row of each ticker
+    """
+    padded = forward_fill(prices)
+    last_valid = last_valid_rows(prices)
+    ffilled_prices = padded.copy()
+    ffilled_prices[np.arange(len(prices))[:, np.newaxis] > last_valid[np.newaxis, :]] = np.nan
+    returns = np.full_like(padded, np.nan)
+    returns[1:] = padded[1:] / padded[:-1] - 1
+    return ffilled_prices, returns, last_valid
+
+
+class UniverseMatrix:
+    def __init__(self, path: str = config.UNIVERSE_MATRIX_DIR_PATH):
+        """
+        Map an existing universe matrix.
+
+        :param path: directory written by `UniverseMatrix.build`
+        """
+        self.path = path
+        with open(os.path.join(path, 'metadata.json'), 'r') as handle:
+            metadata = json.load(handle)
+        if metadata['format_version'] != FORMAT_VERSION:
+            raise Exception('Universe matrix at {} has format {}, expected {}. Please rebuild it.'.format(
+                path, metadata['format_version'], FORMAT_VERSION))
+
+        self.version = metadata['version']
+        self.tickers = pd.Index(metadata['tickers'])
+        self.dates = pd.date_range(start=pd.Timestamp(metadata['start_date']), periods=metadata['length'], freq='D')
+        shape = (len(self.dates), len(self.tickers))
+        for name in ARRAYS:
+            setattr(self, name, np.memmap(os.path.join(path, '{}.f64'.format(name)), dtype=np.float64,
+                                          mode='r', shape=shape))
+        self.last_valid = np.load(os.path.join(path, 'last_valid.npy'))
+
+    def __contains__(self, ticker):
+        return ticker in self.tickers
+
+    def ticker_ids(self, tickers) -> np.ndarray:
+        if isinstance(tickers, str):
+            tickers = [tickers]
+        ids = self.tickers.get_indexer(tickers)
+        if (ids < 0).any():
+            missing = [ticker for ticker, id_ in zip(tickers, ids) if id_ < 0]
+            raise Exception('Tickers {} are not in the universe matrix'.format(missing))
+        return ids
+
+    def date_location(self, date: datetime) -> int:
+        """
+        Row of the last date of the axis that is at or before `date`, -1 if `date` precedes the axis.
+        """
+        return int(self.dates.searchsorted(pd.Timestamp(date), side='right')) - 1
+
+    def frame(self, name: str = 'returns', tickers=None, from_date: datetime = None, to_date: datetime = None,
+              trading_days_only: bool = False) -> pd.DataFrame:
+        """
+        Slice one of the matrices into a dataframe. Only the requested rows and columns are copied, and a slice of
+        the whole universe is a view of the mapped file (shared with the other processes mapping it).
+
+        :param name: 'prices', 'ffilled_prices', or 'returns'
+        :param tickers: by default, the whole universe
+        :param from_date: inclusive
+        :param to_date: inclusive
+        :param trading_days_only: drop the dates on which none of the selected tickers has a bar
+        :return:
+        """
+        if name not in ARRAYS:
+            raise Exception('Please enter a valid matrix name, one of {}'.format(ARRAYS))
+        start = 0 if from_date is None else self.dates.searchsorted(pd.Timestamp(from_date), side='left')
+        stop = len(self.dates) if to_date is None else self.date_location(to_date) + 1
+        columns = slice(None) if tickers is None else self.ticker_ids(tickers)
+        values = np.asarray(getattr(self, name)[start:stop])[:, columns]
+        df = pd.DataFrame(data=values, index=self.dates[start:stop],
+                          columns=self.tickers if tickers is None else self.tickers[columns], copy=False)
+        if trading_days_only:
+            traded = ~np.isnan(np.asarray(self.prices[start:stop])[:, columns])
+            df = df[traded.any(axis=1)]
+        return df
+
+    @classmethod
+    def build(cls, price_store: PriceStore = None, path: str = config.UNIVERSE_MATRIX_DIR_PATH, version: int = 0):
+        """
+        Build the matrices for every ticker of the price store, then swap them in at `path`.
+
+        :param price_store: by default, the store at `config.PRICE_STORE_DIR_PATH`
+        :param path:
+        :param version: version of the matrix being replaced, if any. The new one gets the next version.
+        :return: the newly built `UniverseMatrix`
+        """
+        if price_store is None:
+            price_store = get_price_store()
+        raw = price_store.read(field=config.PriceAction.ADJ_CLOSE)
+        start_date = raw.index[0]
+        length = (raw.index[-1].normalize() - start_date.normalize()).days + 1
+        rows = (raw.index.normalize() - start_date.normalize()).days
+
+        prices = np.full((length, len(raw.columns)), np.nan)
+        prices[rows] = raw.values
+        ffilled_prices, returns, last_valid = derived_matrices(prices)
+
+        temp_path = path + '.tmp'
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path)
+        os.makedirs(temp_path)
+        for name, values in zip(ARRAYS, [prices, ffilled_prices, returns]):
+            values.tofile(os.path.join(temp_path, '{}.f64'.format(name)))
+        np.save(os.path.join(temp_path, 'last_valid.npy'), last_valid)
+        cls._write_metadata(temp_path, version=version + 1, tickers=raw.columns.to_list(), start_date=start_date,
+                            length=length)
+
+        old_path = path + '.old'
+        if os.path.exists(path):
+            os.replace(path, old_path)
+        os.replace(temp_path, path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+
+        _open_matrices.pop(path, None)
+        return cls(path)
+
+    def restated_tickers(self, price_store: PriceStore) -> np.ndarray:
+        """
+        Tickers whose last price in the matrix is no longer the adjusted close of the store on that date: their
+        history was restated since (e.g. adjusted for a dividend or a split).
+
+        :return: ids of the tickers in the matrix
+        """
+        ids = np.flatnonzero(self.last_valid >= 0)
+        rows = self.last_valid[ids]
+        store_rows = price_store.dates.normalize().get_indexer(self.dates[rows])
+        locations = price_store.ticker_locations(self.tickers[ids].to_list())
+        current = price_store.field_array(config.PriceAction.ADJ_CLOSE)[locations, np.maximum(store_rows, 0)]
+        stored = self.prices[rows, ids]
+        return ids[(store_rows < 0) | ~np.isclose(current, stored, rtol=1e-9, atol=0)]
+
+    @classmethod
+    def _rebuild_columns(cls, matrix, price_store: PriceStore, ticker_ids: np.ndarray):
+        """
+        Recompute the whole history of some tickers, in place, over the dates of the matrix.
+
+        :return: the matrix mapped again, with the same version (the caller bumps it)
+        """
+        raw = price_store.read(tickers=matrix.tickers[ticker_ids].to_list(),
+                               to_date=matrix.dates[-1] + timedelta(days=1, seconds=-1),
+                               field=config.PriceAction.ADJ_CLOSE)
+        rows = (raw.index.normalize() - matrix.dates[0].normalize()).days
+        prices = np.full((len(matrix.dates), len(ticker_ids)), np.nan)
+        prices[rows[rows >= 0]] = raw.values[rows >= 0]
+        ffilled_prices, returns, last_valid = derived_matrices(prices)
+        for name, values in zip(ARRAYS, [prices, ffilled_prices, returns]):
+            array = np.memmap(os.path.join(matrix.path, '{}.f64'.format(name)), dtype=np.float64, mode='r+',
+                              shape=(len(matrix.dates), len(matrix.tickers)))
+            array[:, ticker_ids] = values
+            array.flush()
+            del array
+        matrix_last_valid = matrix.last_valid.copy()
+        matrix_last_valid[ticker_ids] = last_valid
+        np.save(os.path.join(matrix.path, 'last_valid.npy'), matrix_last_valid)
+        return cls(matrix.path)
+
+    @classmethod
+    def refresh(cls, price_store: PriceStore = None, path: str = config.UNIVERSE_MATRIX_DIR_PATH):
+        """
+        Bring the matrices up to date with the price store. If the store only gained dates, the new rows are
+        appended to the existing files (history is not recomputed); if its tickers changed, the matrices are rebuilt.
+        The columns of the tickers whose history was restated (see `restated_tickers`) are recomputed.
+
+        :param price_store: by default, the store at `config.PRICE_STORE_DIR_PATH`
+        :param path:
+        :return: the up to date `UniverseMatrix`
+        """
+        if price_store is None:
+            price_store = get_price_store()
+        if not os.path.exists(os.path.join(path, 'metadata.json')):
+            return cls.build(price_store=price_store, path=path)
+
+        matrix = cls(path)
+        if not matrix.tickers.equals(price_store.tickers):
+            return cls.build(price_store=price_store, path=path, version=matrix.version)
+
+        restated = matrix.restated_tickers(price_store)
+        if len(restated) > 0:
+            matrix = cls._rebuild_columns(matrix, price_store=price_store, ticker_ids=restated)
+
+        last_date = matrix.dates[-1]
+        if price_store.dates[-1].normalize() <= last_date.normalize():
+            if len(restated) > 0:
+                cls._write_metadata(path, version=matrix.version + 1, tickers=matrix.tickers.to_list(),
+                                    start_date=matrix.dates[0], length=len(matrix.dates))
+                _open_matrices.pop(path, None)
+                return cls(path)
+            return matrix
+
+        raw = price_store.read(from_date=last_date.normalize() + timedelta(days=1),
+                               field=config.PriceAction.ADJ_CLOSE)
+        old_length = len(matrix.dates)
+        length = (raw.index[-1].normalize() - matrix.dates[0].normalize()).days + 1
+        rows = (raw.index.normalize() - last_date.normalize()).days - 1
+        new_prices = np.full((length - old_length, len(matrix.tickers)), np.nan)
+        new_prices[rows] = raw.values
+
+        # tickers that resume trading after a gap reaching the end of the old matrix had that gap masked, unmask it
+        new_last_valid = last_valid_rows(new_prices)
+        has_new_bars = new_last_valid >= 0
+        old_last_valid = matrix.last_valid
+        seed = np.where(old_last_valid >= 0,
+                        matrix.prices[np.maximum(old_last_valid, 0), np.arange(len(matrix.tickers))], np.nan)
+        ffilled_prices = np.memmap(os.path.join(path, 'ffilled_prices.f64'), dtype=np.float64, mode='r+',
+                                   shape=(old_length, len(matrix.tickers)))
+        for ticker_id in np.flatnonzero(has_new_bars & (old_last_valid >= 0) & (old_last_valid < old_length - 1)):
+            ffilled_prices[old_last_valid[ticker_id] + 1:, ticker_id] = seed[ticker_id]
+        ffilled_prices.flush()
+        del ffilled_prices
+
+        padded = forward_fill(new_prices, seed=seed)
+        last_valid = np.where(has_new_bars, new_last_valid + old_length, old_last_valid)
+        new_ffilled_prices = padded.copy()
+        new_ffilled_prices[np.arange(old_length, length)[:, np.newaxis] > last_valid[np.newaxis, :]] = np.nan
+        padded = np.vstack([seed[np.newaxis, :], padded])
+        new_returns = padded[1:] / padded[:-1] - 1
+
+        for name, values in zip(ARRAYS, [new_prices, new_ffilled_prices, new_returns]):
+            with open(os.path.join(path, '{}.f64'.format(name)), 'ab') as handle:
+                values.tofile(handle)
+        np.save(os.path.join(path, 'last_valid.npy'), last_valid)
+        # metadata last, so readers never map rows that are not fully written
+        cls._write_metadata(path, version=matrix.version + 1, tickers=matrix.tickers.to_list(),
+                            start_date=matrix.dates[0], length=length)
+
+        _open_matrices.pop(path, None)
+        return cls(path)
+
+    @staticmethod
+    def _write_metadata(path, version, tickers, start_date, length):
+        temp_file = os.path.join(path, 'metadata.json.tmp')
+        with open(temp_file, 'w') as handle:
+            json.dump({'format_version': FORMAT_VERSION, 'version': version, 'tickers': tickers,
+                       'start_date': pd.Timestamp(start_date).isoformat(), 'length': int(length)}, handle)
+        os.replace(temp_file, os.path.join(path, 'metadata.json'))
+
+
+_open_matrices = {}
+
+
+def get_universe_matrix(path: str = config.UNIVERSE_MATRIX_DIR_PATH, refresh: bool = False):
+    """
+    The universe matrix at `path`, mapped once per process. It is built (from the price store, itself built from
+    the per-ticker pickles if needed) the first time it is asked for.
+
+    :param path:
+    :param refresh: append the bars that landed in the price store since the matrix was last built
+    :return: `UniverseMatrix`, or None if there are no prices to build it from
+    """
+    if refresh or path not in _open_matrices:
+        if refresh or not os.path.exists(os.path.join(path, 'metadata.json')):
+            price_store = get_price_store()
+            if price_store is None:
+                if not os.path.exists(config.STOCK_PRICES_DIR_PATH) or not os.listdir(config.STOCK_PRICES_DIR_PATH):
+                    return None
+                price_store = PriceStore.build()
+            _open_matrices[path] = UniverseMatrix.refresh(price_store=price_store, path=path)
+        else:
+            _open_matrices[path] = UniverseMatrix(path)
+    return _open_matrices[path]
+
+
+if __name__ == '__main__':
+    matrix = get_universe_matrix(refresh=True)
+    print(matrix.version, matrix.frame('returns', from_date=datetime.now() - timedelta(days=30)))
@@ -108,7 +108,7 @@ def piotroski_f_score(stock: str, date: datetime = datetime.now(), lookback_peri
     for k, v in piotroski_dictio.items():
         for kk, vv in v.items():
             for kkk, vvv in vv.items():
-                if isinstance(vvv, np.bool_) and vvv:
+                if isinstance(vvv, (bool, np.bool_)) and vvv:
                     number_of_trues = number_of_trues + 1
 
     piotroski_dictio['Piotroski F-Score'][' '][' '] = number_of_trues
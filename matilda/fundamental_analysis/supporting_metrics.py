@@ -1,5 +1,9 @@
+import typing
 from datetime import datetime
 
+import numpy as np
+import pandas as pd
+
 from matilda.data_pipeline.db_crud import read_market_price
 from matilda.fundamental_analysis.financial_statements import *
 
@@ -8,6 +12,20 @@ Intermediary data from financial statements used in accounting ratios and financ
 '''
 
 
+def fill_missing(value, fallback: typing.Callable):
+    """
+    `value` where it is available, else the value of `fallback()`, which is only computed if needed.
+    Works on a float, a pd.Series / pd.DataFrame, and the arrays of a `FundamentalsPanel`.
+    """
+    if np.all(np.isnan(np.asarray(value, dtype=np.float64))):
+        return fallback()
+    if not np.any(np.isnan(np.asarray(value, dtype=np.float64))):
+        return value
+    if isinstance(value, (pd.Series, pd.DataFrame)):
+        return value.where(value.notna(), fallback())
+    return np.where(np.isnan(value), fallback(), value)
+
+
 def dividend_per_share(stock: str, date: datetime = datetime.now(), lookback_period: timedelta = timedelta(days=0),
                        period: str = '', diluted_shares: bool = True, deduct_preferred_dividends: bool = False):
     dividends_paid = payments_of_dividends(stock=stock, date=date, lookback_period=lookback_period, period=period)
@@ -30,9 +48,7 @@ def market_capitalization(stock: str, diluted_shares: bool = False, date: dateti
                           lookback_period: timedelta = timedelta(days=0), period: str = 'Q'):
     shares_outstanding = total_shares_outstanding(stock=stock, date=date, lookback_period=lookback_period,
                                                   period=period, diluted_shares=diluted_shares)
-    output = read_market_price(stock, date, lookback_period) * shares_outstanding * 1000000  # TODO hotfix!
-    print('Market Capitalization for {} on the {} is: {}'.format(stock, date, output))
-    return output
+    return read_market_price(stock, date, lookback_period) * shares_outstanding * 1000000  # TODO hotfix!
 
 
 def enterprise_value(stock: str, date: datetime = datetime.now(), lookback_period: timedelta = timedelta(days=0),
@@ -47,15 +63,13 @@ def enterprise_value(stock: str, date: datetime = datetime.now(), lookback_perio
     :return:
     """
     # TODO check for unfunded pension liabilities and other debt-deemed provisions, and value of associate companies
-    output = market_capitalization(stock=stock, date=date, lookback_period=lookback_period, period=period) \
-             + total_long_term_debt(stock=stock, date=date, lookback_period=lookback_period, period=period) \
-             + np.nan_to_num(
+    return market_capitalization(stock=stock, date=date, lookback_period=lookback_period, period=period) \
+           + total_long_term_debt(stock=stock, date=date, lookback_period=lookback_period, period=period) \
+           + np.nan_to_num(
         minority_interest(stock=stock, date=date, lookback_period=lookback_period, period=period)) \
-             + np.nan_to_num(
+           + np.nan_to_num(
         preferred_stock_value(stock=stock, date=date, lookback_period=lookback_period, period=period)) \
-             - cash_and_cash_equivalents(stock=stock, date=date, lookback_period=lookback_period, period=period)
-    print('Enterprise Value for {} on the {} is: {}'.format(stock, date, output))
-    return output
+           - cash_and_cash_equivalents(stock=stock, date=date, lookback_period=lookback_period, period=period)
 
 
 def gross_profit(stock: str, date: datetime = datetime.now(), lookback_period: timedelta = timedelta(days=0),
@@ -114,17 +128,13 @@ def earnings_before_interest_and_taxes(stock: str, date: datetime = datetime.now
 
 def earnings_before_taxes(stock: str, date: datetime = datetime.now(), lookback_period: timedelta = timedelta(days=0),
                           period: str = ''):
-    directly_from_statement = read_financial_statement_entry(financial_statement='Income Statement', stock=stock,
-                                                             entry_name=[
-                                                                 'Income (Loss) from Continuing Operations before Income Taxes, Noncontrolling Interest',
-                                                                 ' '],
+    directly_from_statement = read_financial_statement_entry(financial_statement='IncomeStatement', stock=stock,
+                                                             entry_name=['IncomeLossBeforeIncomeTaxesMinorityInterest'],
                                                              date=date, lookback_period=lookback_period,
                                                              period=period)
-    if not np.isnan(directly_from_statement):
-        return directly_from_statement
-    else:
-        return net_income(stock=stock, date=date, lookback_period=lookback_period, period=period) \
-               + income_tax_expense(stock=stock, date=date, lookback_period=lookback_period, period=period)
+    return fill_missing(directly_from_statement, lambda: net_income(
+        stock=stock, date=date, lookback_period=lookback_period, period=period) + income_tax_expense(
+        stock=stock, date=date, lookback_period=lookback_period, period=period))
 
 
 def effective_tax_rate(stock: str, date: datetime = datetime.now(), lookback_period: timedelta = timedelta(days=0),
@@ -137,14 +147,12 @@ def capital_expenditures(stock: str, date: datetime = datetime.now(), lookback_p
                          period: str = ''):
     from_cash_flow_statement = acquisition_property_plant_equipment(stock=stock, date=date,
                                                                     lookback_period=lookback_period, period=period)
-    if not np.isnan(from_cash_flow_statement):
-        return from_cash_flow_statement
-    else:
-        return net_property_plant_equipment(stock=stock, date=date, lookback_period=lookback_period, period=period) \
-               - net_property_plant_equipment(stock=stock, date=date - timedelta(days=365 if period != 'Q' else 90),
-                                              lookback_period=lookback_period, period=period) \
-               + depreciation_and_amortization(stock=stock, date=date, lookback_period=lookback_period,
-                                               period=period)
+    # looking back from the date rather than moving the date, so that it also works over a `FundamentalsPanel`
+    return fill_missing(from_cash_flow_statement, lambda: net_property_plant_equipment(
+        stock=stock, date=date, lookback_period=lookback_period, period=period) - net_property_plant_equipment(
+        stock=stock, date=date, lookback_period=lookback_period + timedelta(days=365 if period != 'Q' else 90),
+        period=period) + depreciation_and_amortization(stock=stock, date=date, lookback_period=lookback_period,
+                                                       period=period))
 
 
 def funds_from_operations():
@@ -256,6 +264,6 @@ def free_cash_flow_to_firm(stock: str, date: datetime = datetime.now(), lookback
            * (1 - effective_tax_rate(stock=stock, date=date, lookback_period=lookback_period, period=period)) \
            + depreciation_and_amortization(stock=stock, date=date, lookback_period=lookback_period, period=period) \
            - (net_working_capital(stock=stock, date=date, lookback_period=lookback_period, period=period)
-              - net_working_capital(stock=stock, date=date - timedelta(days=365 if period != 'Q' else 90),
-                                    lookback_period=lookback_period, period=period)) \
+              - net_working_capital(stock=stock, date=date, period=period,
+                                    lookback_period=lookback_period + timedelta(days=365 if period != 'Q' else 90))) \
            - capital_expenditures(stock=stock, date=date, lookback_period=lookback_period, period=period)
@@ -0,0 +1,92 @@
+"""
+Cold-start import time of the matilda subpackages, for short-lived workers that only need part of the package.
+
+Each module is imported by a fresh interpreter with `-X importtime`, so that nothing was imported before, and its
+slowest third-party dependencies are reported along with its import time:
+
+>>> import_times(modules=['matilda', 'matilda.quantitative_analysis.risk_quantification'], repeat=3)
+>>> record_import_times()  # appended to config.IMPORT_TIMES_FILE_PATH, to track cold starts across changes
+"""
+
+import os
+import subprocess
+import sys
+import typing
+from collections import defaultdict
+from datetime import datetime
+
+import pandas as pd
+
+from matilda import config
+
+SUBPACKAGES = ['matilda', 'matilda.data_pipeline.db_crud', 'matilda.api_routes', 'matilda.fundamental_analysis',
+               'matilda.portfolio_management.stock_screener', 'matilda.portfolio_management.portfolio_simulator',
+               'matilda.quantitative_analysis.risk_quantification',
+               'matilda.quantitative_analysis.portfolio_optimization',
+               'matilda.quantitative_analysis.risk_factor_modeling', 'matilda.broker_deployment.alpaca']
+
+
+def parse_import_times(output: str) -> typing.List[typing.Tuple[str, int, int]]:
+    """
+    :param output: standard error of `python -X importtime`
+    :return: list of (module, self microseconds, cumulative microseconds), in the order modules finished importing
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative, module = line[len('import time:'):].split('|')
+        imports.append((module.strip(), int(self_time), int(cumulative)))
+    return imports
+
+
+def import_profile(module: str) -> typing.Dict:
+    """
+    Import `module` in a fresh interpreter.
+
+    :return: {'Seconds': cumulative import time, 'Modules': number of modules imported,
+        'Slowest Dependencies': the 3 top-level packages, other than matilda, that took the longest to import}
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                             cwd=config.ROOT_DIR, capture_output=True, text=True,
+                             env=dict(os.environ, MPLBACKEND='Agg'))
+    if process.returncode != 0:
+        raise Exception('Importing {} failed:\n{}'.format(module, process.stderr.splitlines()[-1]))
+    imports = parse_import_times(process.stderr)
+    packages = defaultdict(int)
+    for name, self_time, _ in imports:
+        if name.split('.')[0] != 'matilda':
+            packages[name.split('.')[0]] += self_time
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:3]
+    return {'Seconds': sum(self_time for _, self_time, _ in imports) / 1e6, 'Modules': len(imports),
+            'Slowest Dependencies': ', '.join('{} ({:.2f}s)'.format(name, time / 1e6) for name, time in slowest)}
+
+
+def import_times(modules: typing.List[str] = None, repeat: int = 3) -> pd.DataFrame:
+    """
+    :param modules: by default, the main entry points of each subpackage
+    :param repeat: imports of each module, the fastest being kept
+    :return: dataframe indexed by module, see `import_profile`
+    """
+    modules = SUBPACKAGES if modules is None else modules
+    profiles = {}
+    for module in modules:
+        profiles[module] = min((import_profile(module) for _ in range(repeat)), key=lambda profile: profile['Seconds'])
+    return pd.DataFrame.from_dict(profiles, orient='index')
+
+
+def record_import_times(path: str = config.IMPORT_TIMES_FILE_PATH, modules: typing.List[str] = None,
+                        repeat: int = 3) -> pd.DataFrame:
+    """
+    Append the import times of `modules`, dated, to the CSV at `path`.
+    """
+    times_df = import_times(modules=modules, repeat=repeat)
+    times_df.index.name = 'Module'
+    times_df.insert(0, 'Date', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    times_df.to_csv(path, mode='a', header=not os.path.exists(path))
+    return times_df
+
+
+if __name__ == '__main__':
+    with pd.option_context('display.max_colwidth', None, 'display.width', 200):
+        print(record_import_times())
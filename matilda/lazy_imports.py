@@ -0,0 +1,56 @@
+"""
+Lazy star imports of a package's modules (PEP 562).
+
+A package that used to re-export its modules with `from package.module import *` instead declares
+
+>>> __getattr__ = lazy_star_imports(__name__, ['package.module', 'package.other_module'])
+
+and `from package import name` still works, but a module (and whatever it imports: plotting, statistics or broker
+libraries...) is only imported the first time one of its names is asked for. Modules are searched in order, the first
+one exporting the name wins.
+"""
+
+import importlib
+import importlib.util
+import sys
+import typing
+
+
+def exported_names(module) -> typing.Set[str]:
+    """
+    Names `from module import *` would bind.
+    """
+    if hasattr(module, '__all__'):
+        return set(module.__all__)
+    return {name for name in vars(module) if not name.startswith('_')}
+
+
+def lazy_star_imports(package: str, modules: typing.List[str]) -> typing.Callable:
+    """
+    :param package: name of the package, i.e. its `__name__`
+    :param modules: full names of the modules it re-exports, in the order of the star imports they replace
+    :return: the `__getattr__` of the package
+    """
+
+    def __getattr__(name: str):
+        if name.startswith('__'):  # e.g. `__path__` lookups of the import system
+            raise AttributeError(name)
+        if importlib.util.find_spec('{}.{}'.format(package, name)) is not None:  # a submodule
+            return importlib.import_module('{}.{}'.format(package, name))
+        for module_name in modules:
+            module = importlib.import_module(module_name)
+            if name in exported_names(module):
+                value = getattr(module, name)
+            elif getattr(getattr(module, '__getattr__', None), 'lazy_star_imports', False):  # a lazy package too
+                try:
+                    value = getattr(module, name)
+                except AttributeError:
+                    continue
+            else:
+                continue
+            setattr(sys.modules[package], name, value)  # later lookups do not go through `__getattr__`
+            return value
+        raise AttributeError("module '{}' has no attribute '{}'".format(package, name))
+
+    __getattr__.lazy_star_imports = True
+    return __getattr__
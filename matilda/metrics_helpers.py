@@ -67,7 +67,7 @@ def compare_against_macro(metric, stock, against, date=None,
     '''
 
     enum_str_pairs = {config.GICS_Sectors: 'gics_sector', config.SIC_Sectors: 'sic_sector',
-                      config.GICS_Industries: 'gics_indsutry', config.SIC_Industries: 'sic_industry',
+                      config.GICS_Industries: 'gics_industry', config.SIC_Industries: 'sic_industry',
                       config.Regions: 'location', config.Exchanges: 'exchange', config.MarketIndices: ''}
     classification = get_company_classification(stock=stock)[enum_str_pairs[against]]
     stocks_in_macro = companies_in_classification(class_=against(classification), date=date)
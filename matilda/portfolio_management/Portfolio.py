@@ -5,36 +5,28 @@ from datetime import timedelta
 from datetime import datetime
 
 from matilda.data_pipeline.TimeDataFrame import TimeDataFrame
-
-
-class Trade:
-    def __init__(self, stock: pd.Series, direction: bool, shares: int, date: datetime,
-                 stop_loss: float = None, take_profit: float = None, commission: float = 5):
-        self.stock = stock
-        self.direction = direction
-        self.shares = shares
-        self.date = date
-        self.stop_loss = stop_loss
-        self.take_profit = take_profit
-        self.commission = commission
+from matilda.portfolio_management.position_ledger import PositionLedger
 
 
 class Portfolio(TimeDataFrame):
-    def __init__(self, assets, balance: float = 0, trades=None, date: datetime = datetime.now()):
+    def __init__(self, assets, balance: float = 0, positions: PositionLedger = None, date: datetime = datetime.now(),
+                 from_date: datetime = None, to_date: datetime = None):
         """
 
         :param assets:
         :param balance:
-        :param trades:
+        :param positions: open positions, by default none
         :param date:
+        :param from_date: first date of the returns read for tickers, see `TimeDataFrame`
+        :param to_date: last date of the returns read for tickers, see `TimeDataFrame`
         """
-        if trades is None:
-            trades = []
+        if positions is None:
+            positions = PositionLedger()
 
-        super().__init__(assets)
+        super().__init__(assets, from_date=from_date, to_date=to_date)
         self.stocks = self.df_returns.columns
         self.balance = balance
-        self.trades = trades
+        self.positions = positions
         self.float = float(balance)
         self.date = date
         self.last_rebalancing_day = date
@@ -48,96 +40,88 @@ class Portfolio(TimeDataFrame):
         :return:
         '''
         long_short = pd.concat([long_stocks, short_stocks], axis=1)
+        closing_prices = long_short.loc[self.date - timedelta(seconds=1)]  # TODO end of day or start?
         float_before_trades = self.float
         for i in range(2):
-            for stock, prices in long_short.iteritems():
-                closing_price = prices.loc[self.date - timedelta(seconds=1)]  # TODO end of day or start?
-                stock_is_in_portfolio = False
-
-                for trade in self.trades:
-
-                    # If the stock computed is already part of our portfolio, then:
-                    if stock == trade.stock.name \
-                            and ((stock in long_stocks.columns and trade.stock.name in long_stocks.columns)
-                                 or (stock in short_stocks.columns and trade.stock.name in short_stocks.columns)):
-
-                        stock_is_in_portfolio = True
-
-                        # Aggregate total weight of asset in portfolio
-                        current_weight_in_portfolio = 0
-                        for trade in self.trades:
-                            if stock == trade.stock.name:
-                                current_weight_in_portfolio += trade.shares * closing_price / float_before_trades
-
-                        # The weight we need to rebalance for
-                        delta_weights = weights[stock] - current_weight_in_portfolio
-                        delta_shares = (abs(delta_weights) * float_before_trades - commission) / closing_price
-
-                        # for first sweep, target weight should less than current weight and original position is long
-                        #  or vice versa for short (means we're selling)
-                        # for second sweep, target weight should be more than current weight and original position is
-                        # long or vice versa for short (means we're buying)
-
-                        if delta_shares > 0:
-                            if not fractional_shares:
-                                delta_shares = math.floor(delta_shares)
-                            if (i == 0 and ((delta_weights < 0 and trade.direction)
-                                            or (delta_weights > 0 and not trade.direction))):
-                                # we're exiting longs and entering shorts
-                                trade = Trade(direction=True if stock in long_stocks.columns else False,
-                                              stock=prices, shares=delta_shares, date=self.date)
-                                self.make_position(trade, entry=False if stock in long_stocks.columns else True)
-                                break
-                            elif (i == 1 and ((delta_weights > 0 and trade.direction)
-                                              or (delta_weights < 0 and not trade.direction))):
-                                # we're entering longs and exiting shorts
-                                trade = Trade(direction=True if stock in long_stocks.columns else False,
-                                              stock=prices, shares=delta_shares, date=self.date)
-                                self.make_position(trade, entry=True if stock in long_stocks.columns else False)
-                                break
+            for stock, closing_price in closing_prices.items():
+                direction = stock in long_stocks.columns
+                held_direction = self.positions.direction(stock)
+
+                # A stock that switched sides is exited first, then entered again as a new position
+                if i == 0 and held_direction is not None and held_direction != direction:
+                    self.make_position(stock, direction=held_direction, shares=abs(self.positions.shares(stock)),
+                                       price=closing_price, entry=False, commission=commission)
+                    held_direction = None
+
+                # If the stock computed is already part of our portfolio, then:
+                if held_direction is not None:
+                    current_weight_in_portfolio = abs(self.positions.shares(stock)) * closing_price \
+                                                  / float_before_trades
+
+                    # The weight we need to rebalance for
+                    delta_weights = weights[stock] - current_weight_in_portfolio
+                    delta_shares = (abs(delta_weights) * float_before_trades - commission) / closing_price
+                    if not fractional_shares:
+                        delta_shares = math.floor(delta_shares)
+
+                    # for first sweep, target weight should less than current weight and original position is long
+                    #  or vice versa for short (means we're selling)
+                    # for second sweep, target weight should be more than current weight and original position is
+                    # long or vice versa for short (means we're buying)
+                    if delta_shares > 0:
+                        if i == 0 and ((delta_weights < 0 and held_direction)
+                                       or (delta_weights > 0 and not held_direction)):
+                            # we're exiting longs and entering shorts
+                            self.make_position(stock, direction=direction, shares=delta_shares, price=closing_price,
+                                               entry=not direction, commission=commission)
+                        elif i == 1 and ((delta_weights > 0 and held_direction)
+                                         or (delta_weights < 0 and not held_direction)):
+                            # we're entering longs and exiting shorts
+                            self.make_position(stock, direction=direction, shares=delta_shares, price=closing_price,
+                                               entry=direction, commission=commission)
 
                 # If the stock computed is not already part of our portfolio
-                if not stock_is_in_portfolio:
+                else:
                     shares_to_trade = (weights[stock] * float_before_trades - commission) / closing_price
                     if not fractional_shares:
                         shares_to_trade = math.floor(shares_to_trade)
                     if shares_to_trade > 0:
-                        if i == 0 and stock in short_stocks.columns:  # entering shorts
-                            trade = Trade(direction=False, stock=prices, shares=shares_to_trade, date=self.date)
-                            self.make_position(trade, entry=True)
-                        if i == 1 and stock in long_stocks.columns:  # entering longs
-                            trade = Trade(direction=True, stock=prices, shares=shares_to_trade, date=self.date)
-                            self.make_position(trade, entry=True)
-
-    def make_position(self, trade: Trade, entry: bool):
-        trade_closing_price = trade.stock[self.date - timedelta(seconds=1)]
+                        if i == 0 and not direction:  # entering shorts
+                            self.make_position(stock, direction=False, shares=shares_to_trade, price=closing_price,
+                                               entry=True, commission=commission)
+                        if i == 1 and direction:  # entering longs
+                            self.make_position(stock, direction=True, shares=shares_to_trade, price=closing_price,
+                                               entry=True, commission=commission)
+
+    def make_position(self, stock: str, direction: bool, shares: float, price: float, entry: bool,
+                      commission: float = 5):
+        """
+        Enter or exit (part of) a position at `price`, and settle it against the balance.
+
+        :param stock: ticker
+        :param direction: True if long, False if short
+        :param shares:
+        :param price: closing price of the stock on the trading day
+        :param entry: True to enter the position, False to exit it (oldest lots first)
+        :param commission:
+        :return:
+        """
         if not entry:  # if I am exiting a position
-
-            shares_left = trade.shares
-            for portfolio_trade in self.trades:
-                if portfolio_trade.stock.name == trade.stock.name and trade.direction == portfolio_trade.direction:
-                    # If the number of shares to exit is greater than the trade in the portfolio
-                    # (total exit or simply partial exit with more shares than trade placed at such date)
-                    if shares_left > portfolio_trade.shares:
-                        self.trades.pop(self.trades.index(portfolio_trade))
-                        shares_left -= portfolio_trade.shares
-                    else:  # partial exit
-                        portfolio_trade.shares -= shares_left
-                        break
+            shares = self.positions.exit(stock, direction=direction, shares=shares)
+            if shares == 0:
+                return
         else:
-            if self.balance > trade_closing_price * trade.shares + trade.commission:
-                self.trades.append(trade)
+            if self.balance <= price * shares + commission:
+                return
+            self.positions.enter(stock, direction=direction, shares=shares, price=price, date=self.date)
         # Now Adjust Balance: making a position should only affect the balance, not the float
 
         # if entering a long position or exiting a short position
-        if (trade.direction and entry) or (not trade.direction and not entry):
-            if self.balance > trade_closing_price * trade.shares + trade.commission:
-                self.balance = self.balance - (trade_closing_price * trade.shares + trade.commission)
+        if (direction and entry) or (not direction and not entry):
+            self.balance = self.balance - (price * shares + commission)
         # if exiting a long position or entering a short position
-        elif (trade.direction and not entry) or (not trade.direction and entry):
-            self.balance = self.balance + (trade_closing_price * trade.shares - trade.commission)
         else:
-            return
+            self.balance = self.balance + (price * shares - commission)
 
     def get_volatility_returns(self, to_freq: str = 'Y'):
         return self.df_returns.std(axis=0) * np.sqrt(self.freq_multipliers[self.frequency[0]][to_freq])
@@ -1,4 +1,10 @@
-from matilda.portfolio_management.strategies import *
-from matilda.portfolio_management.Portfolio import *
-from matilda.portfolio_management.portfolio_simulator import *
-from matilda.portfolio_management.stock_screener import *
\ No newline at end of file
+from matilda.lazy_imports import lazy_star_imports
+
+__getattr__ = lazy_star_imports(__name__, ['matilda.portfolio_management.strategies',
+                                           'matilda.portfolio_management.position_ledger',
+                                           'matilda.portfolio_management.Portfolio',
+                                           'matilda.portfolio_management.simulation_checkpoint',
+                                           'matilda.portfolio_management.portfolio_simulator',
+                                           'matilda.portfolio_management.stock_screener',
+                                           'matilda.portfolio_management.parameter_sweep',
+                                           'matilda.portfolio_management.walk_forward'])
@@ -0,0 +1,96 @@
+"""
+Backtest a strategy over a grid of parameters, in parallel.
+
+Runs are fanned out over a process pool. The market data is not shipped to the workers: the universe matrix is a set of
+read-only memory-mapped files, built once by the parent if needed, and every worker maps the same files, so the
+matrix sits once in the OS page cache and is shared by all the workers without being copied.
+"""
+
+import itertools
+import typing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from matilda import config
+from matilda.data_pipeline.universe_matrix import get_universe_matrix
+
+
+def parameter_grid(grid: typing.Dict[str, typing.List]) -> typing.List[typing.Dict]:
+    """
+    >>> parameter_grid({'max_stocks_count_in_portfolio': [10, 20], 'fractional_shares': [True]})
+    [{'max_stocks_count_in_portfolio': 10, 'fractional_shares': True}, {'max_stocks_count_in_portfolio': 20, 'fractional_shares': True}]
+    """
+    names = list(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+
+
+def summary_statistics(evolution_df: pd.DataFrame) -> pd.Series:
+    """
+    Summary of one `evolution_df` returned by `Strategy.historical_simulation`.
+    """
+    floats = evolution_df['Float'].to_numpy(dtype=np.float64)
+    running_peaks = np.maximum.accumulate(floats)
+    returns = floats[1:] / floats[:-1] - 1
+    return pd.Series({'Final Float': floats[-1],
+                      'Total Return': floats[-1] / floats[0] - 1,
+                      'Max Drawdown': (floats / running_peaks - 1).min(),
+                      'Mean Return per Rebalancing': returns.mean() if len(returns) > 0 else np.nan,
+                      'Volatility per Rebalancing': returns.std(ddof=1) if len(returns) > 1 else np.nan,
+                      'Rebalancing Count': len(floats)})
+
+
+def _attach_universe_matrix():
+    # map the universe matrix once per worker, before its first run
+    get_universe_matrix()
+
+
+def _simulate(strategy_factory: typing.Callable, parameters: typing.Dict, simulation_kwargs: typing.Dict):
+    strategy = strategy_factory(**parameters)
+    return strategy.historical_simulation(verbose=False, **simulation_kwargs)
+
+
+def parameter_sweep(strategy_factory: typing.Callable, grid: typing.Dict[str, typing.List], starting_date: datetime,
+                    ending_date: datetime, starting_capital: float, processes: int = None, **simulation_kwargs):
+    """
+    Backtest `strategy_factory(**parameters)` for every combination of parameters of the grid.
+
+    >>> evolution_df, summary_df = parameter_sweep(CustomStrategy, grid={
+    ...     'max_stocks_count_in_portfolio': [10, 20, 30], 'net_exposure': [(100, 0)],
+    ...     'rebalancing_frequency': [RebalancingFrequency.Monthly, RebalancingFrequency.Quarterly]},
+    ...     starting_date=datetime(2019, 1, 1), ending_date=datetime(2020, 12, 1), starting_capital=50000)
+
+    :param strategy_factory: `Strategy` subclass, or any picklable callable (i.e. defined at the top level of a module)
+        returning a `Strategy` from keyword parameters
+    :param grid: {parameter name: list of values to try}
+    :param starting_date:
+    :param ending_date:
+    :param starting_capital:
+    :param processes: size of the process pool, by default the number of CPUs. 1 runs everything in this process.
+    :param simulation_kwargs: other arguments of `Strategy.historical_simulation`, e.g. `commission` or `engine`
+    :return: tuple of two tidy dataframes, with one column per parameter of the grid and a 'Run' column:
+        * the evolution curves, with one row per run and rebalancing date,
+        * the summary statistics, with one row per run.
+    """
+    # build the matrix here if needed, so that the workers only have to map it
+    if get_universe_matrix() is None:
+        raise Exception('No prices to simulate on. Please populate {} first.'.format(config.STOCK_PRICES_DIR_PATH))
+
+    runs = parameter_grid(grid)
+    simulation_kwargs = dict(simulation_kwargs, starting_date=starting_date, ending_date=ending_date,
+                             starting_capital=starting_capital)
+    if processes == 1:
+        evolutions = [_simulate(strategy_factory, parameters, simulation_kwargs) for parameters in runs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_attach_universe_matrix) as executor:
+            evolutions = list(executor.map(_simulate, itertools.repeat(strategy_factory), runs,
+                                           itertools.repeat(simulation_kwargs)))
+
+    parameters_df = pd.DataFrame(runs).rename_axis('Run')
+    evolution_df = pd.concat({run: evolution for run, evolution in enumerate(evolutions)}, names=['Run', 'Date'])
+    evolution_df = parameters_df.join(evolution_df.reset_index(level='Date'), how='inner').reset_index()
+    summary_df = parameters_df.join(pd.DataFrame([summary_statistics(evolution) for evolution in evolutions],
+                                                 index=parameters_df.index)).reset_index()
+    return evolution_df, summary_df
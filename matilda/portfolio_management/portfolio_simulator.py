@@ -1,21 +1,24 @@
 import abc
 import os
+import typing
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 
 from datetime import datetime, timedelta
 from functools import partial
 from abc import abstractmethod
 from enum import Enum
 from matilda import config
-from matilda.broker_deployment.alpaca import AlpacaBroker
+from matilda.data_pipeline.index_membership import get_index_membership
+from matilda.data_pipeline.read_memo import ReadMemo
+from matilda.data_pipeline.trading_calendar import get_universe_calendar
+from matilda.data_pipeline.universe_matrix import UniverseMatrix, get_universe_matrix
 from matilda.portfolio_management.Portfolio import Portfolio
+from matilda.portfolio_management.position_ledger import PositionLedger
+from matilda.portfolio_management.simulation_checkpoint import SimulationCheckpoint
 from matilda.broker_deployment.broker_interface import Broker
 from matilda.portfolio_management.stock_screener import StockScreener
 
-plt.style.use('fivethirtyeight')
-
 
 # TODO: Add statistics i.e. average drawdown, alpha, beta/sharpe/sortino...
 #       Functionality for reinvesting dividends
@@ -40,6 +43,8 @@ class Strategy(metaclass=abc.ABCMeta):
     def __init__(self, max_stocks_count_in_portfolio: int, net_exposure: tuple,
                  maximum_leverage: float = 1.0,
                  reinvest_dividends: bool = False, fractional_shares: bool = False,
+                 rebalancing_frequency: RebalancingFrequency = None,
+                 securities_universe: config.MarketIndices = None,
                  ):
 
         """
@@ -51,6 +56,10 @@ class Strategy(metaclass=abc.ABCMeta):
         :param maximum_leverage:
         :param reinvest_dividends:
         :param fractional_shares:
+        :param rebalancing_frequency: declare a fixed rebalancing schedule, in trading sessions. The simulator then
+            jumps from one rebalancing date to the next instead of asking `is_market_timing` every session.
+        :param securities_universe: only trade the constituents of this index as of each rebalancing date, so that a
+            backtest does not pick among the survivors in today's index.
 
         """
         self.max_stocks_count_in_portfolio = max_stocks_count_in_portfolio
@@ -58,6 +67,8 @@ class Strategy(metaclass=abc.ABCMeta):
         self.maximum_leverage = maximum_leverage
         self.reinvest_dividends = reinvest_dividends
         self.fractional_shares = fractional_shares
+        self.rebalancing_frequency = rebalancing_frequency
+        self.securities_universe = securities_universe
 
     @abstractmethod
     def screen_stocks(self, current_date):
@@ -79,92 +90,258 @@ class Strategy(metaclass=abc.ABCMeta):
         """
         pass
 
-    @abstractmethod
     def is_market_timing(self, portfolio: Portfolio):
         """
-        Is it time to rebalance the portfolio.
+        Is it time to rebalance the portfolio. Needs to be overridden unless the strategy declares a
+        `rebalancing_frequency`.
         Example: `return (current_date - last_rebalancing_day).days > config.RebalancingFrequency.Quarterly.value`
 
         :param portfolio:
         :return: Boolean true if we need to rebalance our portfolio, False otherwise
 
         """
-        pass
+        if self.rebalancing_frequency is None:
+            raise Exception('Please override `is_market_timing`, or declare a `rebalancing_frequency`')
+        # counted on the sessions the simulation walks, those of the universe matrix
+        sessions = get_universe_calendar().sessions_between(portfolio.last_rebalancing_day, portfolio.date)
+        return len(sessions) - 1 >= self.rebalancing_frequency.value
 
     def historical_simulation(self, starting_date: datetime, ending_date: datetime, starting_capital: float,
                               include_slippage: bool = False, include_capital_gains_tax: bool = False,
-                              commission: int = 2):
-        results = []
-        portfolio = Portfolio(assets=[], balance=starting_capital, trades=[], date=starting_date)
-
-        # First, populate stock returns universe
-        securities_universe_prices_df = pd.DataFrame()
-        for stock in os.listdir(path=config.STOCK_PRICES_DIR_PATH):
-            ticker = stock.strip('.pkl')
-            series = pd.read_pickle(os.path.join(config.STOCK_PRICES_DIR_PATH, stock))['Adj Close']
-
-            dummy_dates = pd.date_range(start=series.index[0], end=series.index[-1])
-            zeros_dummy = pd.Series(data=np.zeros(shape=len(dummy_dates)).fill(np.nan),
-                                    index=dummy_dates, name='Dummy', dtype='float64')
-
-            series = pd.concat([series, zeros_dummy], axis=1).iloc[:, 0]
-            securities_universe_prices_df[ticker] = series.ffill()
-
-        securities_universe_returns_df = securities_universe_prices_df.pct_change()
-
-        for date in pd.date_range(start=starting_date, end=ending_date):
-            portfolio.date = datetime(year=date.year, month=date.month, day=date.day)
-
-            for trade in portfolio.trades:  # update portfolio float
-                date_loc = trade.stock.index.get_loc(date - timedelta(seconds=1))
+                              commission: int = 2, engine: str = 'event', verbose: bool = True,
+                              checkpoint_path: str = None, checkpoint_every: int = 21,
+                              close_last_session: bool = False):
+        """
 
-                daily_pct_return = (trade.stock.iloc[date_loc] - trade.stock.iloc[date_loc - 1]) \
-                                   / trade.stock.iloc[date_loc - 1]
+        :param starting_date:
+        :param ending_date:
+        :param starting_capital:
+        :param include_slippage:
+        :param include_capital_gains_tax:
+        :param commission:
+        :param engine:  'event' walks the open trades every day to mark them to market.
+                        'vectorized' keeps positions as a numpy array indexed by ticker id, and marks them to market
+                        with one dot product per day against the universe matrix. Strategy callbacks other than
+                        `is_market_timing` only run on rebalancing days. Both produce the same `evolution_df`.
+        :param verbose: plot and print the evolution of the portfolio
+        :param checkpoint_path: file to snapshot the simulation to, every `checkpoint_every` simulated dates and at
+            the end. If it already holds a snapshot of the same run (same strategy and parameters, see
+            `_run_parameters`, and same arguments but `ending_date`), the simulation resumes from it: an interrupted
+            run picks up where it stopped, and a finished run is extended to the new `ending_date` by simulating only
+            the dates after its last one.
+        :param checkpoint_every: number of simulated dates between two snapshots
+        :param close_last_session: also record the last session of the run in the `evolution_df` when it is not a
+            rebalancing date, so that the performance since the last rebalancing is reported (e.g. when scoring
+            windows shorter than the rebalancing frequency)
+        :return:
+        """
+        # First, map the aligned universe prices and returns (built once, refreshed as new bars land)
+        universe_matrix = get_universe_matrix()
+        if universe_matrix is None:
+            raise Exception('No prices to simulate on. Please populate {} first.'.format(config.STOCK_PRICES_DIR_PATH))
+        if engine not in ['event', 'vectorized']:
+            raise Exception("Please enter a valid `engine`, either 'event' or 'vectorized'")
+
+        run = {'strategy': '{}.{}'.format(self.__class__.__module__, self.__class__.__qualname__),
+               'parameters': self._run_parameters(), 'starting_date': pd.Timestamp(starting_date),
+               'starting_capital': starting_capital, 'include_slippage': include_slippage,
+               'include_capital_gains_tax': include_capital_gains_tax, 'engine': engine, 'commission': commission}
+        checkpoint = SimulationCheckpoint.load(checkpoint_path) if checkpoint_path is not None else None
+        if checkpoint is not None:
+            if checkpoint.run != run:
+                raise Exception('The checkpoint at {} was taken for another run: {}'.format(checkpoint_path,
+                                                                                           checkpoint.run))
+            portfolio, results = checkpoint.restore_portfolio(), checkpoint.results
+            if portfolio.positions.tickers[:len(universe_matrix.tickers)] != universe_matrix.tickers.to_list():
+                portfolio.positions = portfolio.positions.reindex(universe_matrix.tickers)
+        else:
+            portfolio, results = Portfolio(assets=[], balance=starting_capital, date=starting_date,
+                                           positions=PositionLedger(tickers=universe_matrix.tickers)), []
+
+        def save_checkpoint():
+            SimulationCheckpoint.from_portfolio(run=run, portfolio=portfolio, results=results).save(checkpoint_path)
+
+        dates, rows, scheduled, start = self._simulation_dates(
+            universe_matrix=universe_matrix, starting_date=starting_date, ending_date=ending_date,
+            resume_after=checkpoint.last_date if checkpoint is not None else None)
+        simulation = self._event_driven_simulation if engine == 'event' else self._vectorized_simulation
+        for i in simulation(portfolio=portfolio, universe_matrix=universe_matrix, dates=dates, rows=rows,
+                            scheduled=scheduled, start=start, results=results, commission=commission):
+            if checkpoint_path is not None and ((i - start + 1) % checkpoint_every == 0 or i == len(dates) - 1):
+                save_checkpoint()
+
+        if close_last_session and results[-1][0] != dates[-1].strftime("%Y-%m-%d"):
+            results = results + [self._evolution_row(portfolio=portfolio, date=dates[-1])]
 
-                daily_doll_return = daily_pct_return * trade.stock.loc[date - timedelta(seconds=1)] * trade.shares
+        evolution_df = pd.DataFrame(results, columns=['Date', 'Holdings', 'Balance', 'Float'])
+        evolution_df.set_index('Date', inplace=True)
+        evolution_df['Cumulative (%) Return'] = evolution_df.filter(['Float']).pct_change().apply(
+            lambda x: x + 1).cumprod()
+        if verbose:
+            import matplotlib.pyplot as plt
+
+            plt.style.use('fivethirtyeight')
+            evolution_df['Float'].plot(grid=True, figsize=(10, 6))
+            plt.show()
+            with pd.option_context('display.max_rows', None, 'display.max_columns', None):
+                print(evolution_df.to_string())
+        return evolution_df
 
-                portfolio.float = portfolio.float + daily_doll_return if trade.direction \
-                    else portfolio.float - daily_doll_return
+    def _run_parameters(self) -> typing.Dict:
+        """
+        Parameters of the strategy that identify a run: its public attributes other than methods (e.g. the screening
+        and allocation callbacks a `FoldCache` installs). They are compared with `==` when resuming a checkpoint, so
+        state that does not define the run belongs in attributes prefixed with an underscore.
+        """
+        return {name: value for name, value in vars(self).items() if not name.startswith('_') and not callable(value)}
 
-            if not (self.is_market_timing(portfolio=portfolio) or date == starting_date):
-                continue
+    def _rebalance(self, portfolio: Portfolio, date: datetime, row: int, universe_matrix: UniverseMatrix,
+                   commission):
+        """
+        Screen, allocate and trade on a rebalancing day.
 
-            portfolio.last_rebalancing_day = date  # rebalancing day, now can go on:
+        :param row: row of the universe matrix holding the closing prices the trades are made at (the day before)
+        :return: the row of the `evolution_df` for that day
+        """
+        portfolio.last_rebalancing_day = date  # rebalancing day, now can go on:
+        with ReadMemo():  # the screens of one day read the same entries and prices over and over
             stocks_to_trade = self.screen_stocks(current_date=portfolio.date)
-            long_stocks, short_stocks = stocks_to_trade
+        long_stocks, short_stocks = stocks_to_trade
+        if self.securities_universe is not None:
+            membership = get_index_membership(self.securities_universe.value)
+            long_stocks = [stock for stock in long_stocks if membership.is_member(stock, portfolio.date)]
+            short_stocks = [stock for stock in short_stocks if membership.is_member(stock, portfolio.date)]
+
+        for stock in portfolio.positions:  # close portfolio positions that no longer meet condition
+            if stock not in long_stocks + short_stocks:
+                portfolio.make_position(stock, direction=portfolio.positions.direction(stock),
+                                        shares=abs(portfolio.positions.shares(stock)),
+                                        price=universe_matrix.ffilled_prices[row, universe_matrix.ticker_ids(stock)[0]],
+                                        entry=False, commission=commission)
+
+        # Get portfolio returns of selected stocks up to current date, and optimize portfolio allocation
+        portfolio.df_returns = universe_matrix.frame('returns', tickers=long_stocks, to_date=date)
+        weights = self.portfolio_allocation_regime(portfolio=portfolio)
+
+        closing_date = universe_matrix.dates[row]
+        portfolio.rebalance_portfolio(long_stocks=universe_matrix.frame('ffilled_prices', tickers=long_stocks,
+                                                                        from_date=closing_date, to_date=closing_date),
+                                      short_stocks=universe_matrix.frame('ffilled_prices', tickers=short_stocks,
+                                                                         from_date=closing_date, to_date=closing_date),
+                                      weights=weights, commission=commission,
+                                      fractional_shares=self.fractional_shares)
+
+        return self._evolution_row(portfolio=portfolio, date=date)
+
+    @staticmethod
+    def _evolution_row(portfolio: Portfolio, date: datetime):
+        return [date.strftime("%Y-%m-%d"), portfolio.positions.holdings(), round(portfolio.balance, 2),
+                round(portfolio.float, 2)]
+
+    def _simulation_dates(self, universe_matrix: UniverseMatrix, starting_date: datetime, ending_date: datetime,
+                          resume_after: datetime = None):
+        """
+        Dates the engines visit: every trading session of the universe matrix, or only the scheduled rebalancing
+        sessions (and the last session, to close the run) if the strategy declared a `rebalancing_frequency`. Each date
+        is marked to market with the bars up to the day before (stamped at 23:59:59), so the rows of the universe
+        matrix skipped between two dates are applied in bulk.
+
+        :param resume_after: last date already simulated, if resuming a run
+        :return: (dates, matrix rows of the dates, boolean array of the scheduled rebalancing dates or None if
+            the strategy times the market itself, index of the first date to simulate)
+        """
+        sessions = get_universe_calendar(universe_matrix).sessions_between(starting_date, ending_date)
+        if len(sessions) == 0:
+            raise Exception('There are no trading sessions between {} and {}'.format(starting_date, ending_date))
+        if resume_after is not None and pd.Timestamp(resume_after) > sessions[-1]:
+            raise Exception('The run was already simulated up to {}, after {}'.format(resume_after, ending_date))
+
+        if self.rebalancing_frequency is None:
+            dates, scheduled_dates = sessions, None
+        else:
+            scheduled_dates = sessions[::self.rebalancing_frequency.value]
+            dates = scheduled_dates.union(sessions[-1:])
+        if resume_after is not None:
+            dates = dates.union(pd.DatetimeIndex([resume_after]))
+        scheduled = dates.isin(scheduled_dates) if scheduled_dates is not None else None
+        start = 0 if resume_after is None else dates.get_loc(pd.Timestamp(resume_after)) + 1
+        rows = np.maximum(universe_matrix.dates.searchsorted(dates - timedelta(seconds=1), side='right') - 1, 0)
+        return dates, rows, scheduled, start
+
+    def _is_rebalancing_date(self, portfolio: Portfolio, i: int, scheduled: np.ndarray):
+        if i == 0:
+            return True
+        return scheduled[i] if scheduled is not None else self.is_market_timing(portfolio=portfolio)
+
+    def _event_driven_simulation(self, portfolio: Portfolio, universe_matrix: UniverseMatrix, dates: pd.DatetimeIndex,
+                                 rows: np.ndarray, scheduled: np.ndarray, start: int, results: typing.List,
+                                 commission):
+        """
+        Simulate `dates[start:]`, appending the rows of the rebalancing dates to `results`.
+
+        :return: generator of the index of each date, once simulated
+        """
+        for i in range(start, len(dates)):
+            date = dates[i]
+            portfolio.date = datetime(year=date.year, month=date.month, day=date.day)
+            previous_row = rows[i - 1] if i > 0 else rows[i]
 
-            for trade in portfolio.trades:  # close portfolio trades that no longer meet condition
-                if trade.stock.name not in long_stocks + short_stocks:
-                    portfolio.make_position(trade, entry=False)
+            for stock in portfolio.positions:  # update portfolio float with the bars since the previous date
+                ticker_id = universe_matrix.ticker_ids(stock)[0]
+                prices = universe_matrix.ffilled_prices[previous_row:rows[i] + 1, ticker_id]
+                daily_pct_returns = (prices[1:] - prices[:-1]) / prices[:-1]
+                doll_return = (daily_pct_returns * prices[1:]).sum() * portfolio.positions.shares(stock)
 
-            # Get portfolio returns of selected stocks up to current date, and optimize portfolio allocation
-            portfolio.df_returns = securities_universe_returns_df[long_stocks]
-            sliced_portfolio = portfolio.slice_dataframe(to_date=date, inplace=False)
-            weights = self.portfolio_allocation_regime(portfolio=sliced_portfolio)
+                portfolio.float = portfolio.float + doll_return
 
-            portfolio.rebalance_portfolio(long_stocks=securities_universe_prices_df[long_stocks],
-                                          short_stocks=securities_universe_prices_df[short_stocks],
-                                          weights=weights, commission=commission,
-                                          fractional_shares=self.fractional_shares)
+            if self._is_rebalancing_date(portfolio=portfolio, i=i, scheduled=scheduled):
+                results.append(self._rebalance(portfolio=portfolio, date=date, row=rows[i],
+                                               universe_matrix=universe_matrix, commission=commission))
+            yield i
 
-            # Aggregate trades for better formatting in the dataframe
-            dictionary = dict()
-            for trade in portfolio.trades:
-                dictionary[trade.stock.name] = dictionary.get(trade.stock.name, 0) + trade.shares
+    def _vectorized_simulation(self, portfolio: Portfolio, universe_matrix: UniverseMatrix, dates: pd.DatetimeIndex,
+                               rows: np.ndarray, scheduled: np.ndarray, start: int, results: typing.List,
+                               commission):
+        """
+        Simulate `dates[start:]`, appending the rows of the rebalancing dates to `results`.
 
-            aggregated_trades = [(key, val) for (key, val) in dictionary.items()]
-            results.append([date.strftime("%Y-%m-%d"), aggregated_trades,
-                            round(portfolio.balance, 2), round(portfolio.float, 2)])
+        :return: generator of the index of each date, once simulated
+        """
+        scheduled_indices = np.flatnonzero(scheduled) if scheduled is not None else None
+
+        def mark_to_market(i):
+            # positions only change on rebalancing dates, so mark the dates after the i-th one to market at once, up to
+            # the next scheduled rebalancing date (the next date if the strategy times the market itself): the daily
+            # dollar move of a position is its return times its closing price times its shares
+            if scheduled_indices is None:
+                stop = min(i + 1, len(dates) - 1)
+            else:
+                following = scheduled_indices[scheduled_indices > i]
+                stop = following[0] if len(following) > 0 else len(dates) - 1
+            positions = portfolio.positions.signed_shares()  # the ledger's ticker ids are the universe matrix's
+            float_moves = np.zeros(stop - i + 1)  # relative to the i-th date
+            held_ids = np.flatnonzero(positions)
+            if held_ids.size > 0 and stop > i:
+                held_rows = np.ix_(np.arange(rows[i] + 1, rows[stop] + 1), held_ids)
+                dollar_moves = universe_matrix.returns[held_rows] * universe_matrix.ffilled_prices[held_rows]
+                cumulative_moves = np.concatenate([[0], np.cumsum(dollar_moves.dot(positions[held_ids]))])
+                float_moves[1:] = cumulative_moves[rows[i + 1:stop + 1] - rows[i]]
+            return i, portfolio.float, float_moves
+
+        marked_from, base_float, float_moves = start - 1, portfolio.float, np.zeros(1)
+        for i in range(start, len(dates)):
+            date = dates[i]
+            portfolio.date = datetime(year=date.year, month=date.month, day=date.day)
+            if i > 0:
+                if i - marked_from >= len(float_moves):  # past the dates marked so far
+                    marked_from, base_float, float_moves = mark_to_market(i - 1)
+                portfolio.float = base_float + float_moves[i - marked_from]
 
-        evolution_df = pd.DataFrame(results, columns=['Date', 'Holdings', 'Balance', 'Float'])
-        evolution_df.set_index('Date', inplace=True)
-        evolution_df['Cumulative (%) Return'] = evolution_df.filter(['Float']).pct_change().apply(
-            lambda x: x + 1).cumprod()
-        evolution_df['Float'].plot(grid=True, figsize=(10, 6))
-        plt.show()
-        with pd.option_context('display.max_rows', None, 'display.max_columns', None):
-            print(evolution_df.to_string())
-        return evolution_df
+            if self._is_rebalancing_date(portfolio=portfolio, i=i, scheduled=scheduled):
+                results.append(self._rebalance(portfolio=portfolio, date=date, row=rows[i],
+                                               universe_matrix=universe_matrix, commission=commission))
+                marked_from, base_float, float_moves = mark_to_market(i)
+            yield i
 
     def broker_deployment(self, broker):
         """
@@ -180,8 +357,8 @@ class Strategy(metaclass=abc.ABCMeta):
         # TODO long for now, improve optimization to include diff constraints
         weights = self.portfolio_allocation_regime(portfolio=Portfolio(assets_to_long))
         broker.place_order(symbol='AAPL', side='buy')
-        current_positions = broker.list_positions()
-        for position in current_positions:
+        current_positions = PositionLedger.from_broker(broker)
+        for position in current_positions.holdings():
             print(position)
         broker.place_order()
 
@@ -219,7 +396,8 @@ class Strategy(metaclass=abc.ABCMeta):
 if __name__ == '__main__':
     # some imports for minimal example
     from matilda import piotroski_f_score, earnings_per_share, return_on_equity, FactorModels, \
-        EquallyWeightedPortfolio, AlpacaBroker
+        EquallyWeightedPortfolio
+    from matilda.broker_deployment.alpaca import AlpacaBroker
     from matilda.metrics_helpers import mean_metric_growth_rate, compare_against_macro
 
     # initialize stock screener with an initial universe of Dow Jones stocks
@@ -0,0 +1,190 @@
+"""
+Book of the open positions of a portfolio.
+
+Positions are keyed by ticker id, and the net signed shares of every ticker live in one numpy array, so looking up
+or aggregating a position is O(1), and the whole book can be handed to a vectorized computation as one vector.
+Each position also keeps its lots (shares, entry price, entry date) in arrays consumed from the front, so that exits
+are FIFO and cost O(lots exited).
+"""
+
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+
+class Lots:
+    __slots__ = ('shares', 'prices', 'dates', 'start', 'stop')
+
+    def __init__(self, capacity: int = 4):
+        self.shares = np.zeros(capacity)
+        self.prices = np.zeros(capacity)
+        self.dates = np.zeros(capacity, dtype='datetime64[s]')
+        self.start = 0  # first open lot
+        self.stop = 0  # one past the last open lot
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def append(self, shares: float, price: float, date: datetime):
+        if self.stop == len(self.shares):
+            # compact the consumed lots away, and double the capacity if still full
+            count = len(self)
+            capacity = len(self.shares) if count < len(self.shares) // 2 else 2 * len(self.shares)
+            for name in ('shares', 'prices', 'dates'):
+                array = getattr(self, name)
+                resized = np.zeros(capacity, dtype=array.dtype)
+                resized[:count] = array[self.start:self.stop]
+                setattr(self, name, resized)
+            self.start, self.stop = 0, count
+        self.shares[self.stop] = shares
+        self.prices[self.stop] = price
+        self.dates[self.stop] = np.datetime64(date, 's')
+        self.stop += 1
+
+    def consume(self, shares: float) -> float:
+        """
+        Exit `shares` shares, oldest lots first.
+
+        :return: the number of shares actually exited, at most the number of shares held
+        """
+        exited = 0
+        while self.start < self.stop and shares - exited > 0:
+            taken = min(self.shares[self.start], shares - exited)
+            self.shares[self.start] -= taken
+            exited += taken
+            if self.shares[self.start] <= 0:
+                self.start += 1
+        return exited
+
+
+class PositionLedger:
+    def __init__(self, tickers=None):
+        """
+        :param tickers: optional ticker axis (e.g. the universe matrix's) fixing the ids of the tickers.
+            Tickers outside of it get new ids as they are traded.
+        """
+        self.tickers = [] if tickers is None else list(tickers)
+        self.ticker_ids = {ticker: ticker_id for ticker_id, ticker in enumerate(self.tickers)}
+        self.net_shares = np.zeros(max(len(self.tickers), 16))  # signed: positive if long, negative if short
+        self.lots = {}  # ticker id -> `Lots`
+
+    def __len__(self):
+        return len(self.lots)
+
+    def __contains__(self, ticker):
+        return ticker in self.ticker_ids and self.ticker_ids[ticker] in self.lots
+
+    def __iter__(self):
+        """
+        Tickers with an open position.
+        """
+        return iter([self.tickers[ticker_id] for ticker_id in self.lots])
+
+    def ticker_id(self, ticker: str) -> int:
+        if ticker not in self.ticker_ids:
+            self.ticker_ids[ticker] = len(self.tickers)
+            self.tickers.append(ticker)
+            if len(self.tickers) > len(self.net_shares):
+                self.net_shares = np.concatenate([self.net_shares, np.zeros(len(self.net_shares))])
+        return self.ticker_ids[ticker]
+
+    def shares(self, ticker: str) -> float:
+        """
+        Signed number of shares held: positive if long, negative if short, 0 if not held.
+        """
+        return self.net_shares[self.ticker_ids[ticker]] if ticker in self.ticker_ids else 0
+
+    def direction(self, ticker: str):
+        """
+        True if long, False if short, None if not held.
+        """
+        shares = self.shares(ticker)
+        return None if shares == 0 else bool(shares > 0)
+
+    def enter(self, ticker: str, direction: bool, shares: float, price: float, date: datetime):
+        """
+        Add a lot to a position. A ticker is held in one direction at a time.
+        """
+        ticker_id = self.ticker_id(ticker)
+        if ticker_id in self.lots and (self.net_shares[ticker_id] > 0) != direction:
+            raise Exception('{} is held {}, please exit it before entering the other direction'.format(
+                ticker, 'long' if direction is False else 'short'))
+        if ticker_id not in self.lots:
+            self.lots[ticker_id] = Lots()
+        self.lots[ticker_id].append(shares=shares, price=price, date=date)
+        self.net_shares[ticker_id] += shares if direction else -shares
+
+    def exit(self, ticker: str, direction: bool, shares: float) -> float:
+        """
+        Exit (part of) a position, oldest lots first.
+
+        :return: the number of shares actually exited, 0 if `ticker` is not held in that `direction`
+        """
+        if self.direction(ticker) is not direction:
+            return 0
+        ticker_id = self.ticker_ids[ticker]
+        held = abs(self.net_shares[ticker_id])
+        lots = self.lots[ticker_id]
+        exited = held if shares >= held else lots.consume(shares)
+        if shares >= held or len(lots) == 0:
+            del self.lots[ticker_id]
+            self.net_shares[ticker_id] = 0
+        else:  # re-sum the lots left rather than subtracting, so that rounding never flips the sign
+            remaining = lots.shares[lots.start:lots.stop].sum()
+            self.net_shares[ticker_id] = remaining if direction else -remaining
+        return exited
+
+    def holdings(self):
+        """
+        :return: list of (ticker, shares) of the open positions, shares being unsigned
+        """
+        return [(self.tickers[ticker_id], abs(self.net_shares[ticker_id])) for ticker_id in self.lots]
+
+    def signed_shares(self, tickers: pd.Index = None) -> np.ndarray:
+        """
+        Net signed shares aligned on `tickers` (by default, the ledger's own ticker axis). Tickers that are not held,
+        or unknown to the ledger, get 0.
+        """
+        if tickers is None:
+            return self.net_shares[:len(self.tickers)].copy()
+        ids = np.array([self.ticker_ids.get(ticker, -1) for ticker in tickers], dtype=int)
+        return np.where(ids >= 0, self.net_shares[ids], 0)
+
+    def lots_frame(self, ticker: str) -> pd.DataFrame:
+        """
+        Open lots of a position, oldest first.
+        """
+        if ticker not in self:
+            return pd.DataFrame(columns=['Shares', 'Price'])
+        lots = self.lots[self.ticker_ids[ticker]]
+        window = slice(lots.start, lots.stop)
+        return pd.DataFrame({'Shares': lots.shares[window], 'Price': lots.prices[window]},
+                            index=pd.DatetimeIndex(lots.dates[window]))
+
+    def reindex(self, tickers):
+        """
+        Same positions, on another ticker axis (e.g. after the universe matrix was rebuilt with new tickers).
+        """
+        ledger = PositionLedger(tickers=tickers)
+        for ticker_id, lots in self.lots.items():
+            new_ticker_id = ledger.ticker_id(self.tickers[ticker_id])
+            ledger.lots[new_ticker_id] = lots
+            ledger.net_shares[new_ticker_id] = self.net_shares[ticker_id]
+        return ledger
+
+    @classmethod
+    def from_broker(cls, broker, date: datetime = None):
+        """
+        Ledger of the positions currently open at a broker, one lot per position at its average entry price.
+
+        :param broker: `Broker` whose `list_positions` returns objects with `symbol`, `qty`, `side` ('long' or
+            'short') and `avg_entry_price` attributes, like Alpaca's
+        :param date: entry date given to the lots, by default now
+        """
+        date = datetime.now() if date is None else date
+        ledger = cls()
+        for position in broker.list_positions():
+            ledger.enter(ticker=position.symbol, direction=position.side == 'long', shares=abs(float(position.qty)),
+                         price=float(position.avg_entry_price), date=date)
+        return ledger
@@ -0,0 +1,82 @@
+"""
+Snapshots of a running `Strategy.historical_simulation`, to resume it after an interruption or extend it to a later
+ending date without replaying the days it already simulated.
+"""
+
+import os
+import pickle
+import typing
+from datetime import datetime
+
+import pandas as pd
+
+from matilda.portfolio_management.Portfolio import Portfolio
+
+CHECKPOINT_VERSION = 2
+
+
+class SimulationCheckpoint:
+    def __init__(self, run: typing.Dict, last_date: datetime, balance: float, float_: float,
+                 last_rebalancing_day: datetime, positions, results: typing.List, df_returns: pd.DataFrame = None):
+        """
+        :param run: what identifies the run (strategy, starting date and capital, engine...). A checkpoint can only
+            resume the run it was taken for.
+        :param last_date: last date simulated
+        :param balance: of the portfolio, at the end of `last_date`
+        :param float_: of the portfolio, at the end of `last_date`
+        :param last_rebalancing_day:
+        :param positions: `PositionLedger` of the portfolio
+        :param results: rows of the `evolution_df` so far
+        :param df_returns: of the portfolio, i.e. the returns its allocation was last optimized on
+        """
+        self.run = run
+        self.last_date = last_date
+        self.balance = balance
+        self.float = float_
+        self.last_rebalancing_day = last_rebalancing_day
+        self.positions = positions
+        self.results = results
+        self.df_returns = df_returns if df_returns is not None else pd.DataFrame()
+
+    @classmethod
+    def from_portfolio(cls, run: typing.Dict, portfolio: Portfolio, results: typing.List):
+        return cls(run=run, last_date=portfolio.date, balance=portfolio.balance, float_=portfolio.float,
+                   last_rebalancing_day=portfolio.last_rebalancing_day, positions=portfolio.positions,
+                   results=list(results), df_returns=portfolio.df_returns)
+
+    def restore_portfolio(self) -> Portfolio:
+        portfolio = Portfolio(assets=[], balance=self.balance, date=self.last_date, positions=self.positions)
+        portfolio.float = self.float
+        portfolio.last_rebalancing_day = self.last_rebalancing_day
+        portfolio.df_returns = self.df_returns
+        return portfolio
+
+    def save(self, path: str):
+        """
+        Written next to `path` then swapped in, so that an interruption while saving never corrupts the previous
+        checkpoint.
+        """
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as handle:
+            pickle.dump({'version': CHECKPOINT_VERSION, 'run': self.run, 'last_date': self.last_date,
+                         'balance': self.balance, 'float': self.float,
+                         'last_rebalancing_day': self.last_rebalancing_day, 'positions': self.positions,
+                         'results': self.results, 'df_returns': self.df_returns}, handle,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        :return: `SimulationCheckpoint`, or None if there is no checkpoint at `path`
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as handle:
+            state = pickle.load(handle)
+        if state['version'] != CHECKPOINT_VERSION:
+            raise Exception('Checkpoint at {} has version {}, expected {}. Please restart the simulation.'.format(
+                path, state['version'], CHECKPOINT_VERSION))
+        return cls(run=state['run'], last_date=state['last_date'], balance=state['balance'], float_=state['float'],
+                   last_rebalancing_day=state['last_rebalancing_day'], positions=state['positions'],
+                   results=state['results'], df_returns=state['df_returns'])
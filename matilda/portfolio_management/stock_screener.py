@@ -2,8 +2,11 @@ from datetime import datetime
 from functools import partial
 
 from matilda import companies_in_classification, config, price_to_earnings, earnings_per_share
+from matilda.data_pipeline.fundamentals_panel import FundamentalsPanel
+from matilda.data_pipeline.read_memo import ReadMemo
 from matilda.portfolio_management.Portfolio import Portfolio, TimeDataFrame
 from matilda.quantitative_analysis.risk_factor_modeling.asset_pricing_model import FactorModels
+import numpy as np
 import pandas as pd
 import inspect
 import typing
@@ -34,13 +37,15 @@ class StockScreener:
 
         :param securities_universe:     by default, we start with the S&P 500, due to current functionality.
                                         It stays constant throughout the `StockScreener`, which is why we
-                                        separate it from the `stocks` attribute.
+                                        separate it from the `stocks` attribute. An index is taken with its
+                                        constituents as of `date`, and of the date of each `run`.
         :param date: by default, now.
         '''
         if securities_universe is None:
-            securities_universe = companies_in_classification(class_=config.MarketIndices.SP_500)
-        elif not isinstance(securities_universe, list):
-            securities_universe = companies_in_classification(class_=securities_universe)
+            securities_universe = config.MarketIndices.SP_500
+        self.universe = securities_universe  # list of tickers, or classification resolved at each date
+        if not isinstance(securities_universe, list):
+            securities_universe = companies_in_classification(class_=securities_universe, date=date)
 
         self.securities_universe = securities_universe  # starting universe
         self.stocks = securities_universe
@@ -48,16 +53,18 @@ class StockScreener:
         self.conditions = []
         self.dataframe = pd.DataFrame()
 
+    @ReadMemo()
     def run(self, conditions=None, date: datetime = datetime.now()):
         """
-        Date setter. Reapply the conditions you applied so far, to any date
+        Date setter. Reapply the conditions you applied so far, to any date. Reads repeated by the conditions are
+        answered from memory.
 
         :param conditions:  list of tuples, the first element of which is the `filter` function, and the rest
                             being the arguments. By default, the conditions already applied by the `StockScreener` object.
         :param date: datetime to which we need to apply the conditions. By default, now.
         :return:
         """
-        new_screener = StockScreener(securities_universe=self.securities_universe, date=date)
+        new_screener = StockScreener(securities_universe=self.universe, date=date)
         if conditions is None:
             conditions = self.conditions
         for condition in conditions:
@@ -92,19 +99,30 @@ class StockScreener:
         self.conditions.append((StockScreener.filter_by_market, filter))
         return self.stocks
 
+    def panel_filter(self, condition: typing.Callable):
+        """
+        Evaluate a `helper_condition` for every stock at once, over a `FundamentalsPanel`. Metrics that only work on
+        one ticker (e.g. composite scores formatting their components, or comparisons against a classification) fail
+        on the panel, or do not return an array for it, and are then evaluated stock by stock.
+        """
+        panel = FundamentalsPanel(stocks=self.stocks, dates=self.date)
+        try:
+            passed = condition(panel, self.date)
+        except Exception:
+            passed = None
+        if not isinstance(passed, np.ndarray) or passed.dtype != bool:
+            return [stock for stock in self.stocks if condition(stock, self.date)]
+        passed = np.broadcast_to(passed, panel.shape)[0]
+        return [stock for stock, passed_ in zip(self.stocks, passed) if passed_]
+
     def filter_by_comparison_to_number(self, metric: partial, comparator: str, number: float):
-        stocks = []
-        for stock in self.stocks:
-            if helper_condition(metric, comparator, number)(stock, self.date):
-                stocks.append(stock)
-        self.stocks = stocks
+        self.stocks = self.panel_filter(helper_condition(metric, comparator, number))
         self.conditions.append((StockScreener.filter_by_comparison_to_number, metric, comparator, number))
 
         return self.stocks
 
     def filter_by_comparison_to_other_metric(self, metric: partial, comparator: str, other_metric: typing.Callable):
-        self.stocks = [stock for stock in self.stocks if
-                       helper_condition(metric, comparator, other_metric)(stock, self.date)]
+        self.stocks = self.panel_filter(helper_condition(metric, comparator, other_metric))
         self.conditions.append(
             partial(StockScreener.filter_by_comparison_to_other_metric, metric, comparator, other_metric))
         return self.stocks
@@ -134,7 +152,7 @@ class StockScreener:
         factor_model = factor_model.value(to_date=self.date)
 
         for stock in self.stocks:
-            regression = factor_model.regress_factor_loadings(portfolio=TimeDataFrame(stock),
+            regression = factor_model.regress_factor_loadings(portfolio=TimeDataFrame(stock, to_date=self.date),
                                                               benchmark_returns=benchmark_returns,
                                                               regression_window=regression_period, rolling=False,
                                                               show=False)
@@ -0,0 +1,212 @@
+"""
+Walk-forward optimization of a strategy.
+
+The trading sessions are cut into folds: each fold picks, among a grid of parameters, the ones that performed best on a
+trailing in-sample window, then trades them on the out-of-sample window that follows. Folds only depend on the data,
+so they run concurrently in a process pool.
+
+Overlapping in-sample windows screen and allocate on the same dates with the same parameters, so the results of
+`screen_stocks` and `portfolio_allocation_regime` are cached on disk, in a `FoldCache` shared by all the workers. They
+are namespaced by the versions of the prices and fundamentals, and by the source code of the strategy, so that they
+are computed again once any of them changed.
+"""
+
+import hashlib
+import inspect
+import itertools
+import os
+import pickle
+import typing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+
+from matilda import config
+from matilda.data_pipeline.fundamentals_cube import get_fundamentals_cube
+from matilda.data_pipeline.trading_calendar import get_universe_calendar
+from matilda.data_pipeline.universe_matrix import get_universe_matrix
+from matilda.portfolio_management.parameter_sweep import parameter_grid, summary_statistics
+
+
+class FoldCache:
+    def __init__(self, path: str = config.WALK_FORWARD_CACHE_DIR_PATH, namespace: str = ''):
+        """
+        Pickled results, one file per key. Files are written next to their final name then swapped in, so that
+        concurrent workers computing the same key never read a half-written file.
+
+        :param path: directory of the cache
+        :param namespace: prefixed to every key, e.g. the version of the data the results were computed on
+        """
+        self.path = path
+        self.namespace = namespace
+        self.hits, self.misses = 0, 0
+        os.makedirs(path, exist_ok=True)
+
+    def file_path(self, key) -> str:
+        digest = hashlib.sha1(repr((self.namespace, key)).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, '{}.pkl'.format(digest))
+
+    def get_or_compute(self, key, compute: typing.Callable):
+        file_path = self.file_path(key)
+        if os.path.exists(file_path):
+            self.hits += 1
+            with open(file_path, 'rb') as handle:
+                return pickle.load(handle)
+        self.misses += 1
+        value = compute()
+        temp_path = '{}.{}.tmp'.format(file_path, os.getpid())
+        with open(temp_path, 'wb') as handle:
+            pickle.dump(value, handle)
+        os.replace(temp_path, file_path)
+        return value
+
+
+def strategy_key(strategy_factory: typing.Callable, parameters: typing.Dict):
+    return '{}.{}'.format(strategy_factory.__module__, strategy_factory.__qualname__), sorted(parameters.items())
+
+
+def cache_namespace(strategy_factory: typing.Callable, strategy) -> str:
+    """
+    What the cached results of a strategy depend on besides their key: the versions of the universe matrix and of
+    the fundamentals cube they were computed on (the cube is rebuilt as filings land), and the source code of the
+    strategy, of its base classes and of its factory.
+
+    :param strategy: an instance returned by `strategy_factory`
+    """
+    sources = []
+    for obj in [strategy_factory] + [cls for cls in type(strategy).__mro__ if cls is not object]:
+        try:
+            sources.append(inspect.getsource(obj))
+        except (OSError, TypeError):  # e.g. defined in an interactive session, fall back on its name
+            sources.append('{}.{}'.format(obj.__module__, obj.__qualname__))
+    cube = get_fundamentals_cube()
+    return '{}-{}-{}'.format(get_universe_matrix().version, cube.version if cube is not None else None,
+                             hashlib.sha1('\n'.join(sources).encode('utf-8')).hexdigest())
+
+
+def cached_strategy(strategy_factory: typing.Callable, parameters: typing.Dict, cache: FoldCache):
+    """
+    Instantiate the strategy, with its screening and allocation served from `cache` when the same parameters already
+    screened or allocated on that date.
+    """
+    strategy = strategy_factory(**parameters)
+    key = strategy_key(strategy_factory, parameters)
+    screen_stocks, portfolio_allocation_regime = strategy.screen_stocks, strategy.portfolio_allocation_regime
+
+    def cached_screen_stocks(current_date):
+        return cache.get_or_compute((key, 'screen_stocks', pd.Timestamp(current_date).isoformat()),
+                                    lambda: screen_stocks(current_date=current_date))
+
+    def cached_portfolio_allocation_regime(portfolio):
+        # the portfolio is the universe's returns of the screened stocks up to the rebalancing date
+        returns = portfolio.df_returns
+        last_date = returns.index[-1].isoformat() if len(returns) > 0 else None
+        return cache.get_or_compute((key, 'portfolio_allocation_regime', last_date, list(returns.columns)),
+                                    lambda: portfolio_allocation_regime(portfolio=portfolio))
+
+    strategy.screen_stocks = cached_screen_stocks
+    strategy.portfolio_allocation_regime = cached_portfolio_allocation_regime
+    return strategy
+
+
+def walk_forward_folds(starting_date: datetime, ending_date: datetime, in_sample_sessions: int,
+                       out_of_sample_sessions: int) -> typing.List[typing.Tuple[pd.DatetimeIndex, pd.DatetimeIndex]]:
+    """
+    Cut the trading sessions between `starting_date` and `ending_date` into rolling folds. The in-sample window of the
+    first fold starts on `starting_date`, and each next fold moves forward by `out_of_sample_sessions`.
+
+    :return: list of (in-sample sessions, out-of-sample sessions)
+    """
+    sessions = get_universe_calendar().sessions_between(starting_date, ending_date)
+    folds = []
+    for start in range(0, len(sessions) - in_sample_sessions, out_of_sample_sessions):
+        in_sample = sessions[start:start + in_sample_sessions]
+        out_of_sample = sessions[start + in_sample_sessions:start + in_sample_sessions + out_of_sample_sessions]
+        folds.append((in_sample, out_of_sample))
+    return folds
+
+
+def _run_fold(strategy_factory: typing.Callable, grid: typing.Dict, fold: typing.Tuple, objective: str,
+              cache_path: str, namespace: str, simulation_kwargs: typing.Dict):
+    in_sample, out_of_sample = fold
+    cache = FoldCache(path=cache_path, namespace=namespace)
+
+    # re-fit the parameters on the in-sample window
+    in_sample_summaries = []
+    for parameters in parameter_grid(grid):
+        strategy = cached_strategy(strategy_factory, parameters, cache)
+        evolution_df = strategy.historical_simulation(starting_date=in_sample[0], ending_date=in_sample[-1],
+                                                      verbose=False, **simulation_kwargs)
+        in_sample_summaries.append(summary_statistics(evolution_df))
+    best = max(range(len(in_sample_summaries)), key=lambda i: in_sample_summaries[i][objective])
+    parameters = parameter_grid(grid)[best]
+
+    # then trade them on the out-of-sample window
+    strategy = cached_strategy(strategy_factory, parameters, cache)
+    evolution_df = strategy.historical_simulation(starting_date=out_of_sample[0], ending_date=out_of_sample[-1],
+                                                  verbose=False, **simulation_kwargs)
+    return parameters, in_sample_summaries[best][objective], evolution_df, cache.hits, cache.misses
+
+
+def walk_forward_optimization(strategy_factory: typing.Callable, grid: typing.Dict[str, typing.List],
+                              starting_date: datetime, ending_date: datetime, starting_capital: float,
+                              in_sample_sessions: int = 252, out_of_sample_sessions: int = 63,
+                              objective: str = 'Total Return', processes: int = None,
+                              cache_path: str = config.WALK_FORWARD_CACHE_DIR_PATH, **simulation_kwargs):
+    """
+    >>> folds_df, evolution_df = walk_forward_optimization(CustomStrategy, grid={
+    ...     'max_stocks_count_in_portfolio': [10, 20], 'net_exposure': [(100, 0)],
+    ...     'rebalancing_frequency': [RebalancingFrequency.Monthly, RebalancingFrequency.Quarterly]},
+    ...     starting_date=datetime(2015, 1, 1), ending_date=datetime(2020, 12, 1), starting_capital=50000)
+
+    :param strategy_factory: `Strategy` subclass, or any picklable callable returning a `Strategy` from keyword
+        parameters
+    :param grid: {parameter name: list of values to try}
+    :param starting_date: first in-sample session
+    :param ending_date: last out-of-sample session
+    :param starting_capital: capital each fold starts trading with, in and out of sample
+    :param in_sample_sessions: length of the window the parameters are fitted on, in trading sessions
+    :param out_of_sample_sessions: length of the window they are then traded on, in trading sessions
+    :param objective: column of `summary_statistics` maximized in sample
+    :param processes: size of the process pool, by default the number of CPUs. 1 runs every fold in this process.
+    :param cache_path: directory of the `FoldCache`
+    :param simulation_kwargs: other arguments of `Strategy.historical_simulation`, e.g. `commission` or `engine`
+    :return: tuple of two tidy dataframes, both with a 'Fold' column:
+        * one row per fold: its windows, the fitted parameters, their in-sample objective, their out-of-sample summary
+          statistics, and the cache hits and misses of the fold,
+        * the out-of-sample evolution curves.
+    """
+    # build the matrix here if needed, so that the workers only have to map it
+    if get_universe_matrix() is None:
+        raise Exception('No prices to simulate on. Please populate {} first.'.format(config.STOCK_PRICES_DIR_PATH))
+    folds = walk_forward_folds(starting_date=starting_date, ending_date=ending_date,
+                               in_sample_sessions=in_sample_sessions, out_of_sample_sessions=out_of_sample_sessions)
+    if len(folds) == 0:
+        raise Exception('There are not enough trading sessions between {} and {} for an in-sample window of {} '
+                        'sessions'.format(starting_date, ending_date, in_sample_sessions))
+
+    # every window is closed on its last session, so that windows shorter than the rebalancing frequency are scored
+    simulation_kwargs = dict(simulation_kwargs, starting_capital=starting_capital, close_last_session=True)
+    namespace = cache_namespace(strategy_factory, strategy_factory(**parameter_grid(grid)[0]))
+    arguments = [itertools.repeat(strategy_factory), itertools.repeat(grid), folds, itertools.repeat(objective),
+                 itertools.repeat(cache_path), itertools.repeat(namespace), itertools.repeat(simulation_kwargs)]
+    if processes == 1:
+        outputs = list(map(_run_fold, *arguments))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            outputs = list(executor.map(_run_fold, *arguments))
+
+    rows = []
+    for (in_sample, out_of_sample), (parameters, in_sample_objective, evolution_df, hits, misses) in zip(folds, outputs):
+        row = {'In-Sample Start': in_sample[0], 'In-Sample End': in_sample[-1],
+               'Out-of-Sample Start': out_of_sample[0], 'Out-of-Sample End': out_of_sample[-1]}
+        row.update(parameters)
+        row['In-Sample {}'.format(objective)] = in_sample_objective
+        row.update(summary_statistics(evolution_df).add_prefix('Out-of-Sample ').to_dict())
+        row.update({'Cache Hits': hits, 'Cache Misses': misses})
+        rows.append(row)
+    folds_df = pd.DataFrame(rows).rename_axis('Fold').reset_index()
+    evolution_df = pd.concat({fold: output[2] for fold, output in enumerate(outputs)},
+                             names=['Fold', 'Date']).reset_index()
+    return folds_df, evolution_df
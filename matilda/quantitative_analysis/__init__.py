@@ -1,3 +1,5 @@
-from matilda.quantitative_analysis.portfolio_optimization import *
-from matilda.quantitative_analysis.risk_factor_modeling import *
-from matilda.quantitative_analysis.risk_quantification import *
+from matilda.lazy_imports import lazy_star_imports
+
+__getattr__ = lazy_star_imports(__name__, ['matilda.quantitative_analysis.portfolio_optimization',
+                                           'matilda.quantitative_analysis.risk_factor_modeling',
+                                           'matilda.quantitative_analysis.risk_quantification'])
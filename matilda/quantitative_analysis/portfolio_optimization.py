@@ -2,7 +2,6 @@ import abc
 import inspect
 from datetime import datetime
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import typing
@@ -204,6 +203,8 @@ class ModernPortfolioTheory(PortfolioAllocationModel):
 
         sharpe_arr = target_returns / minimal_volatilities
 
+        import matplotlib.pyplot as plt
+
         fig, ax = plt.subplots(figsize=(10, 10))
         plt.scatter(minimal_volatilities, target_returns, c=sharpe_arr, cmap='viridis')
         plt.colorbar(label='Sharpe Ratio')
@@ -317,6 +318,9 @@ class ModernPortfolioTheory(PortfolioAllocationModel):
 
         x = np.linspace(0, max(betas) + 0.1, 100)
         y = float(risk_free_rate) + x * float(risk_premium)
+
+        import matplotlib.pyplot as plt
+
         fig, ax = plt.subplots(figsize=(10, 10))
         plt.plot(x, y)
         ax.set_xlabel('Betas', fontsize=14)
@@ -418,7 +418,7 @@ class CustomAssetPricingModel(AssetPricingModel):
                  end_date: datetime, rebalancing_frequency: config.RebalancingFrequency):
         # super().__init__()
         self.factors = factors
-        self.asset_returns = Portfolio(assets=securities_universe).df_returns
+        self.asset_returns = Portfolio(assets=securities_universe, from_date=start_date, to_date=end_date).df_returns
         self.securities_universe = list(self.asset_returns.columns)
         self.start_date = start_date
         self.end_date = end_date
@@ -1,10 +1,8 @@
 import math
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy import stats
 from scipy.stats import norm
-from matilda.quantitative_analysis.risk_factor_modeling import CapitalAssetPricingModel
 
 '''
 Risk Deviation Measures
@@ -41,6 +39,8 @@ Value at Risk (VAR) quantifies the minimum loss over the whole range of outcomes
 
 # Historical Simulation: calculating daily portfolio changes in value to determine the probability distribution of returns.
 def value_at_risk_historical_simulation(portfolio_returns, confidence_level=0.05):
+    import matplotlib.pyplot as plt
+
     portfolio_returns = portfolio_returns.dropna()
     plt.hist(portfolio_returns, bins=40)
     plt.xlabel('Returns')
@@ -144,6 +144,8 @@ def drawdown_risk(portfolio_returns, trailing_period=252, max=False):
     max_daily_drawdown = daily_drawdown.rolling(trailing_period, min_periods=1).min()
 
     # Plot the results
+    import matplotlib.pyplot as plt
+
     daily_drawdown.plot()
     max_daily_drawdown.plot()
     plt.show()
@@ -273,6 +275,8 @@ def capm_beta(portfolio_returns, benchmark_returns=None):
     :param benchmark_returns: Pandas series representing percentage changes of the benchmark (i.e. S&P500) returns over time.
     :return:
     """
+    from matilda.quantitative_analysis.risk_factor_modeling import CapitalAssetPricingModel
+
     return CapitalAssetPricingModel(from_date=portfolio_returns.index[0], to_date=portfolio_returns.index[-1],
                                     factor_dataset=benchmark_returns) \
         .regress_factor_loadings(portfolio=portfolio_returns).params[1]
@@ -298,6 +302,8 @@ def jensens_alpha(portfolio_returns, benchmark_returns):
     :param benchmark_returns: Pandas series representing percentage changes of the benchmark (i.e. S&P500) returns over time.
     :return:
     """
+    from matilda.quantitative_analysis.risk_factor_modeling import CapitalAssetPricingModel
+
     return CapitalAssetPricingModel(from_date=portfolio_returns.index[0], to_date=portfolio_returns.index[-1],
                                     factor_dataset=benchmark_returns) \
         .regress_factor_loadings(portfolio=portfolio_returns).params[0]
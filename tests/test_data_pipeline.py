@@ -0,0 +1,508 @@
+import shutil
+import tempfile
+import unittest
+import os
+from datetime import datetime, timedelta
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from matilda import config
+from matilda.data_pipeline import object_model
+from matilda.data_pipeline import price_store as price_store_module
+from matilda.data_pipeline import read_cache as read_cache_module
+from matilda.data_pipeline import storage_backend as storage_backend_module
+from matilda.data_pipeline import universe_matrix as universe_matrix_module
+from matilda.data_pipeline.classification_table import ClassificationTable
+from matilda.data_pipeline.data_preparation_helpers import date_positions, date_slice, get_date_index
+from matilda.data_pipeline.db_crud import as_of_filing_values, populate_db_asset_prices, price_buckets, \
+    read_financial_statement_entry, rolled_filing_values
+from matilda.data_pipeline.fundamentals_cube import FundamentalsCube
+from matilda.data_pipeline.fundamentals_panel import FundamentalsPanel
+from matilda.data_pipeline.index_membership import IndexMembership
+from matilda.data_pipeline.price_store import PriceStore
+from matilda.data_pipeline.query_plans import execution_stats, plan_stages
+from matilda.data_pipeline.read_cache import ReadCache
+from matilda.data_pipeline.read_graph import ReadGraph
+from matilda.data_pipeline.read_memo import ReadMemo, memoized_read
+from matilda.data_pipeline.storage_backend import MongoBackend, SQLiteBackend, get_storage_backend, \
+    set_storage_backend
+from matilda.data_pipeline.TimeDataFrame import TimeDataFrame
+from matilda.data_pipeline.trading_calendar import TradingCalendar
+from matilda.data_pipeline.universe_matrix import UniverseMatrix
+
+
+class TestPriceStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'price_store')
+        dates = pd.date_range(start=datetime(2020, 1, 1), periods=6) + pd.Timedelta(days=1, seconds=-1)
+        self.frames = {
+            'AAPL': pd.DataFrame({'Open': np.arange(6.), 'Close': np.arange(6.) + 1,
+                                  'Adj Close': np.arange(6.) + 2}, index=dates),
+            'MSFT': pd.DataFrame({'Open': np.arange(3.), 'Close': np.arange(3.) + 10,
+                                  'Adj Close': np.arange(3.) + 20}, index=dates[2:5]),
+        }
+
+    def test_aligned_read(self):
+        store = PriceStore.from_frames(frames=self.frames, path=self.path)
+        self.assertEqual(len(store.dates), 6)
+        df = store.read(tickers=['MSFT', 'AAPL'], from_date=datetime(2020, 1, 3), to_date=datetime(2020, 1, 5))
+        self.assertEqual(list(df.columns), ['MSFT', 'AAPL'])
+        self.assertEqual(len(df), 2)  # the bar of the 5th is stamped at 23:59:59, after `to_date`
+        self.assertEqual(df['MSFT'].tolist(), [20., 21.])
+        self.assertEqual(df['AAPL'].tolist(), [4., 5.])
+
+    def test_read_ticker(self):
+        store = PriceStore.from_frames(frames=self.frames, path=self.path)
+        df = store.read_ticker('MSFT')
+        self.assertEqual(df.index.tolist(), self.frames['MSFT'].index.tolist())
+        self.assertEqual(df['Close'].tolist(), [10., 11., 12.])
+        self.assertTrue(df['Volume'].isna().all())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class TestUniverseMatrix(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        dates = pd.bdate_range(start=datetime(2020, 1, 1), periods=15) + pd.Timedelta(days=1, seconds=-1)
+        self.frames = {
+            'AAPL': pd.DataFrame({'Adj Close': np.linspace(100, 114, 15)}, index=dates),
+            # gap over the end of the first half, then resumes
+            'MSFT': pd.DataFrame({'Adj Close': [10., 11., 12., 13., 14.]}, index=dates[[0, 1, 2, 10, 11]]),
+            'FB': pd.DataFrame({'Adj Close': [50., 51.]}, index=dates[[4, 5]]),
+        }
+
+    def store(self, name, cutoff=None):
+        frames = {ticker: frame if cutoff is None else frame[frame.index < cutoff]
+                  for ticker, frame in self.frames.items()}
+        return PriceStore.from_frames(frames=frames, path=os.path.join(self.directory, name))
+
+    def test_build(self):
+        matrix = UniverseMatrix.build(price_store=self.store('full'), path=os.path.join(self.directory, 'matrix'))
+        self.assertEqual(len(matrix.dates), 21)  # calendar days, weekends included
+        ffilled = matrix.frame('ffilled_prices')
+        self.assertEqual(ffilled['MSFT'].iloc[3], 12.)  # forward filled over the gap
+        self.assertTrue(np.isnan(ffilled['FB'].iloc[-1]))  # not filled past the last bar
+        returns = matrix.frame('returns')
+        self.assertAlmostEqual(returns['AAPL'].iloc[1], 0.01)
+        self.assertEqual(returns['AAPL'].loc['2020-01-04'].iloc[0], 0.)  # saturday
+
+    def test_incremental_refresh_matches_build(self):
+        full = UniverseMatrix.build(price_store=self.store('full'), path=os.path.join(self.directory, 'full_matrix'))
+        path = os.path.join(self.directory, 'matrix')
+        UniverseMatrix.build(price_store=self.store('partial', cutoff=datetime(2020, 1, 10)), path=path)
+        refreshed = UniverseMatrix.refresh(price_store=self.store('full'), path=path)
+        self.assertEqual(refreshed.version, 2)
+        for name in ['prices', 'ffilled_prices', 'returns']:
+            pd.testing.assert_frame_equal(refreshed.frame(name), full.frame(name))
+        np.testing.assert_array_equal(refreshed.last_valid, full.last_valid)
+
+    def test_refresh_rebuilds_restated_history(self):
+        path = os.path.join(self.directory, 'matrix')
+        UniverseMatrix.build(price_store=self.store('partial', cutoff=datetime(2020, 1, 10)), path=path)
+        self.frames['AAPL'] = self.frames['AAPL'] * 0.98  # adjusted for a dividend, with the new bars
+        full = UniverseMatrix.build(price_store=self.store('full'), path=os.path.join(self.directory, 'full_matrix'))
+        refreshed = UniverseMatrix.refresh(price_store=self.store('full'), path=path)
+        for name in ['prices', 'ffilled_prices', 'returns']:
+            pd.testing.assert_frame_equal(refreshed.frame(name), full.frame(name))
+        np.testing.assert_array_equal(refreshed.last_valid, full.last_valid)
+
+        # restated without new bars
+        self.frames['MSFT'] = self.frames['MSFT'] * 0.5
+        restated = UniverseMatrix.refresh(price_store=self.store('restated'), path=path)
+        self.assertEqual(restated.version, refreshed.version + 1)
+        self.assertEqual(restated.frame('prices')['MSFT'].dropna().to_list(), [5., 5.5, 6., 6.5, 7.])
+
+    def test_time_data_frame(self):
+        matrix = UniverseMatrix.build(price_store=self.store('full'), path=os.path.join(self.directory, 'matrix'))
+        with mock.patch.dict(universe_matrix_module._open_matrices, {config.UNIVERSE_MATRIX_DIR_PATH: matrix}):
+            # the whole history by default
+            self.assertEqual(len(TimeDataFrame(['AAPL', 'MSFT']).df_returns), 14)  # the first bar has no return
+            self.assertEqual(len(TimeDataFrame(['AAPL'], from_date=datetime(2020, 1, 10)).df_returns), 8)
+        with mock.patch('matilda.data_pipeline.TimeDataFrame.get_universe_matrix') as get_universe_matrix:
+            returns = pd.Series([0.01, -0.02, 0.], index=pd.date_range(datetime(2020, 1, 1), periods=3), name='AAPL')
+            self.assertEqual(TimeDataFrame(returns).df_returns['AAPL'].to_list(), [0.01, -0.02, 0.])
+            get_universe_matrix.assert_not_called()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class TestTradingCalendar(unittest.TestCase):
+    def setUp(self):
+        # business days of January 2020, with bars stamped at 23:59:59
+        self.calendar = TradingCalendar(pd.bdate_range(start=datetime(2020, 1, 1), end=datetime(2020, 1, 31))
+                                        + pd.Timedelta(days=1, seconds=-1))
+
+    def test_sessions_skip_weekends(self):
+        sessions = self.calendar.sessions_between(datetime(2020, 1, 3), datetime(2020, 1, 7))
+        self.assertEqual(sessions.tolist(), [pd.Timestamp(2020, 1, 3), pd.Timestamp(2020, 1, 6),
+                                             pd.Timestamp(2020, 1, 7)])
+        self.assertNotIn(datetime(2020, 1, 4), self.calendar)
+
+    def test_schedule(self):
+        schedule = self.calendar.schedule(datetime(2020, 1, 4), datetime(2020, 1, 31), every=5)
+        self.assertEqual(schedule.tolist(), [pd.Timestamp(2020, 1, day) for day in [6, 13, 20, 27]])
+
+
+class TestAsOfFilingValues(unittest.TestCase):
+    def setUp(self):
+        self.filing_dates = np.array(['2015-03-31', '2015-06-30', '2015-09-30', '2015-12-31', '2016-03-31'],
+                                     dtype='datetime64[ns]')
+        self.filing_values = np.array([1., 2., 3., 4., 5.])
+        self.dates = np.array(['2015-01-01', '2015-07-01', '2016-01-01', '2016-06-01'], dtype='datetime64[ns]')
+
+    def test_quarter(self):
+        # a filing dated on the date itself is not known yet, and there is no filing before the first one
+        dates = np.append(self.dates, self.filing_dates[:1])
+        values = as_of_filing_values(self.filing_dates, self.filing_values, dates, period='Q',
+                                     financial_statement='BalanceSheet')
+        np.testing.assert_array_equal(values, [np.nan, 2, 4, 5, np.nan])
+
+    def test_trailing_and_year_to_date(self):
+        ttm = as_of_filing_values(self.filing_dates, self.filing_values, self.dates, period='TTM',
+                                  financial_statement='IncomeStatement')
+        np.testing.assert_array_equal(ttm, [np.nan, 1.5, 2.5, 3.5])
+        ytd = as_of_filing_values(self.filing_dates, self.filing_values, self.dates, period='YTD',
+                                  financial_statement='BalanceSheet')
+        np.testing.assert_array_equal(ytd, [np.nan, 3, 0, 5])
+
+    def test_rollups(self):
+        # as `rolled_filings_pipeline` computes them: a missing entry in the window makes the sum NaN
+        values = np.column_stack([self.filing_values, [1., np.nan, 1., 1., 1.]])
+        rollups = rolled_filing_values(self.filing_dates, values)
+        np.testing.assert_array_equal(rollups['TTM'][0], [[1, 1], [3, np.nan], [6, np.nan], [10, np.nan], [14, np.nan]])
+        np.testing.assert_array_equal(rollups['TTM'][1], [1, 2, 3, 4, 4])
+        np.testing.assert_array_equal(rollups['YTD'][0][:, 0], [1, 3, 6, 10, 5])
+        np.testing.assert_array_equal(rollups['YTD'][1], [1, 2, 3, 4, 1])
+
+
+class TestDateIndex(unittest.TestCase):
+    def setUp(self):
+        self.dates = pd.date_range(start=datetime(2020, 1, 1), periods=5)
+
+    def test_positions(self):
+        for dates in [self.dates, self.dates.to_numpy(), self.dates.strftime('%Y-%m-%d').to_list()]:
+            self.assertEqual(get_date_index(datetime(2020, 1, 2), dates), 2)
+            self.assertEqual(get_date_index(datetime(2021, 1, 1), dates), -1)
+        np.testing.assert_array_equal(get_date_index([datetime(2019, 1, 1), datetime(2020, 1, 2)], self.dates[::-1]),
+                                      [0, 4])
+        np.testing.assert_array_equal(date_positions(self.dates[[1, 3]], self.dates, side='left'), [1, 3])
+        np.testing.assert_array_equal(date_positions(self.dates[[1, 3]], self.dates[::-1]), [3, 1])
+
+    def test_slice(self):
+        # after `from_date`, up to `to_date` included, whichever way the dates are sorted
+        series = pd.Series(np.arange(5.), index=self.dates)
+        rows = date_slice(series.index, from_date=self.dates[1], to_date=self.dates[3])
+        self.assertEqual(series.iloc[rows].to_list(), [2., 3.])
+        self.assertEqual(series[::-1].iloc[date_slice(series.index[::-1], from_date=self.dates[1],
+                                                      to_date=datetime(2021, 1, 1))].to_list(), [4., 3., 2.])
+        self.assertEqual(date_slice(series.index, to_date=datetime(2021, 1, 1)), slice(0, 5))
+
+
+class TestPriceBuckets(unittest.TestCase):
+    def test_months(self):
+        dates = pd.DatetimeIndex(['2020-02-03', '2020-01-30', '2020-01-31']) + pd.Timedelta(days=1, seconds=-1)
+        data = pd.DataFrame({'Close': [3., 1., 2.], 'Adj Close': [3., 1., 2.], 'Volume': [30, 10, 20]}, index=dates)
+        buckets = list(price_buckets(data))
+        self.assertEqual([month for month, _ in buckets], [datetime(2020, 1, 1), datetime(2020, 2, 1)])
+        january = buckets[0][1]
+        self.assertEqual(january['dates'], [datetime(2020, 1, 30, 23, 59, 59), datetime(2020, 1, 31, 23, 59, 59)])
+        self.assertEqual(january['close'], [1., 2.])
+        self.assertEqual(january['volume'], [10., 20.])
+        self.assertNotIn('open', january)
+
+
+class TestFundamentalsCube(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.line_items = ['BalanceSheet.Assets.TotalAssets', 'IncomeStatement.Revenues.NetSales']
+        self.cube = FundamentalsCube.from_filings(filings={'Quarterly': {
+            'AAPL': self.filings(['2015-03-31', '2015-06-30'], [[1., 10.], [2., 20.]]),
+            'MSFT': self.filings(['2015-06-30'], [[5., np.nan]])}}, line_items=self.line_items,
+            path=os.path.join(self.directory, 'cube'))
+
+    @staticmethod
+    def filings(dates, values):
+        return np.array(dates, dtype='datetime64[ns]'), np.array(values)
+
+    def test_filings(self):
+        self.assertEqual(self.cube.tickers.tolist(), ['AAPL', 'MSFT'])
+        filings = self.cube.filings(['MSFT', 'AAPL', 'TSLA'], ['IncomeStatement.Revenues.NetSales'], 'Quarterly')
+        self.assertEqual(sorted(filings.keys()), ['AAPL', 'MSFT'])
+        np.testing.assert_array_equal(filings['AAPL'][1][:, 0], [10, 20])
+        self.assertEqual(self.cube.filings(['AAPL'], self.line_items, 'Yearly'), {})
+
+    def test_append(self):
+        cube = self.cube.append(filings={'Quarterly': {'AAPL': self.filings(['2015-09-30'], [[3., 30.]])}},
+                                last_ids={})
+        self.assertEqual(cube.version, 2)
+        dates, values = cube.filings(['AAPL'], ['BalanceSheet.Assets.TotalAssets'], 'Quarterly')['AAPL']
+        self.assertEqual(len(dates), 3)
+        np.testing.assert_array_equal(values[:, 0], [1, 2, 3])
+        # filings predating the last one of their ticker, or of new tickers, need a rebuild
+        self.assertIsNone(cube.append(filings={'Quarterly': {'AAPL': self.filings(['2015-01-01'], [[0., 0.]])}},
+                                      last_ids={}))
+        self.assertIsNone(cube.append(filings={'Quarterly': {'TSLA': self.filings(['2015-01-01'], [[0., 0.]])}},
+                                      last_ids={}))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class TestFundamentalsPanel(unittest.TestCase):
+    def test_evaluate(self):
+        panel = FundamentalsPanel(stocks=['AAPL', 'MSFT'], dates=[datetime(2020, 1, 1), datetime(2019, 1, 1)])
+        # as if already read
+        panel.entries[('BalanceSheet', ('Assets', 'TotalAssets'), 'Q', timedelta(days=0))] = np.array([[4., 6.],
+                                                                                                      [8., 9.]])
+        panel.entries[('BalanceSheet', ('Liabilities', 'TotalLiabilities'), 'Q', timedelta(days=0))] = np.ones((2, 2))
+
+        def debt_ratio(stock):
+            return read_financial_statement_entry(stock=stock, financial_statement='BalanceSheet',
+                                                  entry_name=['Liabilities', 'TotalLiabilities'], period='Q') \
+                   / read_financial_statement_entry(stock=stock, financial_statement='BalanceSheet',
+                                                    entry_name=['Assets', 'TotalAssets'], period='Q')
+
+        df = panel.evaluate({'Debt Ratio': debt_ratio})
+        self.assertEqual(df.index.tolist(), [pd.Timestamp(2019, 1, 1), pd.Timestamp(2020, 1, 1)])
+        self.assertEqual(df.columns.tolist(), [('Debt Ratio', 'AAPL'), ('Debt Ratio', 'MSFT')])
+        np.testing.assert_array_equal(df.values, [[0.25, 1 / 6], [0.125, 1 / 9]])
+
+
+class TestReadGraph(unittest.TestCase):
+    def test_evaluate(self):
+        graph = ReadGraph()
+        # as if already read
+        assets = ('AAPL', 'BalanceSheet', ('Assets', 'TotalAssets'), 'Q')
+        graph.leaves[assets + (datetime(2020, 1, 1), None)] = 8.
+        graph.leaves[assets + (datetime(2019, 1, 1), None)] = 4.
+
+        def asset_growth(stock, date):
+            def total_assets(date, lookback_period=timedelta(days=0)):
+                return read_financial_statement_entry(stock=stock, financial_statement='BalanceSheet',
+                                                      entry_name=['Assets', 'TotalAssets'], period='Q', date=date,
+                                                      lookback_period=lookback_period)
+
+            # the previous year read twice, by date and by lookback period
+            return total_assets(date) / total_assets(date - timedelta(days=365)) \
+                   + 0 * total_assets(date, lookback_period=timedelta(days=365))
+
+        df = graph.evaluate({'Asset Growth': asset_growth}, stocks='AAPL', date=datetime(2020, 1, 1))
+        self.assertEqual(df.loc['AAPL', 'Asset Growth'], 2)
+        self.assertEqual(graph.report(), {'Leaf Reads': 3, 'Distinct Leaves': 2, 'Reads Saved': 1,
+                                          'Batched Reads': 0})
+        self.assertEqual(len(graph.dependencies['Asset Growth']), 2)
+
+
+class TestReadMemo(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+        @memoized_read
+        def read_market_price(stock, date=None, lookback_period=timedelta(days=0)):
+            self.calls.append(stock)
+            return pd.Series([100.])
+
+        self.read_market_price = read_market_price
+
+    def test_scope(self):
+        with ReadMemo(maxsize=2) as memo:
+            self.read_market_price('AAPL', datetime(2020, 1, 1))
+            # same normalized arguments
+            self.read_market_price(stock='AAPL', date=pd.Timestamp(2020, 1, 1), lookback_period=timedelta(days=0))
+            self.read_market_price(['AAPL', 'MSFT'], date=[datetime(2020, 1, 1)])
+            self.read_market_price(('AAPL', 'MSFT'), date=(datetime(2020, 1, 1),))
+            with ReadMemo():  # defers to the outer scope
+                price = self.read_market_price('AAPL', datetime(2020, 1, 1))
+                price.iloc[0] = 0  # a copy is returned
+            self.assertEqual(self.read_market_price('AAPL', datetime(2020, 1, 1)).iloc[0], 100.)
+            self.read_market_price('TSLA', datetime(2020, 1, 1))  # evicts the least recently used
+            self.read_market_price(['AAPL', 'MSFT'], date=[datetime(2020, 1, 1)])
+        self.assertEqual(self.calls, ['AAPL', ['AAPL', 'MSFT'], 'TSLA', ['AAPL', 'MSFT']])
+        self.assertEqual((memo.hits, memo.misses), (4, 4))
+
+        self.read_market_price('AAPL', datetime(2020, 1, 1))  # out of scope
+        self.assertEqual(len(self.calls), 5)
+
+
+class TestReadCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ReadCache(path=os.path.join(self.directory, 'read_cache.sqlite'))
+
+    def test_invalidate(self):
+        for key, tickers in [('AAPL', ['AAPL']), ('AAPL MSFT', ['AAPL', 'MSFT']), ('MSFT', ['MSFT'])]:
+            self.cache.get_or_read(key=key, collection='Filing', tickers=tickers, read=lambda: pd.Series([1.]))
+        self.cache.get_or_read(key='AAPL prices', collection='AssetPrices', tickers=['AAPL'], read=lambda: 100.)
+        self.assertEqual(self.cache.get_or_read(key='AAPL prices', collection='AssetPrices', tickers=['AAPL'],
+                                                read=lambda: 0.), 100.)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 4))
+
+        # another process, same cache
+        cache = ReadCache(path=self.cache.path)
+        self.assertEqual(len(cache), 4)
+        cache.invalidate(tickers=['AAPL'], collection='Filing')
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get_or_read(key='AAPL MSFT', collection='Filing', tickers=['AAPL', 'MSFT'],
+                                                read=lambda: 'read again'), 'read again')
+
+    def tearDown(self):
+        self.cache.connection.close()
+        shutil.rmtree(self.directory)
+
+
+class TestIndexMembership(unittest.TestCase):
+    def test_as_of(self):
+        # stored newest first, as scraped
+        membership = IndexMembership([{'date': datetime(2020, 1, 1), 'companies': ['AAPL', 'MSFT']},
+                                      {'date': datetime(2015, 1, 1), 'companies': ['AAPL', 'XOM']}])
+        self.assertEqual(membership.constituents(datetime(2014, 12, 31)), [])
+        self.assertEqual(membership.constituents(datetime(2015, 1, 1)), ['AAPL', 'XOM'])
+        self.assertEqual(membership.constituents(datetime(2021, 1, 1)), ['AAPL', 'MSFT'])
+        self.assertTrue(membership.is_member('XOM', datetime(2019, 12, 31)))
+        self.assertFalse(membership.is_member('XOM', datetime(2020, 1, 1)))
+        self.assertFalse(membership.is_member('GE', datetime(2020, 1, 1)))
+        np.testing.assert_array_equal(
+            membership.membership(['MSFT', 'GE', 'XOM'], [datetime(2014, 1, 1), datetime(2016, 1, 1),
+                                                           datetime(2020, 6, 1)]),
+            [[False, False, False], [False, False, True], [True, False, False]])
+        self.assertEqual(IndexMembership([]).constituents(datetime(2020, 1, 1)), [])
+
+
+class TestClassificationTable(unittest.TestCase):
+    def test_lookups(self):
+        table = ClassificationTable([{'_id': 'XOM', 'gics_sector': 'Energy', 'exchange': 'NYSE'},
+                                     {'_id': 'MSFT', 'gics_sector': 'Information Technology', 'exchange': 'NASDAQ'},
+                                     {'_id': 'AAPL', 'gics_sector': 'Information Technology'}])
+        self.assertIn('AAPL', table)
+        self.assertEqual(table.value('MSFT', 'gics_sector'), 'Information Technology')
+        self.assertIsNone(table.value('AAPL', 'exchange'))
+        self.assertEqual(table.tickers_where('gics_sector', 'Information Technology'), ['AAPL', 'MSFT'])
+        self.assertEqual(table.tickers_where('exchange', 'NYSE'), ['XOM'])
+        self.assertEqual(table.tickers_where('exchange', 'LSE'), [])
+        self.assertEqual(table.classification('XOM')['exchange'], 'NYSE')
+
+
+class TestQueryPlans(unittest.TestCase):
+    def test_plan_stages(self):
+        explain = {'stages': [{'$cursor': {
+            'queryPlanner': {'winningPlan': {'stage': 'PROJECTION_SIMPLE', 'inputStage': {
+                'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': 'period_1_company_1_date_1'}}},
+                'rejectedPlans': [{'stage': 'COLLSCAN'}]},
+            'executionStats': {'nReturned': 8, 'totalKeysExamined': 8, 'totalDocsExamined': 8,
+                               'executionStages': {'stage': 'PROJECTION_SIMPLE'}}}}]}
+        self.assertEqual(plan_stages(explain), ['PROJECTION_SIMPLE', 'FETCH', 'IXSCAN'])
+        self.assertEqual(plan_stages({'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}}), ['COLLSCAN'])
+        self.assertEqual(execution_stats(explain)['totalDocsExamined'], 8)
+
+
+class TestSQLiteBackend(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = SQLiteBackend(path=os.path.join(self.directory, 'local_database.sqlite'))
+        self.filing_dates = pd.DatetimeIndex(['2015-03-31', '2015-06-30', '2015-09-30', '2015-12-31', '2016-03-31'])
+        self.backend.write_filings(object_model.Filing(
+            company='AAPL', date=date, period='Quarterly', BalanceSheet={'Assets': {'TotalAssets': i + 1}},
+            IncomeStatement={'Revenues': {'NetSales': None if i == 1 else 10}})
+            for i, date in enumerate(self.filing_dates))
+        self.entry_paths = ['BalanceSheet.Assets.TotalAssets', 'IncomeStatement.Revenues.NetSales']
+
+    def test_filings(self):
+        filings, last_id = self.backend.read_filings(stocks=['AAPL', 'MSFT'], entry_paths=self.entry_paths,
+                                                     period_type='Quarterly')
+        dates, values = filings['AAPL']
+        np.testing.assert_array_equal(dates, self.filing_dates.to_numpy())
+        np.testing.assert_array_equal(values, [[1, 10], [2, np.nan], [3, 10], [4, 10], [5, 10]])
+
+        # replacing a filing keeps its id, new ones come after the last id read
+        summary = self.backend.write_filings([object_model.Filing(company='AAPL', date=self.filing_dates[0],
+                                                                  period='Quarterly'),
+                                              object_model.Filing(company='MSFT', date=self.filing_dates[0],
+                                                                  period='Quarterly')])
+        self.assertEqual((summary['Inserted'].sum(), summary['Replaced'].sum()), (1, 1))
+        filings, _ = self.backend.read_filings(stocks=None, entry_paths=self.entry_paths, period_type='Quarterly',
+                                               after_id=last_id)
+        self.assertEqual(list(filings), ['MSFT'])
+
+    def test_fundamentals_cube_with_read_cache(self):
+        read_cache = ReadCache(path=os.path.join(self.directory, 'read_cache.sqlite'))
+        path = os.path.join(self.directory, 'cube')
+        set_storage_backend(self.backend)
+        try:
+            with mock.patch.dict(read_cache_module._read_caches, {(config.READ_CACHE_FILE_PATH, os.getpid()):
+                                                                  read_cache}):
+                cube = FundamentalsCube.build(path=path)
+                self.backend.write_filings([object_model.Filing(company='MSFT', date=self.filing_dates[0],
+                                                                period='Quarterly',
+                                                                BalanceSheet={'Assets': {'TotalAssets': 7}})])
+                cube = FundamentalsCube.refresh(path=path)
+            self.assertEqual(len(read_cache), 0)  # reads of every ticker bypass the cache
+        finally:
+            set_storage_backend(None)
+            read_cache.connection.close()
+        filings = cube.filings(['AAPL', 'MSFT'], ['BalanceSheet.Assets.TotalAssets'], 'Quarterly')
+        np.testing.assert_array_equal(filings['AAPL'][1][:, 0], [1, 2, 3, 4, 5])
+        np.testing.assert_array_equal(filings['MSFT'][1][:, 0], [7])
+
+    def test_rolled_filings(self):
+        dates, values, rollups = self.backend.read_rolled_filings(stocks=['AAPL'], entry_paths=self.entry_paths)['AAPL']
+        expected = rolled_filing_values(dates, values)
+        for period in ['TTM', 'YTD']:
+            np.testing.assert_array_equal(rollups[period][0], expected[period][0])
+            np.testing.assert_array_equal(rollups[period][1], expected[period][1])
+
+    def test_prices(self):
+        dates = pd.DatetimeIndex(['2020-01-30', '2020-01-31', '2020-02-03']) + pd.Timedelta(days=1, seconds=-1)
+        data = pd.DataFrame({'Close': [1., 2., 3.]}, index=dates)
+        self.backend.write_price_buckets(object_model.PriceBucket(ticker='AAPL', month=month, **arrays)
+                                         for month, arrays in price_buckets(data))
+        self.assertEqual(self.backend.last_stored_bars(['AAPL', 'MSFT']), {'AAPL': dates[-1].to_pydatetime()})
+        self.assertEqual(self.backend.read_market_prices(['AAPL', 'MSFT'], as_of=datetime(2020, 2, 3)), {'AAPL': 2.})
+        _, prices = self.backend.read_prices('AAPL', from_date=datetime(2020, 1, 31), to_date=datetime(2020, 3, 1))
+        self.assertEqual(prices, [2., 3.])
+
+        # appending again bars already stored leaves them as they are
+        more = pd.DataFrame({'Close': [3., 4.]}, index=dates[-1:].append(dates[-1:] + pd.Timedelta(days=1)))
+        self.backend.append_price_bars(('AAPL', month, arrays) for month, arrays in price_buckets(more))
+        buckets = list(self.backend.documents(object_model.PriceBucket))
+        self.assertEqual([bucket.close for bucket in buckets], [[1., 2.], [3., 4.]])
+
+    def test_populate_from_mid_month(self):
+        dates = pd.bdate_range(start=datetime(2020, 1, 1), end=datetime(2020, 2, 28)) + pd.Timedelta(days=1, seconds=-1)
+        frames = {'AAPL': pd.DataFrame({'Close': np.arange(len(dates), dtype=float)}, index=dates)}
+        store = PriceStore.from_frames(frames=frames, path=os.path.join(self.directory, 'price_store'))
+        set_storage_backend(self.backend)
+        try:
+            with mock.patch.dict(price_store_module._open_stores, {config.PRICE_STORE_DIR_PATH: store}):
+                populate_db_asset_prices(tickers=['AAPL'])
+                populate_db_asset_prices(tickers=['AAPL'], from_date=datetime(2020, 2, 15))
+        finally:
+            set_storage_backend(None)
+        # the bars of February before the 15th are still there
+        stored_dates, prices = self.backend.read_prices('AAPL', from_date=datetime(2020, 1, 1),
+                                                        to_date=datetime(2020, 3, 1))
+        self.assertEqual(pd.DatetimeIndex(stored_dates).to_list(), dates.to_list())
+        self.assertEqual(prices, frames['AAPL']['Close'].to_list())
+
+    def test_backend_choice(self):
+        # the local database existing is not enough, it has to be chosen
+        self.assertIsInstance(get_storage_backend(path=self.backend.path), MongoBackend)
+        with mock.patch.dict(storage_backend_module._local_backends, clear=True), \
+                mock.patch.object(config, 'STORAGE_BACKEND', 'sqlite'):
+            backend = get_storage_backend(path=self.backend.path)
+            self.assertIs(get_storage_backend(path=self.backend.path), backend)
+            backend.connection.close()
+        self.assertEqual(backend.path, self.backend.path)
+
+    def tearDown(self):
+        self.backend.connection.close()
+        shutil.rmtree(self.directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,286 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from functools import partial
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from matilda import config
+from matilda.data_pipeline import db_crud, universe_matrix
+from matilda.data_pipeline.price_store import PriceStore
+from matilda.data_pipeline.universe_matrix import UniverseMatrix
+from matilda.fundamental_analysis.accounting_ratios import current_ratio
+from matilda.fundamental_analysis.fundamental_factor_scores.financial_distress_models import piotroski_f_score
+from matilda.portfolio_management.Portfolio import Portfolio
+from matilda.portfolio_management.parameter_sweep import parameter_grid, parameter_sweep, summary_statistics
+from matilda.portfolio_management.portfolio_simulator import RebalancingFrequency, Strategy
+from matilda.portfolio_management.position_ledger import PositionLedger
+from matilda.portfolio_management.simulation_checkpoint import SimulationCheckpoint
+from matilda.portfolio_management.stock_screener import StockScreener
+from matilda.portfolio_management.walk_forward import FoldCache, cache_namespace, walk_forward_optimization
+
+
+class TestPositionLedger(unittest.TestCase):
+    def setUp(self):
+        self.ledger = PositionLedger(tickers=['AAPL', 'MSFT'])
+        for day, shares in enumerate([10, 20, 30]):
+            self.ledger.enter('AAPL', direction=True, shares=shares, price=100 + day, date=datetime(2020, 1, day + 1))
+        self.ledger.enter('TSLA', direction=False, shares=5, price=400, date=datetime(2020, 1, 1))
+
+    def test_fifo_partial_exit(self):
+        self.assertEqual(self.ledger.exit('AAPL', direction=True, shares=25), 25)
+        self.assertEqual(self.ledger.shares('AAPL'), 35)
+        lots = self.ledger.lots_frame('AAPL')
+        self.assertEqual(lots['Shares'].tolist(), [5, 30])
+        self.assertEqual(lots['Price'].tolist(), [101, 102])
+
+    def test_full_exit(self):
+        self.assertEqual(self.ledger.exit('AAPL', direction=False, shares=10), 0)  # not held short
+        self.assertEqual(self.ledger.exit('AAPL', direction=True, shares=100), 60)
+        self.assertNotIn('AAPL', self.ledger)
+        self.assertEqual(self.ledger.holdings(), [('TSLA', 5)])
+
+    def test_signed_shares(self):
+        self.assertEqual(self.ledger.signed_shares().tolist(), [60, 0, -5])
+        self.assertEqual(self.ledger.signed_shares(['TSLA', 'GOOG', 'AAPL']).tolist(), [-5, 0, 60])
+
+
+class TestParameterSweep(unittest.TestCase):
+    def test_parameter_grid(self):
+        runs = parameter_grid({'max_stocks_count_in_portfolio': [10, 20], 'net_exposure': [(100, 0), (130, 30)]})
+        self.assertEqual(len(runs), 4)
+        self.assertEqual(runs[1], {'max_stocks_count_in_portfolio': 10, 'net_exposure': (130, 30)})
+
+    def test_summary_statistics(self):
+        summary = summary_statistics(pd.DataFrame({'Float': [100., 120., 90., 110.]}))
+        self.assertAlmostEqual(summary['Total Return'], 0.1)
+        self.assertAlmostEqual(summary['Max Drawdown'], -0.25)
+        self.assertEqual(summary['Rebalancing Count'], 4)
+
+
+class TestFoldCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def test_get_or_compute(self):
+        cache = FoldCache(path=self.directory, namespace=1)
+        calls = []
+        for _ in range(2):
+            value = cache.get_or_compute(('screen_stocks', '2020-01-02'), lambda: calls.append(1) or ['AAPL'])
+            self.assertEqual(value, ['AAPL'])
+        self.assertEqual((len(calls), cache.hits, cache.misses), (1, 1, 1))
+
+        # results computed on another version of the data are not served
+        cache = FoldCache(path=self.directory, namespace=2)
+        cache.get_or_compute(('screen_stocks', '2020-01-02'), lambda: ['MSFT'])
+        self.assertEqual(cache.misses, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class TestSimulationCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def test_round_trip(self):
+        path = os.path.join(self.directory, 'checkpoint.pkl')
+        self.assertIsNone(SimulationCheckpoint.load(path))
+
+        positions = PositionLedger(tickers=['AAPL', 'MSFT'])
+        positions.enter('MSFT', direction=True, shares=10, price=200, date=datetime(2020, 1, 2))
+        results = [['2020-01-02', positions.holdings(), 3000, 5000]]
+        SimulationCheckpoint(run={'engine': 'event'}, last_date=datetime(2020, 1, 3), balance=3000, float_=5010,
+                             last_rebalancing_day=datetime(2020, 1, 2), positions=positions,
+                             results=results).save(path)
+
+        checkpoint = SimulationCheckpoint.load(path)
+        self.assertEqual(checkpoint.run, {'engine': 'event'})
+        self.assertEqual(checkpoint.results, results)
+        self.assertEqual(checkpoint.positions.shares('MSFT'), 10)
+        self.assertEqual(checkpoint.positions.lots_frame('MSFT')['Price'].tolist(), [200])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class RotatingStrategy(Strategy):
+    """
+    Equally weighted in two of the three tickers, rotating every month.
+    """
+    def screen_stocks(self, current_date):
+        tickers = ['AAPL', 'MSFT', 'TSLA', 'AAPL']
+        return tickers[current_date.month % 3:][:2], []
+
+    def portfolio_allocation_regime(self, portfolio):
+        return pd.Series(0.45, index=portfolio.df_returns.columns)
+
+
+class WeeklyTimingStrategy(RotatingStrategy):
+    def is_market_timing(self, portfolio):
+        # a week after the last bar the allocation was optimized on
+        return (portfolio.date - portfolio.df_returns.index[-1]).days >= 7
+
+
+class InterruptedStrategy(WeeklyTimingStrategy):
+    def __init__(self, interrupt_on: datetime, **kwargs):
+        super().__init__(**kwargs)
+        self._interrupt_on = interrupt_on  # not a parameter of the run
+
+    def screen_stocks(self, current_date):
+        if current_date >= self._interrupt_on:
+            self._interrupt_on = datetime.max
+            raise KeyboardInterrupt
+        return super().screen_stocks(current_date)
+
+
+class TestHistoricalSimulation(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        dates = pd.bdate_range(start=datetime(2020, 1, 1), end=datetime(2020, 6, 30))
+        dates = dates.drop(pd.Timestamp(2020, 1, 20)) + pd.Timedelta(days=1, seconds=-1)  # a market holiday
+        random = np.random.default_rng(0)
+        frames = {ticker: pd.DataFrame({'Adj Close': 100 * np.exp(np.cumsum(random.normal(0, 0.02, len(dates))))},
+                                       index=dates) for ticker in ['AAPL', 'MSFT', 'TSLA']}
+        store = PriceStore.from_frames(frames=frames, path=os.path.join(self.directory, 'price_store'))
+        matrix = UniverseMatrix.build(price_store=store, path=os.path.join(self.directory, 'universe_matrix'))
+        self.patches = [mock.patch.dict(universe_matrix._open_matrices, {config.UNIVERSE_MATRIX_DIR_PATH: matrix})]
+        for patch in self.patches:
+            patch.start()
+
+    def simulate(self, strategy, engine, **kwargs):
+        return strategy.historical_simulation(starting_date=datetime(2020, 1, 6), ending_date=datetime(2020, 6, 15),
+                                              starting_capital=10000, engine=engine, verbose=False, **kwargs)
+
+    def test_engines_agree(self):
+        for strategy in [RotatingStrategy(max_stocks_count_in_portfolio=2, net_exposure=(100, 0),
+                                          rebalancing_frequency=RebalancingFrequency.Weekly),
+                         WeeklyTimingStrategy(max_stocks_count_in_portfolio=2, net_exposure=(100, 0))]:
+            event = self.simulate(strategy, engine='event')
+            vectorized = self.simulate(strategy, engine='vectorized')
+            self.assertGreater(len(event), 20)
+            self.assertNotEqual(event['Float'].iloc[-1], 10000)
+            pd.testing.assert_frame_equal(event, vectorized)
+
+    def test_rebalancing_dates(self):
+        strategy = RotatingStrategy(max_stocks_count_in_portfolio=2, net_exposure=(100, 0),
+                                    rebalancing_frequency=RebalancingFrequency.Weekly)
+        evolution_df = self.simulate(strategy, engine='event')
+        # every 5th session, the holiday skipped
+        self.assertEqual(evolution_df.index[:4].to_list(), ['2020-01-06', '2020-01-13', '2020-01-21', '2020-01-28'])
+        self.assertEqual(evolution_df.index[-1], '2020-06-09')
+        closed_df = self.simulate(strategy, engine='event', close_last_session=True)
+        self.assertEqual(closed_df.index[-2:].to_list(), ['2020-06-09', '2020-06-15'])
+
+        portfolio = Portfolio(assets=[], balance=10000, date=datetime(2020, 1, 24))
+        portfolio.last_rebalancing_day = datetime(2020, 1, 17)
+        self.assertFalse(strategy.is_market_timing(portfolio=portfolio))  # 4 sessions later
+        portfolio.date = datetime(2020, 1, 27)
+        self.assertTrue(strategy.is_market_timing(portfolio=portfolio))
+
+    def test_resume_and_extend(self):
+        for engine in ['event', 'vectorized']:
+            strategy = WeeklyTimingStrategy(max_stocks_count_in_portfolio=2, net_exposure=(100, 0))
+            uninterrupted = self.simulate(strategy, engine=engine)
+
+            path = os.path.join(self.directory, '{}.pkl'.format(engine))
+            strategy = InterruptedStrategy(interrupt_on=datetime(2020, 2, 20), max_stocks_count_in_portfolio=2,
+                                           net_exposure=(100, 0))
+            with self.assertRaises(KeyboardInterrupt):
+                strategy.historical_simulation(starting_date=datetime(2020, 1, 6), ending_date=datetime(2020, 3, 31),
+                                               starting_capital=10000, engine=engine, verbose=False,
+                                               checkpoint_path=path, checkpoint_every=5)
+            strategy.historical_simulation(starting_date=datetime(2020, 1, 6), ending_date=datetime(2020, 3, 31),
+                                           starting_capital=10000, engine=engine, verbose=False,
+                                           checkpoint_path=path, checkpoint_every=5)  # resumed
+            extended = self.simulate(strategy, engine=engine, checkpoint_path=path)
+            pd.testing.assert_frame_equal(extended, uninterrupted)
+
+            # the checkpoint belongs to a run with other parameters
+            strategy = InterruptedStrategy(interrupt_on=datetime.max, max_stocks_count_in_portfolio=3,
+                                           net_exposure=(100, 0))
+            with self.assertRaisesRegex(Exception, 'another run'):
+                self.simulate(strategy, engine=engine, checkpoint_path=path)
+
+    def test_parameter_sweep(self):
+        grid = {'max_stocks_count_in_portfolio': [2], 'net_exposure': [(100, 0)],
+                'rebalancing_frequency': [RebalancingFrequency.Weekly, RebalancingFrequency.Monthly]}
+        evolution_df, summary_df = parameter_sweep(
+            RotatingStrategy, grid=grid, starting_date=datetime(2020, 1, 6), ending_date=datetime(2020, 6, 15), starting_capital=10000, processes=1)
+        self.assertEqual(len(summary_df), 2)
+        monthly = self.simulate(RotatingStrategy(max_stocks_count_in_portfolio=2, net_exposure=(100, 0),
+                                                 rebalancing_frequency=RebalancingFrequency.Monthly), engine='event')
+        self.assertEqual(evolution_df[evolution_df['Run'] == 1]['Float'].to_list(), monthly['Float'].to_list())
+        self.assertEqual(summary_df['Final Float'].iloc[1], monthly['Float'].iloc[-1])
+
+    def test_walk_forward_optimization(self):
+        cache_path = os.path.join(self.directory, 'cache')
+        grid = {'max_stocks_count_in_portfolio': [2], 'net_exposure': [(100, 0)],
+                'rebalancing_frequency': [RebalancingFrequency.Weekly, RebalancingFrequency.Monthly]}
+        runs = [walk_forward_optimization(RotatingStrategy, grid=grid, starting_date=datetime(2020, 1, 6),
+                                          ending_date=datetime(2020, 6, 15), starting_capital=10000,
+                                          in_sample_sessions=40, out_of_sample_sessions=20, processes=1,
+                                          cache_path=cache_path) for _ in range(2)]
+        (folds_df, evolution_df), (cached_folds_df, cached_evolution_df) = runs
+        self.assertEqual(len(folds_df), 4)
+        self.assertGreater(folds_df['Cache Hits'].sum(), 0)  # overlapping in-sample windows
+        self.assertEqual(cached_folds_df['Cache Misses'].sum(), 0)
+        pd.testing.assert_frame_equal(folds_df.drop(columns=['Cache Hits', 'Cache Misses']),
+                                      cached_folds_df.drop(columns=['Cache Hits', 'Cache Misses']))
+        pd.testing.assert_frame_equal(evolution_df, cached_evolution_df)
+        # each out-of-sample window is closed on its last session
+        last_dates = evolution_df.groupby('Fold')['Date'].last()
+        self.assertEqual(last_dates.to_list(), folds_df['Out-of-Sample End'].dt.strftime('%Y-%m-%d').to_list())
+
+        # another strategy does not get the cached results of this one
+        strategy = RotatingStrategy(max_stocks_count_in_portfolio=2, net_exposure=(100, 0))
+        timing_strategy = WeeklyTimingStrategy(max_stocks_count_in_portfolio=2, net_exposure=(100, 0))
+        self.assertNotEqual(cache_namespace(RotatingStrategy, strategy),
+                            cache_namespace(WeeklyTimingStrategy, timing_strategy))
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.directory)
+
+
+class TestStockScreener(unittest.TestCase):
+    @staticmethod
+    def read_financial_statement_entries(stocks, entries, dates=None, lookback_period=timedelta(days=0)):
+        # every entry of a ticker is a multiple of its scale, a year ago is the same for both tickers
+        scales = {'AAPL': 2., 'MSFT': 1.} if lookback_period == timedelta(days=0) else {'AAPL': 1.5, 'MSFT': 1.5}
+        stocks, dates = db_crud.format_input(stocks, dates)
+        rows = [(date, stock, db_crud.entry_path(statement, name), period,
+                 (len(db_crud.entry_path(statement, name)) % 7 + 1) * scales[stock])
+                for stock in stocks for statement, name, period in entries for date in dates]
+        return pd.DataFrame(rows, columns=['Date', 'Ticker', 'Entry', 'Period', 'Value'])
+
+    def setUp(self):
+        self.patch = mock.patch.object(db_crud, 'read_financial_statement_entries',
+                                       side_effect=self.read_financial_statement_entries)
+        self.reads = self.patch.start()
+        self.screener = StockScreener(securities_universe=['AAPL', 'MSFT'], date=datetime(2020, 1, 1))
+
+    def test_composite_score(self):
+        # formats its components, so it is evaluated stock by stock
+        metric = partial(piotroski_f_score, period='FY')
+        scores = [metric('AAPL', datetime(2020, 1, 1)), metric('MSFT', datetime(2020, 1, 1))]
+        self.assertEqual(scores, [3, 4])
+        self.assertEqual(self.screener.filter_by_comparison_to_number(metric, '>=', 4), ['MSFT'])
+
+    def test_ratio_over_panel(self):
+        self.screener.filter_by_comparison_to_number(partial(current_ratio, period='FY'), '>', 0)
+        self.assertEqual(self.screener.stocks, ['AAPL', 'MSFT'])
+        # each line item read once for both stocks
+        self.assertEqual([call.kwargs['stocks'] for call in self.reads.call_args_list], [['AAPL', 'MSFT']] * 2)
+
+    def tearDown(self):
+        self.patch.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()